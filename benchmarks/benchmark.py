@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+import argparse
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+SOURCE_ROOT = Path(__file__).resolve().parent.parent / "src"
+TESTS_ROOT = Path(__file__).resolve().parent.parent / "tests"  # the fake registry and daemon live with the tests
+sys.path.insert(0, str(SOURCE_ROOT))
+
+from summary import format_bytes  # noqa: E402
+from summary import parse_size  # noqa: E402
+
+USAGE = """runs the replicator against a fake registry and an in-process fake docker daemon, and reports how fast it went
+
+Every scenario runs in a fresh process: it generates a synthetic input file, seeds a source registry with its images and
+runs the real CLI (replicate, construct_build and everything under them) against an empty destination registry. Only the
+docker daemon is replaced, with tests/fakes.FakeDocker, which moves the same layers through the same registries.
+
+    python benchmarks/benchmark.py --entries 100 1000 --max-workers 4 16 --latency 20 --bandwidth 50MB
+    python benchmarks/benchmark.py --output new.json --compare old.json
+
+Options after -- are passed to the replicator, e.g. -- --registry-max-workers 4
+"""
+
+METRICS_COMPARED = {  # metric -> whether higher is better
+    "wall_seconds": False,
+    "entries_per_second": True,
+    "bytes_per_second": True,
+    "peak_memory_bytes": False,
+    "requests_per_entry": False,
+}
+
+
+def synthesize(
+    workdir: Path,
+    source: Any,
+    destination: Any,
+    entries: int,
+    layers: int,
+    layer_size: int,
+    shared_layers: int,
+    duplicates: float,
+    builds: int,
+    seed: int,
+) -> Path:
+    """seeds the source registry and writes an input file replicating it to the destination registry
+
+    Args:
+        workdir (Path): folder for the input file and build contexts
+        source (FakeRegistry): registry to seed with the source images
+        destination (FakeRegistry): registry to replicate to
+        entries (int): number of replication entries
+        layers (int): layers per source image
+        layer_size (int): bytes per layer
+        shared_layers (int): number of base layers shared between the source images, 0 for none
+        duplicates (float): fraction of entries replicating a source another entry already replicates, to another repository
+        builds (int): number of build entries
+        seed (int): seed for the layer contents
+
+    Returns:
+        Path: input file
+    """
+    import yaml
+
+    generator = random.Random(seed)
+    bases = [generator.randbytes(layer_size) for _ in range(shared_layers)]
+    sources = max(1, round(entries * (1 - duplicates)))
+    digests: Dict[int, str] = dict()
+    images: List[Dict[str, Any]] = list()
+    for index in range(entries):
+        number, copy = index % sources, index // sources
+        repository = f"bench/app{number}"
+        if copy == 0:
+            content = [bases[number % shared_layers]] if bases else list()
+            content += [generator.randbytes(layer_size) for _ in range(layers - len(content))]
+            digests[number] = source.seed_image(repository, "1.0", content)
+        entry: Dict[str, Any] = {
+            "source": {"repository": f"{source.host}/{repository}", "tag": "1.0"},
+            "destination": {"repository": f"{destination.host}/mirror{copy}/app{number}"},
+        }
+        if number % 10 == 0:
+            # a share of the sources pinned by digest, like a real input file would have
+            entry["source"]["sha256"] = digests[number].split(":")[1]
+        images.append(entry)
+    for index in range(builds):
+        folder = workdir / f"build{index}"
+        folder.mkdir()
+        (folder / "Dockerfile").write_text("FROM scratch\nCOPY app /app\n")
+        (folder / "app").write_bytes(generator.randbytes(layer_size))
+        images.append(
+            {
+                "destination": {"repository": f"{destination.host}/built/app{index}"},
+                "build": {"build_folder": str(folder), "tags": ["1.0", "latest"]},
+            }
+        )
+    input_file = workdir / "benchmark.yaml"
+    with open(input_file, "w", encoding="utf-8") as file:
+        yaml.safe_dump({"images": images}, file)
+    return input_file
+
+
+def peak_memory() -> Optional[int]:
+    """peak resident memory of this process in bytes, None where the platform doesn't report it"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, KiB elsewhere
+
+
+def run_replicator(cli: Any, daemon: Any, argv: List[str]) -> Tuple[float, int]:
+    """runs the CLI once with the fake daemon in place of a real one
+
+    Args:
+        cli (module): the loaded container-image-replicator script
+        daemon (FakeDocker): fake daemon
+        argv (List[str]): CLI arguments
+
+    Returns:
+        Tuple[float, int]: wall time in seconds and exit code
+    """
+    from engines import DockerEngine
+    from engines import EnginePool
+
+    cli.init_docker = lambda hosts, contexts: EnginePool(cli.logger, [DockerEngine("fake", daemon)])
+    sys.argv = ["container-image-replicator"] + argv
+    started = time.perf_counter()
+    code = 0
+    try:
+        cli.main()
+    except SystemExit as e:
+        code = int(e.code or 0)
+    return time.perf_counter() - started, code
+
+
+def run_scenario(scenario: Dict[str, Any]) -> Dict[str, Any]:
+    """runs one scenario from scratch, in its own process so that peak memory and module state belong to it alone
+
+    Args:
+        scenario (Dict[str, Any]): parameters, see scenarios()
+
+    Returns:
+        Dict[str, Any]: the parameters and what was measured
+    """
+    import logging
+
+    sys.path.insert(0, str(TESTS_ROOT))
+    from fakes import FakeDocker
+    from fakes import FakeRegistry
+
+    loader = importlib.util.spec_from_file_location("container_image_replicator", SOURCE_ROOT / "container-image-replicator.py")
+    assert loader is not None and loader.loader is not None
+    cli = importlib.util.module_from_spec(loader)
+    loader.loader.exec_module(cli)
+    for name in ("urllib3", "docker"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    latency = scenario["latency_ms"] / 1000
+    registries = {
+        "source": FakeRegistry(latency, scenario["bandwidth"], scenario["error_rate"], scenario["seed"]),
+        "destination": FakeRegistry(latency, scenario["bandwidth"], scenario["error_rate"], scenario["seed"] + 1),
+    }
+    daemon = FakeDocker(list(registries.values()), scenario["build_seconds"])
+    with tempfile.TemporaryDirectory(prefix="cir-benchmark-") as directory:
+        workdir = Path(directory)
+        input_file = synthesize(
+            workdir,
+            registries["source"],
+            registries["destination"],
+            scenario["entries"],
+            scenario["layers"],
+            scenario["layer_size"],
+            scenario["shared_layers"],
+            scenario["duplicates"],
+            scenario["builds"],
+            scenario["seed"],
+        )
+        result_file = workdir / "results.json"
+        argv = ["--engine", scenario["engine"], "--max-workers", str(scenario["max_workers"]), "--no-color", "--log-level", "ERROR"]
+        argv += ["--result-file", str(result_file)] + scenario["extra_args"] + [str(input_file)]
+
+        wall_seconds, code = run_replicator(cli, daemon, argv)
+        outcomes = json.loads(result_file.read_text())["counts"] if result_file.exists() else dict()
+        requests = {name: dict(sorted(registry.requests.items())) for name, registry in registries.items()}
+        total = sum(sum(counts.values()) for counts in requests.values())
+        transferred = registries["destination"].bytes_received
+        metrics: Dict[str, Any] = {
+            "exit_code": code,
+            "outcomes": outcomes,
+            "wall_seconds": round(wall_seconds, 3),
+            "entries_per_second": round(scenario["entries"] / wall_seconds, 2),
+            "bytes_per_second": round(transferred / wall_seconds),
+            "bytes_pulled": registries["source"].bytes_sent,
+            "bytes_pushed": transferred,
+            "requests": requests,
+            "requests_total": total,
+            "requests_per_entry": round(total / (scenario["entries"] + scenario["builds"]), 2),
+            "errors_injected": sum(registry.errors_injected for registry in registries.values()),
+        }
+
+        if scenario["rerun"]:
+            # the same input again, against destinations that are now up to date, measures the checks on their own
+            for registry in registries.values():
+                registry.reset_counters()
+            result_file.unlink(missing_ok=True)
+            rerun_seconds, rerun_code = run_replicator(cli, daemon, argv)
+            rerun_total = sum(sum(registry.requests.values()) for registry in registries.values())
+            metrics["rerun"] = {
+                "exit_code": rerun_code,
+                "outcomes": json.loads(result_file.read_text())["counts"] if result_file.exists() else dict(),
+                "wall_seconds": round(rerun_seconds, 3),
+                "entries_per_second": round(scenario["entries"] / rerun_seconds, 2),
+                "requests_total": rerun_total,
+                "requests_per_entry": round(rerun_total / (scenario["entries"] + scenario["builds"]), 2),
+            }
+
+    metrics["peak_memory_bytes"] = peak_memory()
+    daemon.close()
+    for registry in registries.values():
+        registry.close()
+    return {"parameters": scenario, "metrics": metrics}
+
+
+def scenarios(arguments: Any) -> List[Dict[str, Any]]:
+    """every combination of the entries, engines and worker counts given, with the shared parameters"""
+    shared = {
+        "latency_ms": arguments.latency,
+        "bandwidth": arguments.bandwidth,
+        "error_rate": arguments.error_rate,
+        "layers": arguments.layers,
+        "layer_size": arguments.layer_size,
+        "shared_layers": arguments.shared_layers,
+        "duplicates": arguments.duplicates,
+        "builds": arguments.builds,
+        "build_seconds": arguments.build_seconds,
+        "seed": arguments.seed,
+        "rerun": arguments.rerun,
+        "extra_args": arguments.extra_args,
+    }
+    return [
+        dict(shared, entries=entries, engine=engine, max_workers=max_workers)
+        for entries, engine, max_workers in itertools.product(arguments.entries, arguments.engine, arguments.max_workers)
+    ]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=SOURCE_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe(parameters: Dict[str, Any]) -> str:
+    return f"{parameters['entries']} entries, {parameters['engine']}, {parameters['max_workers']} workers"
+
+
+def print_scenario(result: Dict[str, Any]) -> None:
+    metrics = result["metrics"]
+    peak = metrics["peak_memory_bytes"]
+    print(
+        f"{describe(result['parameters'])}: {metrics['wall_seconds']:.2f}s, {metrics['entries_per_second']:.1f} entries/s, "
+        f"{format_bytes(metrics['bytes_per_second'])}/s, {metrics['requests_per_entry']:.1f} requests/entry, "
+        f"peak memory {format_bytes(peak) if peak is not None else 'unknown'}, outcomes {metrics['outcomes']}"
+        + (f", exit code {metrics['exit_code']}" if metrics["exit_code"] else "")
+    )
+    if "rerun" in metrics:
+        rerun = metrics["rerun"]
+        print(f"  rerun: {rerun['wall_seconds']:.2f}s, {rerun['requests_per_entry']:.1f} requests/entry, outcomes {rerun['outcomes']}")
+
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]) -> None:
+    """prints how each scenario changed against the one with the same parameters in a baseline report
+
+    Args:
+        baseline (Dict[str, Any]): earlier report
+        report (Dict[str, Any]): this run's report
+    """
+    print(f"\ncompared with {baseline.get('revision') or 'baseline'} from {baseline.get('created', 'unknown')}:")
+    for result in report["scenarios"]:
+        previous = next((old for old in baseline.get("scenarios", list()) if old["parameters"] == result["parameters"]), None)
+        if previous is None:
+            print(f"{describe(result['parameters'])}: not in the baseline")
+            continue
+        changes = list()
+        for metric, higher_is_better in METRICS_COMPARED.items():
+            old, new = previous["metrics"].get(metric), result["metrics"].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change < 0 if higher_is_better else change > 0
+            changes.append(f"{metric} {old} -> {new} ({change:+.1f}%{' worse' if worse and abs(change) >= 5 else ''})")
+        print(f"{describe(result['parameters'])}:\n  " + "\n  ".join(changes))
+
+
+def init_arg_parser() -> Any:
+    parser = argparse.ArgumentParser(description=USAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, nargs="+", default=[100, 1000], help="numbers of entries to run, one scenario each")
+    parser.add_argument("--engine", choices=["daemon", "registry"], nargs="+", default=["daemon", "registry"], help="engines to run")
+    parser.add_argument("--max-workers", type=int, nargs="+", default=[4, 16], dest="max_workers", help="--max-workers values to run")
+    parser.add_argument("--latency", type=float, default=5.0, help="milliseconds added to every registry request")
+    parser.add_argument("--bandwidth", type=parse_size, default=0, help="bytes per second of each registry, e.g. 50MB. 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, dest="error_rate", help="fraction of registry requests failing with a 503")
+    parser.add_argument("--layers", type=int, default=3, help="layers per source image")
+    parser.add_argument("--layer-size", type=parse_size, default=4096, dest="layer_size", help="size of each layer, e.g. 1MB")
+    parser.add_argument(
+        "--shared-layers", type=int, default=5, dest="shared_layers", help="base layers shared between source images, 0 for none"
+    )
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of entries replicating an already listed source elsewhere")
+    parser.add_argument("--builds", type=int, default=0, help="build entries to add")
+    parser.add_argument("--build-seconds", type=float, default=0.05, dest="build_seconds", help="time each fake build takes")
+    parser.add_argument("--seed", type=int, default=0, help="seed for layer contents and injected errors")
+    parser.add_argument("--rerun", action="store_true", help="run every scenario a second time, once its destinations are up to date")
+    parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"), help="JSON report to write")
+    parser.add_argument("--compare", type=Path, metavar="BASELINE", help="report of an earlier run to compare against")
+    if "--" in sys.argv:
+        split = sys.argv.index("--")
+        arguments = parser.parse_args(sys.argv[1:split])
+        arguments.extra_args = sys.argv[split + 1 :]
+    else:
+        arguments = parser.parse_args()
+        arguments.extra_args = list()
+    if not 0 <= arguments.duplicates < 1 or not 0 <= arguments.error_rate < 1:
+        parser.error("--duplicates and --error-rate must be at least 0 and below 1")
+    if arguments.layers < 1:
+        parser.error("--layers must be at least 1")
+    return arguments
+
+
+def main() -> None:
+    """main"""
+    arguments = init_arg_parser()
+    report: Dict[str, Any] = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": list(),
+    }
+    for scenario in scenarios(arguments):
+        # a fresh process per scenario, so one's peak memory, caches and leftover threads don't skew the next
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_scenario, scenario).result()
+        print_scenario(result)
+        report["scenarios"].append(result)
+    with open(arguments.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+    print(f"wrote {len(report['scenarios'])} scenarios to {arguments.output}")
+    if arguments.compare is not None:
+        compare(json.loads(arguments.compare.read_text()), report)
+
+
+if __name__ == "__main__":
+    main()
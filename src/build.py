@@ -1,67 +1,162 @@
-import logging
+import time
+from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import wait
+from dataclasses import dataclass
+from dataclasses import field
 from json import dumps
 from pathlib import Path
-from sys import exit
 from typing import Any
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Tuple
 
 import docker
+import requests
 from typing_extensions import LiteralString
 
+from buildcontext import CONTEXT_HASH_LABEL
+from buildcontext import hash_build_context
+from entries import parse_image_reference
+from plan import in_shard
 from push import push_image
+from registry import RegistryError
+from registry import RegistryPool
+from results import RESULT_BUILT
+from results import RESULT_FAILED
+from results import RESULT_UP_TO_DATE
+from results import RunResults
+from tracing import span
 
 
-def construct_build(logger: Any, arguments: Any, docker_client: Any, image_list: list[dict[str, Any]]) -> bool:
+@dataclass
+class BuildResult:
+    """outcome and timings of one build entry"""
+
+    repository: str
+    tags: List[str]
+    build_folder: str = ""
+    built: bool = False
+    skipped: bool = False
+    pushed: List[str] = field(default_factory=list)  # tags pushed successfully
+    errors: Dict[str, str] = field(default_factory=dict)  # unexpected error per tag that failed to push
+    context_hash: str = ""
+    hash_seconds: float = 0.0
+    build_seconds: float = 0.0
+    push_seconds: float = 0.0
+
+
+def construct_build(logger: Any, arguments: Any, docker_client: Any, image_list: Iterable[Dict[str, Any]], results: RunResults) -> bool:
     logger.info(f"preparing threads for building. Maximum threads: {arguments.max_workers}")
-    thread_pool = ThreadPoolExecutor(max_workers=arguments.max_workers)
-    for image in list(image_list):
-        build_folder: Path = Path(image["build"]["build_folder"])
-        destination_repository: str = str(image["destination"]["repository"])
-        dockerfile: Path = Path(image["build"]["dockerfile"])
-
-        # construct dict to contain build info for this image
-        build_args = dict(image["build"]["build_args"])
-        tags = list(image["build"]["tags"])
-
-        # validations
-        # validate build_path
-        if Path.is_dir(build_folder):
-            logger.debug(f'Build path found at: "{build_folder}"')
-        else:
-            logging.error(f'Unable to locate the build path: "{build_folder}" in {dumps(image)}')
-            break  # skip building/pushing
-
-        # validate dockerfile path
-        # TODO check if Dockerfile is in the build_folder
-        if Path.is_file(dockerfile):
-            logger.debug(f'Dockerfile found at: "{dockerfile}"')
-        else:
-            logging.error(f'Unable to locate the Dockerfile: "{dockerfile}" in {dumps(image)}"')
-            break  # skip building/pushing
-
-        # TODO validate that there is at least one tag
-        # combine repositories and tags
-        destination_endpoints = list()
-        for tag in tags:
-            destination_endpoints.append(f"{destination_repository}:{tag}")
-
-        # create threads
-        threads = [
-            thread_pool.submit(
-                docker_build, logger, arguments, build_folder, docker_client, dockerfile, destination_endpoints, tags, build_args
+    registry_pool = RegistryPool(logger, arguments)
+    threads: Dict[Future[BuildResult], Tuple[Path, str, List[str]]] = dict()
+    with ThreadPoolExecutor(max_workers=arguments.max_workers) as thread_pool:
+        # builds are submitted as their entries are read, so they start before the whole input has been read
+        for image in image_list:
+            build_folder: Path = Path(image["build"]["build_folder"])
+            destination_repository: str = str(image["destination"]["repository"])
+            # dockerfile and build_args are optional, same as with `docker build`
+            dockerfile: Path = Path(image["build"].get("dockerfile") or build_folder / "Dockerfile")
+            build_args = {str(key): str(value) for key, value in dict(image["build"].get("build_args") or dict()).items()}
+            tags = [str(tag) for tag in image["build"]["tags"]]
+            if not in_shard(destination_repository, arguments.shard):
+                continue
+
+            # validations
+            # validate build_path
+            if Path.is_dir(build_folder):
+                logger.debug(f'Build path found at: "{build_folder}"')
+            else:
+                logger.error(f'Unable to locate the build path: "{build_folder}" in {dumps(image)}')
+                results.record(str(build_folder), destination_repository, RESULT_FAILED, "build path not found")
+                continue  # skip building/pushing
+
+            # validate dockerfile path
+            if Path.is_file(dockerfile):
+                logger.debug(f'Dockerfile found at: "{dockerfile}"')
+            else:
+                logger.error(f'Unable to locate the Dockerfile: "{dockerfile}" in {dumps(image)}"')
+                results.record(str(build_folder), destination_repository, RESULT_FAILED, "Dockerfile not found")
+                continue  # skip building/pushing
+
+            if len(tags) == 0:
+                logger.error(f"{destination_repository} - no tags to build in {dumps(image)}")
+                results.record(str(build_folder), destination_repository, RESULT_FAILED, "no tags")
+                continue
+
+            thread = thread_pool.submit(
+                docker_build,
+                logger,
+                arguments,
+                build_folder,
+                docker_client,
+                dockerfile,
+                destination_repository,
+                tags,
+                build_args,
+                registry_pool,
             )
-        ]
+            threads[thread] = (build_folder, destination_repository, tags)
 
-    # if there were no threads just continue
-    try:
-        if len(threads) > 0:
-            wait(threads, return_when="ALL_COMPLETED")
-    except UnboundLocalError:
-        pass
+        wait(threads, return_when="ALL_COMPLETED")
+
+    for thread, (build_folder, destination_repository, tags) in threads.items():
+        try:
+            result: BuildResult = thread.result()
+        except Exception as e:  # e.g. an unreadable build context or a lost connection to the daemon, the other builds still count
+            logger.error(f"{destination_repository} - failed to build {build_folder}: {e}")
+            for tag in tags:
+                results.record(str(build_folder), f"{destination_repository}:{tag}", RESULT_FAILED, str(e))
+            continue
+        for tag in result.tags:
+            if result.skipped:
+                status, detail = RESULT_UP_TO_DATE, result.context_hash
+            elif tag in result.pushed:
+                status, detail = RESULT_BUILT, result.context_hash
+            else:
+                status, detail = RESULT_FAILED, result.errors.get(tag, "push failed" if result.built else "build failed")
+            results.record(str(result.build_folder), f"{result.repository}:{tag}", status, detail)
+        if result.skipped:
+            logger.info(
+                f"{result.repository} - skipped, build context unchanged ({result.context_hash}, hashed in {result.hash_seconds:.2f}s)"
+            )
+            continue
+        logger.info(
+            f"{result.repository} - hashed in {result.hash_seconds:.2f}s, build {'succeeded' if result.built else 'failed'} in "
+            f"{result.build_seconds:.2f}s, pushed {len(result.pushed)}/{len(result.tags)} tags in {result.push_seconds:.2f}s"
+        )
+    registry_pool.retry_stats.log(logger)
+    registry_pool.close()
+    return True
+
+
+def destination_is_current(
+    logger: Any, registry_pool: RegistryPool, destination_repository: LiteralString, tags: List[LiteralString], context_hash: str
+) -> bool:
+    """checks whether every tag at the destination was built from the same inputs, using the label stamped on it
 
+    Args:
+        registry_pool (RegistryPool): shared registry clients
+        destination_repository (LiteralString): repository the tags are pushed to
+        tags (List[LiteralString]): tags of the entry
+        context_hash (str): hash of the current build inputs
+
+    Returns:
+        bool: True if the build and push can be skipped
+    """
+    host, path = parse_image_reference(destination_repository)
+    client = registry_pool.get(host)
+    for tag in tags:
+        try:
+            labels = client.get_labels(path, tag)
+        except (RegistryError, requests.RequestException) as e:
+            logger.debug(f"{destination_repository}:{tag} - unable to read labels, building anyway: {e}")
+            return False
+        if labels is None or labels.get(CONTEXT_HASH_LABEL) != context_hash:
+            logger.debug(f"{destination_repository}:{tag} - destination wasn't built from the current build context")
+            return False
     return True
 
 
@@ -71,34 +166,94 @@ def docker_build(
     build_folder: Path,
     docker_client: Any,
     dockerfile: Path,
-    destination_endpoints: List[LiteralString],
+    destination_repository: LiteralString,
     tags: List[LiteralString],
-    build_args: Dict[str, str | int | float],
-) -> Any:
-    try:
-        for endpoint in destination_endpoints:
-            repository, tag = endpoint.split(":")
+    build_args: Dict[str, str],
+    registry_pool: RegistryPool,
+) -> BuildResult:
+    """builds an image once, tags the result with every tag and pushes the tags concurrently. The daemon uploads layers
+    shared by the tags once per repository, so the extra pushes only write manifests.
+    The hash of the build inputs is stamped on the image as a label, and nothing is built when every tag at the
+    destination already carries the current hash
+
+    Args:
+        arguments (Any): CLI arguments
+        build_folder (Path): build context
+        dockerfile (Path): Dockerfile to build, inside or outside of the build context
+        destination_repository (LiteralString): repository to tag and push to
+        tags (List[LiteralString]): tags to apply to the built image
+        build_args (Dict[str, str]): `--build-arg` values
+        registry_pool (RegistryPool): shared registry clients and per-registry limits
+
+    Returns:
+        BuildResult: outcome and timings of the build and pushes
+    """
+    result = BuildResult(destination_repository, list(tags), str(build_folder))
+    endpoints = [f"{destination_repository}:{tag}" for tag in tags]
+    started = time.monotonic()
+    with span("hash", str(build_folder)):
+        result.context_hash = hash_build_context(build_folder, dockerfile, build_args)
+    result.hash_seconds = time.monotonic() - started
+    if not arguments.force_pull_push and destination_is_current(logger, registry_pool, destination_repository, tags, result.context_hash):
+        result.skipped = True
+        return result
+
+    started = time.monotonic()
+    with span("build", endpoints[0]) as traced:
+        try:
+            # docker-py sends a Dockerfile outside of the context along with it when given an absolute path
+            image, _ = docker_client.images.build(
+                path=str(build_folder),
+                dockerfile=str(dockerfile.resolve()),
+                buildargs=build_args,
+                labels={CONTEXT_HASH_LABEL: result.context_hash},
+                tag=endpoints[0],
+            )
+            for tag in tags[1:]:
+                image.tag(repository=destination_repository, tag=tag)
+            result.built = True
+            traced.bytes = int(image.attrs.get("Size", 0))
+            logger.success(f"build succeeded: {', '.join(endpoints)} ({image.id})")
+        except (docker.errors.APIError, docker.errors.BuildError, TypeError) as e:
+            logger.error(f"{endpoints[0]} - build failed: {e}")
+            traced.outcome = f"error: {type(e).__name__}"
+            return result
+        finally:
+            result.build_seconds = time.monotonic() - started
+
+    started = time.monotonic()
+    push_workers = min(len(tags), arguments.push_workers or arguments.max_workers)
+    budget = registry_pool.retry_budget()
 
-            build = docker_client.images.build(path=str(build_folder), tag=endpoint)
-            logger.success(f"build succeeded: {endpoint}")
+    def push(tag: LiteralString) -> bool:
+        try:
+            return push_image(logger, docker_client, destination_repository, tag, registry_pool.limiter, budget)
+        except Exception as e:  # e.g. a lost connection to the daemon, the other tags are still pushed
+            logger.error(f"{destination_repository}:{tag} - failed to push image: {e}")
+            result.errors[tag] = str(e)
+            return False
 
-            push_image(logger, docker_client, repository, tag)
-            logger.success(f"push (from build) succeeded: {endpoint}")
+    with ThreadPoolExecutor(max_workers=push_workers) as thread_pool:
+        pushed = list(thread_pool.map(push, tags))
+    result.pushed = [tag for tag, success in zip(tags, pushed) if success]
+    result.push_seconds = time.monotonic() - started
+    return result
 
-    except docker.errors.APIError as e:
-        return f"{e}"
-    except docker.errors.BuildError as e:
-        return f"{e}"
-    except TypeError as e:
-        return f"{e}"
 
-    return "WOO"
+def parse_image_list_build(logger: Any, image: Dict[LiteralString, Any]) -> Optional[str]:
+    """validates a build entry from the input file
 
+    Args:
+        image (Dict[LiteralString, Any]): single element of images from the input file
 
-def parse_image_list_build(logger: Any, image: Dict[LiteralString, Any]) -> None:
+    Returns:
+        Optional[str]: what's wrong with the entry, or None if it's valid
+    """
     try:
         isinstance(image["build"], dict)
-        # TODO more here
-    except KeyError as e:
-        logger.critical(f"syntax error in list file provided: {e}")
-        exit(1)
+        isinstance(image["build"]["build_folder"], str)
+        isinstance(image["build"]["tags"], list)
+        isinstance(image["destination"]["repository"], str)
+    except (KeyError, TypeError) as e:
+        return f"syntax error in list file provided: missing {e}"
+    return None
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from docker.utils.build import exclude_paths
+
+CONTEXT_HASH_LABEL = "io.github.daemondude23.container-image-replicator.context-hash"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def read_dockerignore(build_folder: Path) -> List[str]:
+    """reads the .dockerignore patterns of a build context, the same way docker-py does when sending the context
+
+    Args:
+        build_folder (Path): build context
+
+    Returns:
+        List[str]: patterns, empty if there's no .dockerignore
+    """
+    dockerignore = build_folder / ".dockerignore"
+    if not dockerignore.is_file():
+        return list()
+    with open(dockerignore, encoding="utf-8") as ignore_file:
+        return [line.strip() for line in ignore_file.read().splitlines() if line.strip() != "" and not line.strip().startswith("#")]
+
+
+def hash_file(path: Path) -> str:
+    """hashes one file of the build context in chunks, so large files aren't read into memory. Errors reading it are
+    raised, failing the build entry
+
+    Args:
+        path (Path): file to hash
+
+    Returns:
+        str: hex sha256 of the file and its executable bit. Symlinks are hashed by their target path, which is what docker
+            sends, and other files that aren't regular files, such as sockets or FIFOs, by their type without reading them
+    """
+    mode = os.lstat(path).st_mode
+    if stat.S_ISLNK(mode):
+        return hashlib.sha256(f"symlink:{os.readlink(path)}".encode("utf-8")).hexdigest()
+    if not stat.S_ISREG(mode):
+        # reading a FIFO would block forever, and docker doesn't send the contents of special files either
+        return hashlib.sha256(f"special:{stat.S_IFMT(mode):o}".encode("utf-8")).hexdigest()
+    digest = hashlib.sha256(b"x" if os.access(path, os.X_OK) else b"-")
+    with open(path, "rb") as context_file:
+        while chunk := context_file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_build_context(build_folder: Path, dockerfile: Path, build_args: Dict[str, str], hash_workers: Optional[int] = None) -> str:
+    """computes a deterministic hash of everything that goes into a build: the files docker would send as the context
+    (honoring .dockerignore), the Dockerfile and the build args. Files are hashed in parallel
+
+    Args:
+        build_folder (Path): build context
+        dockerfile (Path): Dockerfile, inside or outside of the build context
+        build_args (Dict[str, str]): `--build-arg` values
+        hash_workers (Optional[int]): number of files hashed at once, the ThreadPoolExecutor default if None
+
+    Returns:
+        str: sha256:<hex> hash of the build inputs
+    """
+    root = build_folder.resolve()
+    dockerfile = dockerfile.resolve()
+    relative_dockerfile = str(dockerfile.relative_to(root)) if dockerfile.is_relative_to(root) else None
+    # a symlink to a directory is sent as a symlink, so only real directories are left out
+    files = sorted(
+        path
+        for path in exclude_paths(str(root), read_dockerignore(root), dockerfile=relative_dockerfile)
+        if (root / path).is_symlink() or not (root / path).is_dir()
+    )
+    # hashlib releases the GIL while hashing, so threads hash files in parallel
+    with ThreadPoolExecutor(max_workers=hash_workers) as thread_pool:
+        file_hashes = list(thread_pool.map(lambda path: hash_file(root / path), files))
+
+    context_hash = hashlib.sha256()
+    for path, file_hash in zip(files, file_hashes):
+        context_hash.update(f"{path}\0{file_hash}\n".encode("utf-8"))
+    context_hash.update(f"dockerfile\0{hash_file(dockerfile)}\n".encode("utf-8"))
+    context_hash.update(f"build_args\0{json.dumps(build_args, sort_keys=True)}\n".encode("utf-8"))
+    return f"sha256:{context_hash.hexdigest()}"
@@ -0,0 +1,203 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+
+from entries import ReplicationEntry
+from plan import SourceJob
+from registry import filter_index
+from registry import RegistryClient
+from registry import RegistryError
+from registry import RegistryPool
+from retry import call_with_retries
+from retry import RETRY_STATUS_CODES
+from retry import RetryBudget
+from tracing import span
+
+DESTINATION_EXISTS = "exists"
+DESTINATION_MISSING = "does not exist"
+DESTINATION_DIFFERS = "differs"
+DESTINATION_UNKNOWN = "unknown"
+
+
+def head_manifest(budget: Optional[RetryBudget], client: RegistryClient, repository: str, reference: str) -> Tuple[Optional[str], int]:
+    """RegistryClient.head_manifest, retrying transient statuses while the budget lasts
+
+    Args:
+        budget (Optional[RetryBudget]): retries left for the image
+        client (RegistryClient): registry to ask
+        repository (str): repository path
+        reference (str): tag or digest
+
+    Returns:
+        Tuple[Optional[str], int]: manifest digest (None if missing) and the status code
+
+    Raises:
+        RegistryError: if the registry kept answering with a transient status
+    """
+
+    def head() -> Tuple[Optional[str], int]:
+        digest, status_code = client.head_manifest(repository, reference)
+        if status_code in RETRY_STATUS_CODES:
+            raise RegistryError(f"{client.host}/{repository}:{reference} - unexpected status {status_code} resolving manifest", status_code)
+        return digest, status_code
+
+    return call_with_retries(budget, f"{client.host}/{repository}:{reference}", head)
+
+
+def check_destination(
+    logger: Any,
+    registry_pool: RegistryPool,
+    entry: ReplicationEntry,
+    compare_source: bool,
+    heads_only: bool = False,
+    budget: Optional[RetryBudget] = None,
+) -> Tuple[str, Optional[str]]:
+    """resolves the destination manifest of one entry with a HEAD request
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients
+        entry (ReplicationEntry): entry to check
+        compare_source (bool): also resolve the source digest and report a mismatch as DESTINATION_DIFFERS
+        heads_only (bool): don't download the source index of a platform-filtered entry to compare it, reporting the
+            destination as DESTINATION_UNKNOWN instead
+        budget (Optional[RetryBudget]): retries left for the image, None to not retry transient failures
+
+    Returns:
+        Tuple[str, Optional[str]]: one of the DESTINATION_* statuses and the destination digest, if it resolved
+    """
+    try:
+        destination, destination_path = registry_pool.resolve_destination(entry.destination_repository)
+        destination_digest, status_code = head_manifest(budget, destination, destination_path, entry.destination_tag)
+        if destination_digest is None and status_code == 404:
+            return DESTINATION_MISSING, None
+        if status_code != 200:
+            logger.debug(f"{entry.destination_endpoint} - unexpected status {status_code} checking destination")
+            return DESTINATION_UNKNOWN, None
+        if not compare_source:
+            return DESTINATION_EXISTS, destination_digest
+
+        source_digest: Optional[str] = f"sha256:{entry.final_sha256}" if entry.final_sha256 != "" else None
+        if entry.platforms and heads_only:
+            return DESTINATION_UNKNOWN, destination_digest
+        if entry.platforms:
+            # a filtered index is rewritten, so its digest can only be known by filtering the source index the same way
+            source, source_path = registry_pool.resolve_source(entry.source_repository)
+            raw, media_type, _ = call_with_retries(
+                budget, entry.source_endpoint, source.get_manifest, source_path, source_digest or entry.source_tag
+            )
+            _, source_digest = filter_index(raw, media_type, entry.platforms)
+        elif source_digest is None:
+            source, source_path = registry_pool.resolve_source(entry.source_repository)
+            source_digest, status_code = head_manifest(budget, source, source_path, entry.source_tag)
+            if source_digest is None:
+                # the destination is there, so let the copy surface whatever is wrong with the source
+                logger.debug(f"{entry.source_endpoint} - unable to resolve source digest, status {status_code}")
+                return DESTINATION_UNKNOWN, destination_digest
+        return (DESTINATION_EXISTS if source_digest == destination_digest else DESTINATION_DIFFERS), destination_digest
+    except (RegistryError, requests.RequestException) as e:
+        logger.debug(f"{entry.destination_endpoint} - failed to check destination: {e}")
+        return DESTINATION_UNKNOWN, None
+
+
+def traced_check_destination(
+    logger: Any, registry_pool: RegistryPool, entry: ReplicationEntry, compare_source: bool, heads_only: bool = False
+) -> Tuple[str, Optional[str]]:
+    """check_destination with a retry budget of its own, recorded as a check span when tracing"""
+    with span("check", entry.destination_endpoint) as traced:
+        status = check_destination(logger, registry_pool, entry, compare_source, heads_only, registry_pool.retry_budget())
+        traced.outcome = status[0]
+        return status
+
+
+def check_destinations(
+    logger: Any, arguments: Any, registry_pool: RegistryPool, entries: List[ReplicationEntry], heads_only: bool = False
+) -> List[Tuple[str, Optional[str]]]:
+    """resolves every destination up front so only missing or outdated entries get scheduled
+
+    Args:
+        arguments (Any): CLI arguments
+        registry_pool (RegistryPool): shared registry clients
+        entries (List[ReplicationEntry]): entries to check
+        heads_only (bool): only send manifest HEAD requests, see check_destination
+
+    Returns:
+        List[Tuple[str, Optional[str]]]: DESTINATION_* status and destination digest for each entry, in the same order.
+            Forced entries aren't checked and are DESTINATION_UNKNOWN
+    """
+    compare_source = arguments.engine == "registry"
+    started = time.monotonic()
+    statuses: List[Tuple[str, Optional[str]]] = [(DESTINATION_UNKNOWN, None)] * len(entries)
+    with ThreadPoolExecutor(max_workers=arguments.check_workers) as thread_pool:
+        futures = {
+            index: thread_pool.submit(traced_check_destination, logger, registry_pool, entry, compare_source, heads_only)
+            for index, entry in enumerate(entries)
+            if not (arguments.force_pull_push or entry.forced)
+        }
+        for index, future in futures.items():
+            statuses[index] = future.result()
+
+    counts = {
+        status: [result[0] for result in statuses].count(status)
+        for status in [DESTINATION_EXISTS, DESTINATION_MISSING, DESTINATION_DIFFERS]
+    }
+    logger.info(
+        f"checked {len(futures)} destinations in {time.monotonic() - started:.2f}s: "
+        f"{counts[DESTINATION_EXISTS]} up to date, {counts[DESTINATION_MISSING]} missing, {counts[DESTINATION_DIFFERS]} outdated, "
+        f"{len(futures) - sum(counts.values())} unknown"
+    )
+    return statuses
+
+
+def measure_source(logger: Any, registry_pool: RegistryPool, job: SourceJob, single_platform: bool) -> int:
+    """reads the size of a job's source from its manifests
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients
+        job (SourceJob): job to measure
+        single_platform (bool): only count one platform of a multi-arch source, like the daemon engine pulls
+
+    Returns:
+        int: size in bytes, 0 if it couldn't be read
+    """
+    source = job.source
+    client, source_path = registry_pool.resolve_source(source.source_repository)
+    reference = f"sha256:{source.final_sha256}" if source.final_sha256 != "" else source.source_tag
+    with span("measure", source.source_endpoint) as traced:
+        try:
+            size: int = client.get_image_size(source_path, reference, source.platforms, single_platform)
+            traced.bytes = size
+            return size
+        except (RegistryError, requests.RequestException, KeyError, ValueError) as e:
+            logger.debug(f"{source.source_endpoint} - unable to read source size: {e}")
+            traced.outcome = f"error: {type(e).__name__}"
+            return 0
+
+
+def measure_sources(logger: Any, arguments: Any, registry_pool: RegistryPool, jobs: List[SourceJob]) -> Dict[str, int]:
+    """reads the size of every job's source with pooled manifest requests, so the largest can be started first
+
+    Args:
+        arguments (Any): CLI arguments
+        registry_pool (RegistryPool): shared registry clients
+        jobs (List[SourceJob]): jobs to measure
+
+    Returns:
+        Dict[str, int]: size in bytes of each job's source by key, 0 for sources that couldn't be read
+    """
+    started = time.monotonic()
+    single_platform = arguments.engine == "daemon"
+    with ThreadPoolExecutor(max_workers=arguments.check_workers) as thread_pool:
+        futures = {job.key: thread_pool.submit(measure_source, logger, registry_pool, job, single_platform) for job in jobs}
+        sizes = {key: future.result() for key, future in futures.items()}
+    unknown = [key for key, size in sizes.items() if size == 0]
+    logger.info(
+        f"measured {len(jobs)} sources in {time.monotonic() - started:.2f}s"
+        + (f", {len(unknown)} of unknown size are scheduled last" if unknown else "")
+    )
+    return sizes
@@ -1,37 +1,55 @@
 #!/usr/bin/env python3.11
 import argparse
 import logging
+import queue
+import threading
 from pathlib import Path
 from sys import exit
 from sys import stdout
 from typing import Any
 from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 
-import coloredlogs
-import docker
 import verboselogs
-import yaml
 from typing_extensions import LiteralString
 
-from build import construct_build
-from build import parse_image_list_build
-from replicate import parse_image_list_replicate
-from replicate import replicate
+from engines import connect_engines
+from engines import EnginePool
+from entries import build_replication_entry
+from ordering import ORDER_FILE
+from ordering import ORDERS
+from plan import build_plan
+from plan import in_shard
+from plan import parse_shard
+from plan import print_plan
+from results import merge_results
+from results import RESULT_FAILED
+from results import RunResults
+from summary import parse_size
+from tracing import start_tracing
+
+# modules that load docker-py, requests, yaml or coloredlogs are imported where they're first needed, so --help, argument
+# errors and --merge don't wait on them
 
 # mypy: disable-error-code = attr-defined
 verboselogs.install()
 logger = logging.getLogger(__name__)
 
 
-def init_docker() -> Any | Any:
-    """initialize docker connection
+def init_docker(hosts: List[str], contexts: List[str]) -> EnginePool:
+    """initialize docker connections
+
+    Args:
+        hosts (List[str]): --docker-host endpoints
+        contexts (List[str]): --docker-context names
 
     Returns:
-        Any | Any: client and API objects
+        EnginePool: every engine that could be reached
     """
-    docker_client: object = docker.from_env()
-    docker_api: object = docker.APIClient()
-    return docker_client, docker_api
+    return connect_engines(logger, hosts, contexts)
 
 
 def init_arg_parser() -> Any:
@@ -61,6 +79,62 @@ def init_arg_parser() -> Any:
             type=int,
         )
 
+        args_optional.add_argument(
+            "--pull-workers",
+            action="store",
+            default=0,
+            dest="pull_workers",
+            help="number of threads pulling images with --engine daemon. 0 means --max-workers",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--push-workers",
+            action="store",
+            default=0,
+            dest="push_workers",
+            help="number of threads pushing images with --engine daemon. 0 means --max-workers",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--queue-size",
+            action="store",
+            default=0,
+            dest="queue_size",
+            help="maximum number of images waiting between pipeline stages with --engine daemon, which bounds how many\
+                pulled images sit on local disk waiting to be pushed. 0 means --max-workers",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--registry-max-workers",
+            action="store",
+            default=0,
+            dest="registry_max_workers",
+            help="maximum number of images transferring from or to any single registry at once. 0 means --max-workers.\
+                Raise --max-workers above this to keep other registries busy while one is saturated",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--registry-limit",
+            action="append",
+            default=list(),
+            dest="registry_limits",
+            help="per-registry override of --registry-max-workers, e.g. docker.io=2. Can be given multiple times",
+            metavar="HOST=N",
+        )
+
+        args_optional.add_argument(
+            "--check-workers",
+            action="store",
+            default=16,
+            dest="check_workers",
+            help="maximum number of concurrent manifest HEAD requests used to check destinations before replicating",
+            type=int,
+        )
+
         args_optional.add_argument(
             "--log-level",
             action="store",
@@ -78,6 +152,259 @@ def init_arg_parser() -> Any:
                 Useful for mutable tags. Be careful, as this can hit rate limits quickly!",
         )
 
+        args_optional.add_argument(
+            "--engine",
+            action="store",
+            choices=["daemon", "registry"],
+            default="daemon",
+            dest="engine",
+            help="how to replicate images. 'daemon' pulls, re-tags and pushes through the local docker daemon.\
+                'registry' streams manifests and blobs directly between registries without the daemon or local disk",
+        )
+
+        args_optional.add_argument(
+            "--docker-host",
+            action="append",
+            default=list(),
+            dest="docker_hosts",
+            metavar="URL",
+            help="docker engine to replicate through with --engine daemon, e.g. ssh://user@builder. Can be given multiple\
+                times to spread images over several engines, each image always going to the same one. Defaults to\
+                DOCKER_HOST, which may also list several engines separated by commas",
+        )
+
+        args_optional.add_argument(
+            "--docker-context",
+            action="append",
+            default=list(),
+            dest="docker_contexts",
+            metavar="NAME",
+            help="docker context whose engine to replicate through, like --docker-host. Can be given multiple times",
+        )
+
+        args_optional.add_argument(
+            "--insecure-registry",
+            action="append",
+            default=list(),
+            dest="insecure_registries",
+            metavar="HOST",
+            help="registry host to talk to over plain HTTP with --engine registry. Can be given multiple times.\
+                localhost and 127.0.0.0/8 are always treated as insecure",
+        )
+
+        args_optional.add_argument(
+            "--blob-chunk-size",
+            action="store",
+            default=16,
+            dest="blob_chunk_size",
+            help="size in MiB of each chunk when uploading blobs with --engine registry",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--platform-workers",
+            action="store",
+            default=4,
+            dest="platform_workers",
+            help="maximum number of platforms of one multi-arch image copied concurrently with --engine registry",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--export-dir",
+            action="store",
+            default=None,
+            dest="export_dir",
+            help="instead of pushing to the destinations, write every image to this OCI image-layout directory for carrying "
+            "into an air-gapped network. Blobs shared by several images are stored once, and images already in it are skipped",
+            metavar="DIR",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--import-dir",
+            action="store",
+            default=None,
+            dest="import_dir",
+            help="push every image of an OCI image-layout directory written by --export-dir to the registry in its name, "
+            "instead of reading input files. Blobs the destinations already have aren't uploaded",
+            metavar="DIR",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--retries",
+            action="store",
+            default=5,
+            dest="retries",
+            help="transient failures (connection resets, timeouts, 5xx and 429 responses) retried per image across all of its "
+            "requests before it's given up on. Interrupted uploads and downloads resume where they stopped",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--retry-backoff",
+            action="store",
+            default=1.0,
+            dest="retry_backoff",
+            help="base in seconds of the exponential backoff between retries, which is fully jittered and capped at 60s",
+            type=float,
+        )
+
+        args_optional.add_argument(
+            "--state-file",
+            action="store",
+            default=None,
+            dest="state_file",
+            help="path to a JSON-lines file recording when each entry was last confirmed at its destination.\
+                Entries confirmed within their TTL are skipped without any network or daemon calls, so an unpinned tag that\
+                moved may stay stale for up to the TTL. Pinned sources, and sources polled by --watch, are also compared by digest",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--state-ttl",
+            action="store",
+            default=86400,
+            dest="state_ttl",
+            help="seconds a confirmation in --state-file stays valid",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--state-ttl-mutable",
+            action="store",
+            default=900,
+            dest="state_ttl_mutable",
+            help="seconds a confirmation in --state-file stays valid for entries with forcePull (mutable tags)",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--local-cache-budget",
+            action="store",
+            default=None,
+            dest="local_cache_budget",
+            help="with --engine daemon, remove images this run pulled once they're pushed everywhere, least recently used first, "
+            "whenever they take up more than this much disk (e.g. 20GiB). Images that were already present are never removed",
+            type=parse_size,
+        )
+
+        args_optional.add_argument(
+            "--batch-size",
+            action="store",
+            default=200,
+            dest="batch_size",
+            help="with --order file, number of entries read before their destinations are checked together and they're "
+            "scheduled. Smaller batches start replicating sooner. A source that turns up again after its batch was scheduled is "
+            "replicated to its later destinations at the end",
+            type=int,
+        )
+
+        args_optional.add_argument(
+            "--order",
+            action="store",
+            choices=ORDERS,
+            default=ORDER_FILE,
+            dest="order",
+            help="order to start replications in. 'size' reads the size of each source from its manifests while checking "
+            "destinations and starts the largest first, so a big image doesn't run alone at the end. 'priority' starts entries "
+            "with a higher priority field first, largest first among equal priorities. Both read the whole input before the first "
+            "replication starts, so --batch-size doesn't apply",
+        )
+
+        args_optional.add_argument(
+            "--shard",
+            action="store",
+            default=None,
+            dest="shard",
+            help="only handle the entries of shard INDEX of COUNT (e.g. 2/4), assigned by a hash of the source image so every "
+            "node agrees on the split without coordinating",
+            metavar="INDEX/COUNT",
+            type=parse_shard,
+        )
+
+        args_optional.add_argument(
+            "--result-file",
+            action="store",
+            default=None,
+            dest="result_file",
+            help="write the outcome of every entry as JSON to this file. Defaults to results-INDEX-of-COUNT.json with --shard",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--merge",
+            action="store",
+            default=None,
+            dest="merge",
+            help="combine the result files of a sharded run into one report, written to --result-file if given, and exit "
+            "non-zero if any entry failed or a shard is missing",
+            metavar="RESULT_FILE",
+            nargs="+",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--trace",
+            action="store",
+            default=None,
+            dest="trace",
+            help="record how long each phase (check, pull, tag, push, copy, build...) took for each image, and write it to "
+            "this file in Chrome trace-event format and next to it as a JSON summary with p50/p95 per phase",
+            metavar="FILE",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--metrics-textfile",
+            action="store",
+            default=None,
+            dest="metrics_textfile",
+            help="write transfer throughput per registry, image and layer to this Prometheus node-exporter textfile (e.g. "
+            "/var/lib/node_exporter/textfile/cir.prom) every --metrics-interval seconds and at exit",
+            metavar="FILE",
+            type=Path,
+        )
+
+        args_optional.add_argument(
+            "--metrics-interval",
+            action="store",
+            default=15,
+            dest="metrics_interval",
+            help="seconds between writes of --metrics-textfile",
+            type=float,
+        )
+
+        args_optional.add_argument(
+            "--watch",
+            action="store",
+            default=None,
+            dest="watch",
+            help="keep running and replicate again every INTERVAL seconds, keeping the docker client, registry connections and "
+            "tokens open. Input files are only read again when they change, and only entries whose source digest changed are "
+            "replicated. Source polls are spread over the interval",
+            metavar="INTERVAL",
+            type=float,
+        )
+
+        args_optional.add_argument(
+            "--plan",
+            action="store_true",
+            default=False,
+            dest="plan",
+            help="print the replication work deduplicated by source image, then exit without replicating or building anything",
+        )
+
+        args_optional.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            dest="dry_run",
+            help="validate the input files and print which images would be pulled, pushed or skipped, resolved with manifest\
+                HEAD requests only, then exit. Doesn't need the docker daemon",
+        )
+
         args_optional.add_argument(
             "--no-color",
             "--no-colors",
@@ -87,53 +414,70 @@ def init_arg_parser() -> Any:
             help="disable color output from the logger",
         )
 
-        args_required.add_argument("input_file", action="store", help="path to YAML file containing registry information", type=Path)
+        args_required.add_argument(
+            "input_files",
+            action="store",
+            help="YAML files containing registry information, globs of them, JSON-lines files (.jsonl, .ndjson) with one entry "
+            "per line, or - to read either from stdin",
+            metavar="input_file",
+            nargs="*",
+        )
 
         arguments = parser.parse_args()
+        if arguments.import_dir is not None and (arguments.input_files or arguments.export_dir is not None):
+            parser.error("--import-dir replaces the input files and can't be combined with them or --export-dir")
+        if not arguments.input_files and arguments.merge is None and arguments.import_dir is None:
+            parser.error("the following arguments are required: input_file")
+        if arguments.watch is not None and (
+            arguments.export_dir is not None or arguments.import_dir is not None or arguments.trace is not None
+        ):
+            parser.error("--watch can't be combined with --export-dir, --import-dir or --trace")
+        if arguments.export_dir is not None or arguments.import_dir is not None:
+            # the daemon can't read or write a layout, so layouts are always copied over the distribution API
+            arguments.engine = "registry"
+        if arguments.shard is not None and arguments.result_file is None:
+            arguments.result_file = Path(f"results-{arguments.shard[0]}-of-{arguments.shard[1]}.json")
         return arguments
     except argparse.ArgumentError:
         logging.fatal("failed to parse arguments")
         exit(1)
 
 
-def parse_image_list_yaml(image_list: Dict[LiteralString, Any]) -> tuple[list[Any], list[Any]]:
-    """searches for each element in the list for all expected keys/values
+def parse_image_list(images: Iterator[Tuple[str, Any]], errors: Any) -> Iterator[Tuple[str, Dict[LiteralString, Any]]]:
+    """validates entries as they're read and tells builds from replications, collecting invalid entries instead of
+    stopping at the first one
 
     Args:
-        image_list (Dict[LiteralString, Any]): list of images from input YAML
+        images (Iterator[Tuple[str, Any]]): location and content of each entry from the input files
+        errors (InputErrors): collects invalid entries
 
-    Returns:
-        bool: True if the whole file parsed as expected
+    Yields:
+        Tuple[str, Dict[LiteralString, Any]]: "build" or "replicate", and the entry
     """
-    build_list = list()
-    replicate_list = list()
-    try:
-        for image in image_list["images"]:
-            try:
-                if isinstance(image["build"], dict):
-                    parse_image_list_build(logger, image)
-                    build_list.append(image)
-            except KeyError:
-                pass
-            try:
-                if isinstance(image["source"], dict):
-                    parse_image_list_replicate(logger, image)
-                    replicate_list.append(image)
-            except KeyError:
-                pass
-    except KeyError as e:
-        logger.critical(f"syntax error in list file provided:\n{e}")
-        exit(1)
-    logger.success("input file successfully validated")
-    return build_list, replicate_list
+    from build import parse_image_list_build
+    from replicate import parse_image_list_replicate
 
+    for location, image in images:
+        if not isinstance(image, dict) or not ("build" in image or "source" in image):
+            errors.add(location, "entry has neither a build nor a source")
+            continue
+        if isinstance(image.get("build"), dict):
+            error = parse_image_list_build(logger, image)
+            if error is None:
+                yield "build", image
+            else:
+                errors.add(location, error)
+        if isinstance(image.get("source"), dict):
+            error = parse_image_list_replicate(logger, image)
+            if error is None:
+                yield "replicate", image
+            else:
+                errors.add(location, error)
 
-def main(docker_api: object) -> None:
-    """main
 
-    Args:
-        docker_api (object): api object
-    """
+def main() -> None:
+    """main"""
+    global engines
     arguments = init_arg_parser()
 
     if arguments.log_level == "INFO":
@@ -153,37 +497,135 @@ def main(docker_api: object) -> None:
             format="%(asctime)s %(levelname)s %(message)s",
         )
     else:
+        import coloredlogs
+
         coloredlogs.install(level=log_level, fmt="%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%S%z")
 
+    if arguments.merge is not None:
+        exit(merge_results(logger, arguments.merge, arguments.result_file))
+
+    from inputs import InputErrors
+    from inputs import iter_input_images
+
+    # the daemon is only connected to once something needs it, so --plan, --dry-run and --engine registry work without one
+    engines = init_docker(arguments.docker_hosts, arguments.docker_contexts)
+    tracer = start_tracing() if arguments.trace is not None else None
+    errors = InputErrors()
+    if arguments.import_dir is not None:
+        from layout import iter_layout_images
+
+        images = parse_image_list(iter_layout_images(arguments.import_dir, errors), errors)
+    else:
+        images = parse_image_list(iter_input_images(logger, arguments.input_files, errors), errors)
+
+    if arguments.plan:
+        entries = [build_replication_entry(logger, image) for kind, image in images if kind == "replicate"]
+        print_plan(logger, build_plan([entry for entry in entries if entry is not None]))
+        errors.log(logger)
+        if errors:
+            exit(1)
+        return
+
+    if arguments.dry_run:
+        from dryrun import dry_run
+
+        resolved = dry_run(logger, arguments, images)
+        errors.log(logger)
+        if errors or not resolved:
+            exit(1)
+        return
+
+    from build import construct_build
+    from replicate import replicate
+    from throughput import current_meter
+    from throughput import MetricsTextfile
+    from watch import watch
+
+    if arguments.engine == "daemon":
+        # fail before anything is read or checked if the daemon can't be reached
+        engines.connect()
+    metrics = (
+        MetricsTextfile(logger, current_meter(), arguments.metrics_textfile, arguments.metrics_interval)
+        if arguments.metrics_textfile
+        else None
+    )
+    if metrics is not None:
+        metrics.start()
+    if arguments.watch is not None:
+        try:
+            watch(
+                logger,
+                arguments,
+                engines,
+                lambda watch_errors: parse_image_list(iter_input_images(logger, arguments.input_files, watch_errors), watch_errors),
+            )
+        finally:
+            if metrics is not None:
+                metrics.close()
+        return
+
+    # entries are handed over while the input is still being read: builds to their own thread, replications to the scheduler
+    results = RunResults(arguments.shard)
+    counts = {"build": 0, "replicate": 0}
+    build_queue: queue.Queue[Any] = queue.Queue()
+    build_thread: Optional[threading.Thread] = None
+
+    def replications() -> Iterator[Dict[LiteralString, Any]]:
+        nonlocal build_thread
+        for kind, image in images:
+            counts[kind] += 1
+            if kind == "replicate":
+                yield image
+                continue
+            if build_thread is None:
+                # builds always go through the daemon, so with --engine registry it's connected to at the first one
+                build_thread = threading.Thread(
+                    target=construct_build,
+                    args=(logger, arguments, engines.primary.client, iter(build_queue.get, None), results),
+                    name="build",
+                )
+                build_thread.start()
+            build_queue.put(image)
+
     try:
-        image_list = yaml.safe_load(Path(arguments.input_file).read_text())
-        build_list, replicate_list = parse_image_list_yaml(image_list)
-
-        # store the lengths of the two main as we will do multiple int comparisons
-        build_list_length = len(build_list)
-        replicate_list_length = len(replicate_list)
-
-        # is there anything to do?
-        if (build_list_length > 0) or (replicate_list_length > 0):
-            if build_list_length > 0:
-                construct_build(logger, arguments, docker_client, build_list)
-            if replicate_list_length > 0:
-                replicate(logger, arguments, docker_api, docker_client, replicate_list)
-        else:
-            logger.warning("no actions found that need taking... strange")
-    except FileNotFoundError:
-        logger.critical(f"input file not found. Cannot continue: {Path(arguments.input_file)}")
-    except yaml.parser.ParserError as e:
-        logger.critical(f"failed to parse input file: {Path(arguments.input_file)} with error: {e}")
+        replicate(logger, arguments, engines, replications(), results)
+    finally:
+        build_queue.put(None)
+        if build_thread is not None:
+            build_thread.join()
+        if metrics is not None:
+            metrics.close()
+    current_meter().log(logger)
+
+    for location, message in errors.errors:
+        if in_shard(location, arguments.shard):
+            results.record(location, "", RESULT_FAILED, message)
+    if counts["build"] == 0 and counts["replicate"] == 0 and not errors:
+        logger.warning("no actions found that need taking... strange")
+    if arguments.result_file is not None:
+        results.write(arguments.result_file)
+        logger.info(f"wrote the outcome of {len(results.results)} entries to {arguments.result_file}")
+    if tracer is not None:
+        summary_path = tracer.write(arguments.trace)
+        logger.info(f"wrote {len(tracer.spans)} trace spans to {arguments.trace} and {summary_path}")
+    errors.log(logger)
+    if errors:
+        exit(1)
 
 
 if __name__ == "__main__":
+    engines: Optional[EnginePool] = None
     try:
-        docker_client, docker_api = init_docker()
-        main(docker_api)
-        docker_client.close()
-    except docker.errors.DockerException:
+        main()
+        if engines is not None:
+            engines.close()
+    except Exception as e:
+        import docker  # already loaded if the error came from it
+
+        if not isinstance(e, docker.errors.DockerException):
+            raise
         print("Error: Unable to communicate with docker daemon")
     except KeyboardInterrupt:
-        docker_client.close()
+        if engines is not None:
+            engines.close()
         exit(1)
@@ -0,0 +1,135 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Tuple
+
+import requests
+from typing_extensions import LiteralString
+
+from check import check_destinations
+from check import DESTINATION_DIFFERS
+from check import DESTINATION_EXISTS
+from check import DESTINATION_MISSING
+from entries import build_replication_entry
+from entries import ReplicationEntry
+from plan import build_plan
+from plan import in_shard
+from plan import source_key
+from registry import RegistryError
+from registry import RegistryPool
+from replicate import open_registry_pool
+
+DRY_RUN_PULL = "pull"
+DRY_RUN_PUSH = "push"
+DRY_RUN_SKIP = "skip"
+DRY_RUN_BUILD = "build"
+DRY_RUN_ERROR = "error"
+
+DESTINATION_REASONS = {DESTINATION_EXISTS: "up to date", DESTINATION_MISSING: "does not exist", DESTINATION_DIFFERS: "outdated"}
+
+
+def resolve_source(registry_pool: RegistryPool, entry: ReplicationEntry) -> Tuple[bool, str]:
+    """checks that a source exists with a manifest HEAD request
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients
+        entry (ReplicationEntry): entry whose source to resolve
+
+    Returns:
+        Tuple[bool, str]: whether it exists, and its digest or what went wrong
+    """
+    reference = f"sha256:{entry.final_sha256}" if entry.final_sha256 != "" else entry.source_tag
+    try:
+        client, path = registry_pool.resolve_source(entry.source_repository)
+        digest, status_code = client.head_manifest(path, reference)
+    except (RegistryError, requests.RequestException) as e:
+        return False, str(e)
+    if status_code == 404:
+        return False, "source not found"
+    if status_code != 200:
+        return False, f"unexpected status {status_code} resolving source"
+    return True, digest or reference
+
+
+def print_action(action: str, subject: str, reason: str = "", indent: int = 0) -> None:
+    print(f"{' ' * indent}{action:<6}{subject}" + (f" ({reason})" if reason else ""))
+
+
+def dry_run(logger: Any, arguments: Any, images: Iterable[Tuple[str, Dict[LiteralString, Any]]]) -> bool:
+    """prints what a run would pull, push and skip, without the docker daemon and with manifest HEAD requests only. Every
+    destination is checked like a run would, and the source of every image that needs pushing is checked to exist. The
+    state file isn't consulted, so entries it would skip are shown as the registries have them
+
+    Args:
+        arguments (Any): CLI arguments
+        images (Iterable[Tuple[str, Dict[LiteralString, Any]]]): validated entries from the input files, as parse_image_list yields them
+
+    Returns:
+        bool: whether every entry was valid and every source that's needed exists
+    """
+    started = time.monotonic()
+    counts = {DRY_RUN_PULL: 0, DRY_RUN_PUSH: 0, DRY_RUN_SKIP: 0, DRY_RUN_BUILD: 0, DRY_RUN_ERROR: 0}
+    entries: List[ReplicationEntry] = list()
+    for kind, image in images:
+        if kind == "build":
+            # whether a build is skipped depends on a label of the destination image, which takes more than a HEAD
+            for tag in image["build"]["tags"]:
+                print_action(DRY_RUN_BUILD, f"{image['destination']['repository']}:{tag}", "not checked")
+                counts[DRY_RUN_BUILD] += 1
+            continue
+        entry = build_replication_entry(logger, image)
+        if entry is None:
+            print_action(DRY_RUN_ERROR, f"{image['source']['repository']}:{image['source']['tag']}", "invalid entry")
+            counts[DRY_RUN_ERROR] += 1
+            continue
+        if not in_shard(source_key(entry), arguments.shard):
+            continue
+        if arguments.engine == "daemon" and len(entry.platforms) > 1:
+            print_action(DRY_RUN_ERROR, entry.destination_endpoint, "multiple platforms require --engine registry")
+            counts[DRY_RUN_ERROR] += 1
+            continue
+        entries.append(entry)
+
+    registry_pool = open_registry_pool(logger, arguments, writable=False)
+    try:
+        statuses = check_destinations(logger, arguments, registry_pool, entries, heads_only=True)
+        reasons = {
+            id(entry): "forced" if arguments.force_pull_push or entry.forced else DESTINATION_REASONS.get(status, "unknown")
+            for entry, (status, _) in zip(entries, statuses)
+        }
+        plan = build_plan(entries)
+        pending = [job for job in plan if any(reasons[id(entry)] != "up to date" for entry in job.entries)]
+        with ThreadPoolExecutor(max_workers=arguments.check_workers) as thread_pool:
+            sources = dict(
+                zip([job.key for job in pending], thread_pool.map(lambda job: resolve_source(registry_pool, job.source), pending))
+            )
+    finally:
+        registry_pool.close()
+
+    for job in plan:
+        if job.key not in sources:
+            print_action(DRY_RUN_SKIP, job.key)
+        elif sources[job.key][0]:
+            print_action(DRY_RUN_PULL, job.key, sources[job.key][1])
+            counts[DRY_RUN_PULL] += 1
+        else:
+            print_action(DRY_RUN_ERROR, job.key, sources[job.key][1])
+        for entry in job.entries:
+            reason = reasons[id(entry)]
+            if reason == "up to date":
+                action = DRY_RUN_SKIP
+            elif job.key in sources and sources[job.key][0]:
+                action = DRY_RUN_PUSH
+            else:
+                action = DRY_RUN_ERROR
+            print_action(action, f"-> {entry.destination_endpoint}", reason, indent=2)
+            counts[action] += 1
+    print(
+        f"{counts[DRY_RUN_PULL]} sources to pull, {counts[DRY_RUN_PUSH]} destinations to push, {counts[DRY_RUN_SKIP]} up to date, "
+        f"{counts[DRY_RUN_BUILD]} tags to build, {counts[DRY_RUN_ERROR]} errors"
+    )
+    logger.info(f"dry run resolved {len(entries)} entries in {time.monotonic() - started:.2f}s")
+    return counts[DRY_RUN_ERROR] == 0
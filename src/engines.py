@@ -0,0 +1,215 @@
+import hashlib
+import math
+import os
+import threading
+from collections import deque
+from typing import Any
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from tracing import percentile
+
+ENGINE_EWMA_ALPHA = 0.3  # weight of the latest task in an engine's average task time
+ENGINE_FAILURE_PENALTY = 0.5  # weight multiplier per consecutive failed task
+ENGINE_MIN_WEIGHT = 0.05  # even a slow or failing engine gets the odd task, so it's noticed when it recovers
+ENGINE_DURATIONS_KEPT = 1000  # task times kept per engine for its percentiles, so --watch doesn't grow them forever
+
+
+class DockerEngine:
+    """one docker daemon, with what a run needs of it and how well its tasks went
+
+    Args:
+        name (str): endpoint or context name, for logs
+        client (Any): docker-py client connected to it
+    """
+
+    def __init__(self, name: str, client: Any) -> None:
+        self.name = name
+        self.client = client
+        self.local_images: Any = None  # LocalImageIndex while the daemon engine runs
+        self.cache: Any = None  # LocalImageCache with --local-cache-budget, kept between --watch passes
+        self.tasks = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.seconds = 0.0  # total time of all tasks
+        self.durations: Deque[float] = deque(maxlen=ENGINE_DURATIONS_KEPT)  # times of the latest tasks
+        self.average: Optional[float] = None  # exponentially weighted seconds per task
+        self._lock = threading.Lock()
+
+    def finished(self, seconds: float, succeeded: bool) -> None:
+        """records a finished task
+
+        Args:
+            seconds (float): time from the start of the pull to the end of the last push
+            succeeded (bool): whether every destination of the task succeeded
+        """
+        with self._lock:
+            self.tasks += 1
+            self.seconds += seconds
+            self.durations.append(seconds)
+            self.average = seconds if self.average is None else ENGINE_EWMA_ALPHA * seconds + (1 - ENGINE_EWMA_ALPHA) * self.average
+            if succeeded:
+                self.consecutive_failures = 0
+            else:
+                self.failed += 1
+                self.consecutive_failures += 1
+
+    def weight(self, fastest: Optional[float]) -> float:
+        """how much of the work this engine should get relative to the others, 1 for the fastest healthy engine
+
+        Args:
+            fastest (Optional[float]): lowest average task time of all engines, None if no task finished yet
+
+        Returns:
+            float: weight between ENGINE_MIN_WEIGHT and 1
+        """
+        with self._lock:
+            weight = fastest / self.average if fastest is not None and self.average else 1.0
+            weight *= ENGINE_FAILURE_PENALTY**self.consecutive_failures
+        return max(ENGINE_MIN_WEIGHT, min(weight, 1.0))
+
+    def close(self) -> None:
+        self.client.close()
+
+
+class EnginePool:
+    """spreads daemon engine tasks over several docker daemons. Each source is routed by rendezvous hashing on its key
+    (its digest when pinned), so the same image keeps going to the same daemon and finds its layers there, while engines
+    that are slow or failing lose part of their share to the others
+
+    Args:
+        logger (Any): logger
+        engines (Optional[List[DockerEngine]]): connected engines, the first one also runs builds
+        connect (Optional[Callable[[], List[DockerEngine]]]): connects the engines the first time they're needed instead,
+            so runs that don't use the daemon never talk to it
+    """
+
+    def __init__(
+        self, logger: Any, engines: Optional[List[DockerEngine]] = None, connect: Optional[Callable[[], List[DockerEngine]]] = None
+    ) -> None:
+        self.logger = logger
+        self._engines = engines
+        self._connect = connect
+        self._lock = threading.Lock()
+
+    def connect(self) -> List[DockerEngine]:
+        """connects the engines unless that's done already
+
+        Returns:
+            List[DockerEngine]: connected engines
+        """
+        with self._lock:
+            if self._engines is None:
+                assert self._connect is not None
+                self._engines = self._connect()
+            return self._engines
+
+    @property
+    def engines(self) -> List[DockerEngine]:
+        return self.connect()
+
+    @property
+    def primary(self) -> DockerEngine:
+        return self.engines[0]
+
+    def route(self, key: str) -> DockerEngine:
+        """picks the engine for a source
+
+        Args:
+            key (str): source key, see plan.source_key
+
+        Returns:
+            DockerEngine: engine to pull and push it with
+        """
+        if len(self.engines) == 1:
+            return self.engines[0]
+        averages = [engine.average for engine in self.engines if engine.average is not None]
+        fastest = min(averages) if averages else None
+        best, best_score = self.engines[0], -math.inf
+        for engine in self.engines:
+            digest = hashlib.sha256(f"{engine.name}\n{key}".encode("utf-8")).digest()
+            draw = (int.from_bytes(digest[:8], "big") + 1) / (2**64 + 1)  # uniform in (0, 1)
+            # weighted rendezvous hashing: an engine's share of keys is proportional to its weight
+            score = -engine.weight(fastest) / math.log(draw)
+            if score > best_score:
+                best, best_score = engine, score
+        return best
+
+    def log(self, logger: Any) -> None:
+        """logs the tasks and task times of each engine, with percentiles of its latest ENGINE_DURATIONS_KEPT tasks"""
+        for engine in self._engines or list():
+            if not engine.durations:
+                logger.info(f"engine {engine.name}: 0 tasks")
+                continue
+            durations = sorted(engine.durations)
+            logger.info(
+                f"engine {engine.name}: {engine.tasks} tasks ({engine.failed} failed) in {engine.seconds:.1f}s, "
+                f"p50 {percentile(durations, 0.50):.1f}s, p95 {percentile(durations, 0.95):.1f}s, max {durations[-1]:.1f}s per task"
+            )
+
+    def close(self) -> None:
+        for engine in self._engines or list():
+            engine.close()
+
+
+def connect_engines(logger: Any, hosts: List[str], contexts: List[str]) -> EnginePool:
+    """prepares the docker engines given, without connecting to them until they're first used
+
+    Args:
+        hosts (List[str]): endpoints such as unix:///var/run/docker.sock or ssh://user@host
+        contexts (List[str]): docker context names
+
+    Returns:
+        EnginePool: engines to connect to on first use
+    """
+    return EnginePool(logger, connect=lambda: open_engines(logger, hosts, contexts))
+
+
+def open_engines(logger: Any, hosts: List[str], contexts: List[str]) -> List[DockerEngine]:
+    """connects to every docker engine given. Without any, DOCKER_HOST is used, which may list several endpoints separated
+    by commas, falling back to the default socket. Engines that can't be reached are left out
+
+    Args:
+        hosts (List[str]): endpoints such as unix:///var/run/docker.sock or ssh://user@host
+        contexts (List[str]): docker context names
+
+    Returns:
+        List[DockerEngine]: the engines that could be reached
+
+    Raises:
+        docker.errors.DockerException: if none could be reached
+    """
+    # docker-py takes a while to import, and most of what doesn't talk to the daemon doesn't need it
+    import docker
+    from docker.context import ContextAPI
+    from docker.utils import kwargs_from_env
+
+    environment = kwargs_from_env()
+    if not hosts and not contexts:
+        hosts = [host.strip() for host in os.environ.get("DOCKER_HOST", "").split(",") if host.strip()]
+    endpoints: Dict[str, Dict[str, Any]] = {host: dict(environment, base_url=host) for host in hosts}
+    for name in contexts:
+        context = ContextAPI.get_context(name)
+        if context is None:
+            logger.error(f"docker context {name} - not found, skipping it")
+            continue
+        endpoints[f"context {name}"] = {"base_url": context.Host, "tls": context.TLSConfig or False}
+    if not hosts and not contexts:
+        endpoints["default"] = dict(environment)
+
+    engines = list()
+    error: Optional[docker.errors.DockerException] = None
+    for name, kwargs in endpoints.items():
+        try:
+            engines.append(DockerEngine(name, docker.DockerClient(**kwargs)))
+        except docker.errors.DockerException as e:
+            logger.error(f"engine {name} - unable to connect, leaving it out: {e}")
+            error = e
+    if not engines:
+        raise error or docker.errors.DockerException("no docker engine to connect to")
+    if len(engines) > 1:
+        logger.info(f"spreading images over {len(engines)} docker engines: {', '.join(engine.name for engine in engines)}")
+    return engines
@@ -0,0 +1,168 @@
+import re
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from typing_extensions import LiteralString
+
+DOCKER_HUB_HOST = "registry-1.docker.io"
+
+
+@dataclass
+class ReplicationEntry:
+    """one replication entry from the input file with its optional fields resolved"""
+
+    source_repository: str
+    source_tag: str
+    destination_repository: str
+    destination_tag: str
+    final_sha256: str
+    force_pull: bool
+    force_push: bool
+    source_digest: Optional[str] = None  # filled in once the source manifest has been resolved
+    platforms: List[str] = field(default_factory=list)  # os/architecture[/variant] to keep from a multi-arch source, all if empty
+    priority: int = 0  # higher priorities are scheduled first with --order priority
+
+    @property
+    def source_endpoint(self) -> str:
+        return f"{self.source_repository}:{self.source_tag}"
+
+    @property
+    def destination_endpoint(self) -> str:
+        return f"{self.destination_repository}:{self.destination_tag}"
+
+    @property
+    def forced(self) -> bool:
+        return self.force_pull or self.force_push
+
+
+def parse_image_reference(repository: LiteralString) -> Tuple[str, str]:
+    """splits a repository into the registry host and the repository path, the same way docker does
+
+    Args:
+        repository (LiteralString): repository with an optional registry prefix, e.g. docker.io/nginx or localhost:5000/nginx
+
+    Returns:
+        Tuple[str, str]: registry host and repository path
+    """
+    parts = repository.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        host, path = parts[0], parts[1]
+    else:
+        host, path = "docker.io", repository
+    if host in ("docker.io", "index.docker.io"):
+        host = DOCKER_HUB_HOST
+        if "/" not in path:
+            path = f"library/{path}"
+    return host, path
+
+
+def validate_sha256(sha256_hash: LiteralString) -> bool:
+    """validates sha256 string
+
+    Args:
+        sha256_hash (LiteralString): string containing sha256 for image
+
+    Returns:
+        bool: True if it is a valid sha256 string
+    """
+    if re.search(r"\b[A-Fa-f0-9]{64}\b", sha256_hash):  # https://stackoverflow.com/a/43599586/11051914
+        return True
+    else:
+        return False
+
+
+def validate_platform(platform: str) -> bool:
+    """validates a platform string such as linux/amd64 or linux/arm/v7
+
+    Args:
+        platform (str): platform from the input file
+
+    Returns:
+        bool: True if it is os/architecture with an optional variant
+    """
+    return re.fullmatch(r"[a-z0-9]+/[a-z0-9_]+(/[a-z0-9]+)?", platform) is not None
+
+
+def build_replication_entry(logger: Any, image: Dict[LiteralString, Any]) -> Optional[ReplicationEntry]:
+    """resolves defaults for a validated replication entry from the input file
+
+    Args:
+        image (Dict[LiteralString, Any]): single element of images from the input file
+
+    Returns:
+        Optional[ReplicationEntry]: the entry, or None if it should be skipped
+    """
+    # remove docker.io registry prefix as its implicit and not returned by the API when doing lookups
+    source_repository: str = re.sub(r"^docker.io/", "", str(image["source"]["repository"]))
+    source_tag: str = str(image["source"]["tag"])
+    destination_repository: str = str(image["destination"]["repository"])
+
+    # check forcePull and forcePush values
+    try:
+        force_pull: bool = bool(image["source"]["forcePull"])
+    except KeyError:
+        force_pull = False
+    try:
+        force_push: bool = bool(image["source"]["forcePush"])
+    except KeyError:
+        force_push = False
+
+    # destination tag is optional, falls back to source tag
+    try:
+        destination_tag = str(image["destination"]["tag"])
+    except KeyError:
+        logger.debug("no destination tag provided - using source tag as a fallback")
+        destination_tag = str(image["source"]["tag"])
+
+    # use images.[]source.sha256 if its valid
+    final_sha256: str = ""
+    try:
+        source_sha256: str = str(image["source"]["sha256"])
+        if validate_sha256(source_sha256):
+            final_sha256 = source_sha256
+            logger.debug(f"{final_sha256} - using this valid sha256")
+        else:
+            logger.warning(f"{source_repository}:@sha256:{source_sha256} - skipping image because sha256 is not valid")
+            return None
+    except KeyError:
+        logger.debug("no valid source sha256 provided, not using sha256 suffix on image URI")
+
+    # the --watch poller passes along the digest it just resolved the source tag to
+    polled_digest = image["source"].get("polledDigest")
+    source_digest = f"sha256:{final_sha256}" if final_sha256 != "" else str(polled_digest) if polled_digest else None
+
+    # platforms is optional, an empty list keeps every platform of a multi-arch source
+    platforms: List[str] = list()
+    try:
+        platforms = [str(platform) for platform in image["source"]["platforms"]]
+    except KeyError:
+        pass
+    for platform in platforms:
+        if not validate_platform(platform):
+            logger.warning(f"{source_repository}:{source_tag} - skipping image because platform {platform} is not valid")
+            return None
+
+    # priority is optional, only used with --order priority
+    try:
+        priority = int(image.get("priority", 0))
+    except (TypeError, ValueError):
+        logger.warning(f"{source_repository}:{source_tag} - skipping image because priority {image['priority']} is not an integer")
+        return None
+
+    return ReplicationEntry(
+        source_repository=source_repository,
+        source_tag=source_tag,
+        destination_repository=destination_repository,
+        destination_tag=destination_tag,
+        final_sha256=final_sha256,
+        force_pull=force_pull,
+        force_push=force_push,
+        source_digest=source_digest,
+        platforms=platforms,
+        priority=priority,
+    )
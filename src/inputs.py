@@ -0,0 +1,202 @@
+import glob
+import json
+import sys
+import threading
+from pathlib import Path
+from typing import Any
+from typing import IO
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+import yaml
+
+JSON_LINES_SUFFIXES = (".jsonl", ".ndjson")
+STDIN = "-"
+
+
+class InputErrors:
+    """problems found while reading input files, collected so one bad entry doesn't stop the others"""
+
+    def __init__(self) -> None:
+        self.errors: List[Tuple[str, str]] = list()
+        self._lock = threading.Lock()
+
+    def add(self, location: str, message: str) -> None:
+        """records a problem
+
+        Args:
+            location (str): input file and entry, e.g. images.yaml#3
+            message (str): what's wrong with it
+        """
+        with self._lock:
+            self.errors.append((location, message))
+
+    def __len__(self) -> int:
+        return len(self.errors)
+
+    def log(self, logger: Any) -> None:
+        for location, message in self.errors:
+            logger.error(f"{location} - {message}")
+        if self.errors:
+            logger.error(f"{len(self.errors)} problems found in the input files, those entries were skipped")
+
+
+def expand_inputs(patterns: List[str], errors: InputErrors) -> List[str]:
+    """expands globs in the input arguments, keeping their order
+
+    Args:
+        patterns (List[str]): paths, globs, or - for stdin
+        errors (InputErrors): collects patterns that match nothing
+
+    Returns:
+        List[str]: paths to read, or - for stdin
+    """
+    paths = list()
+    for pattern in patterns:
+        if pattern == STDIN or not glob.has_magic(pattern):
+            paths.append(pattern)
+            continue
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            errors.add(pattern, "no input files match this pattern")
+        paths.extend(matches)
+    return paths
+
+
+def iter_yaml_images(stream: IO[str], path: str, errors: InputErrors) -> Iterator[Any]:
+    """yields the elements of the top-level `images` list of every YAML document one at a time, while the rest of the
+    stream is still unread, instead of loading the whole document first
+
+    Args:
+        stream (IO[str]): YAML input
+        path (str): name of the input, for error messages
+        errors (InputErrors): collects documents without an `images` list
+
+    Yields:
+        Any: one element of images
+    """
+    # the type stubs leave the event API untyped and don't allow composing a node without a parent, as PyYAML itself does
+    loader: Any = yaml.SafeLoader(stream)
+    try:
+        loader.get_event()  # StreamStartEvent
+        documents = 0
+        while loader.check_event(yaml.DocumentStartEvent):
+            loader.get_event()
+            documents += 1
+            location = path if documents == 1 else f"{path} (document {documents})"
+            if not loader.check_event(yaml.MappingStartEvent):
+                # not a mapping, so there's no images key to look for
+                loader.compose_node(None, None)
+                loader.get_event()  # DocumentEndEvent
+                errors.add(location, "no `images` list found, the input must be a mapping with an `images` key")
+                continue
+            loader.get_event()
+            found = False
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = loader.construct_object(loader.compose_node(None, None))
+                if key != "images":
+                    loader.compose_node(None, None)
+                    continue
+                found = True
+                if not loader.check_event(yaml.SequenceStartEvent):
+                    loader.compose_node(None, None)
+                    errors.add(location, "`images` must be a list")
+                    continue
+                loader.get_event()
+                index = 0
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield loader.construct_object(loader.compose_node(None, index), deep=True)
+                    # constructed entries aren't needed after they're handed out
+                    loader.constructed_objects = dict()
+                    index += 1
+                loader.get_event()
+            loader.get_event()  # MappingEndEvent
+            loader.get_event()  # DocumentEndEvent
+            loader.anchors = dict()
+            if not found:
+                errors.add(location, "no `images` list found, the input must be a mapping with an `images` key")
+        if documents == 0:
+            errors.add(path, "input file is empty")
+    finally:
+        loader.dispose()
+
+
+def iter_json_lines_images(stream: IO[str], path: str, errors: InputErrors) -> Iterator[Tuple[str, Any]]:
+    """yields one entry per line of JSON-lines input, skipping blank lines and collecting lines that don't parse
+
+    Args:
+        stream (IO[str]): JSON-lines input
+        path (str): name of the input, for error messages
+        errors (InputErrors): collects lines that aren't valid JSON
+
+    Yields:
+        Tuple[str, Any]: location of the entry and the entry
+    """
+    for number, line in enumerate(stream, start=1):
+        if line.strip() == "":
+            continue
+        try:
+            yield f"{path}:{number}", json.loads(line)
+        except json.JSONDecodeError as e:
+            errors.add(f"{path}:{number}", f"invalid JSON: {e}")
+
+
+class ChainedStream:
+    """a text stream that replays a line that was already read to sniff the format, then continues with the rest"""
+
+    def __init__(self, first_line: str, stream: IO[str]) -> None:
+        self.first_line = first_line
+        self.stream = stream
+
+    def read(self, size: int = -1) -> str:
+        if self.first_line:
+            data, self.first_line = self.first_line, ""
+            return data
+        return self.stream.read(size)
+
+    def __iter__(self) -> Iterator[str]:
+        if self.first_line:
+            yield self.first_line
+            self.first_line = ""
+        yield from self.stream
+
+    def close(self) -> None:
+        pass
+
+
+def iter_input_images(logger: Any, patterns: List[str], errors: InputErrors) -> Iterator[Tuple[str, Any]]:
+    """reads entries from every input in order, one at a time. Files ending in .jsonl or .ndjson hold one JSON entry per
+    line, everything else is YAML with an `images` list. Stdin holds JSON lines if its first line is a JSON object,
+    otherwise YAML
+
+    Args:
+        patterns (List[str]): paths, globs, or - for stdin
+        errors (InputErrors): collects inputs that can't be read or parsed
+
+    Yields:
+        Tuple[str, Any]: location of the entry (input and line or index) and the entry
+    """
+    for path in expand_inputs(patterns, errors):
+        logger.debug(f"{path} - reading input")
+        try:
+            stream: Any = sys.stdin if path == STDIN else open(path, encoding="utf-8")
+        except OSError as e:
+            errors.add(path, f"unable to read input file: {e}")
+            continue
+        try:
+            json_lines = Path(path).suffix in JSON_LINES_SUFFIXES
+            if path == STDIN:
+                first_line = stream.readline()
+                json_lines = first_line.lstrip().startswith("{")
+                stream = ChainedStream(first_line, stream)
+            if json_lines:
+                yield from iter_json_lines_images(stream, path, errors)
+            else:
+                for index, image in enumerate(iter_yaml_images(stream, path, errors)):
+                    yield f"{path}#{index}", image
+        except yaml.YAMLError as e:
+            errors.add(path, f"failed to parse input file: {e}")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
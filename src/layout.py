@@ -0,0 +1,296 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from inputs import InputErrors
+from registry import MEDIA_TYPE_OCI_INDEX
+from registry import MEDIA_TYPE_OCI_MANIFEST
+from registry import RegistryClient
+from registry import RegistryError
+from retry import RetryBudget
+
+LAYOUT_VERSION = "1.0.0"
+# containerd and nerdctl name images in a layout this way, ref.name alone usually only holds the tag
+ANNOTATION_IMAGE_NAME = "io.containerd.image.name"
+ANNOTATION_REF_NAME = "org.opencontainers.image.ref.name"
+INCOMPLETE_DIRECTORY = ".incomplete"
+
+
+def split_image_name(name: str) -> Tuple[str, str]:
+    """splits repository:tag, keeping the port of a registry host with the repository
+
+    Args:
+        name (str): image name, e.g. localhost:5000/team/app:1.0
+
+    Returns:
+        Tuple[str, str]: repository and tag, latest if there is none
+    """
+    repository, _, tag = name.rpartition(":")
+    if not repository or "/" in tag:
+        return name, "latest"
+    return repository, tag
+
+
+def descriptor_name(descriptor: Dict[str, Any]) -> Optional[str]:
+    """reads the full image name of a manifest in index.json
+
+    Args:
+        descriptor (Dict[str, Any]): manifest descriptor from index.json
+
+    Returns:
+        Optional[str]: repository:tag, or None if the layout doesn't say where the image belongs
+    """
+    annotations = descriptor.get("annotations") or dict()
+    if annotations.get(ANNOTATION_IMAGE_NAME):
+        return str(annotations[ANNOTATION_IMAGE_NAME])
+    # tags can't contain either, so a ref.name with them is a full name
+    name = str(annotations.get(ANNOTATION_REF_NAME, ""))
+    return name if ":" in name or "/" in name else None
+
+
+class ImageLayout:
+    """an OCI image-layout directory used in place of a registry: the destination of --export-dir or the source of
+    --import-dir. Blobs are stored once by digest whatever image they belong to, so repositories are only kept in the
+    names in index.json
+
+    Args:
+        logger (Any): logger
+        path (Path): layout directory, created if it doesn't exist
+        chunk_size (int): bytes per chunk when reading blobs
+    """
+
+    def __init__(self, logger: Any, path: Path, chunk_size: int = 16 * 1024 * 1024) -> None:
+        self.logger = logger
+        self.path = path
+        self.host = f"oci:{path}"
+        self.chunk_size = chunk_size
+        self.blobs = path / "blobs" / "sha256"
+        self.incomplete = path / INCOMPLETE_DIRECTORY
+        self._index: Dict[str, Dict[str, Any]] = dict()  # image name -> manifest descriptor
+        self._changed = False
+        self._lock = threading.Lock()
+
+        index_path = path / "index.json"
+        if index_path.exists():
+            with open(index_path, encoding="utf-8") as index_file:
+                for descriptor in json.load(index_file).get("manifests", list()):
+                    name = descriptor_name(descriptor)
+                    if name is not None:
+                        self._index[name] = descriptor
+
+    def open(self) -> None:
+        """creates the layout for writing, dropping blobs left incomplete by an interrupted export"""
+        shutil.rmtree(self.incomplete, ignore_errors=True)
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.incomplete.mkdir(exist_ok=True)
+        if not (self.path / "oci-layout").exists():
+            self._write_json(self.path / "oci-layout", {"imageLayoutVersion": LAYOUT_VERSION})
+
+    def images(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """lists the named images in index.json
+
+        Returns:
+            List[Tuple[str, Dict[str, Any]]]: repository:tag and manifest descriptor of each image
+        """
+        with self._lock:
+            return sorted(self._index.items())
+
+    def _blob_path(self, digest: str) -> Path:
+        algorithm, _, encoded = digest.partition(":")
+        if algorithm != "sha256" or len(encoded) != 64 or not all(c in "0123456789abcdef" for c in encoded):
+            raise RegistryError(f"{self.host}@{digest} - unsupported digest", 400)
+        return self.blobs / encoded
+
+    def _resolve(self, repository: str, reference: str) -> Optional[str]:
+        if reference.startswith("sha256:"):
+            return reference if self._blob_path(reference).exists() else None
+        with self._lock:
+            descriptor = self._index.get(f"{repository}:{reference}")
+        return str(descriptor["digest"]) if descriptor is not None else None
+
+    def head_manifest(self, repository: str, reference: str, known_digest: Optional[str] = None) -> Tuple[Optional[str], int]:
+        """resolves a tag or digest to a manifest digest, like a manifest HEAD request
+
+        Args:
+            repository (str): image name without the tag
+            reference (str): tag or digest
+            known_digest (Optional[str]): unused, reading the index is as cheap as comparing
+
+        Returns:
+            Tuple[Optional[str], int]: manifest digest (None if missing) and 200 or 404
+        """
+        digest = self._resolve(repository, reference)
+        return digest, 200 if digest is not None else 404
+
+    def get_manifest(self, repository: str, reference: str) -> Tuple[bytes, str, str]:
+        """reads a manifest
+
+        Args:
+            repository (str): image name without the tag
+            reference (str): tag or digest
+
+        Returns:
+            Tuple[bytes, str, str]: raw manifest, media type and digest
+        """
+        digest = self._resolve(repository, reference)
+        if digest is None:
+            raise RegistryError(f"{self.host}/{repository}:{reference} - manifest not found in layout", 404)
+        raw = self._blob_path(digest).read_bytes()
+        media_type = json.loads(raw).get("mediaType") or MEDIA_TYPE_OCI_MANIFEST
+        return raw, str(media_type), digest
+
+    # only reads manifests through get_manifest, so it works on a layout unchanged
+    get_image_size = RegistryClient.get_image_size
+
+    def put_manifest(self, repository: str, reference: str, raw: bytes, media_type: str) -> None:
+        """stores a manifest, and names it in index.json when it's stored under a tag
+
+        Args:
+            repository (str): image name without the tag
+            reference (str): tag or digest to store the manifest under
+            raw (bytes): manifest exactly as it was downloaded
+            media_type (str): manifest media type
+        """
+        digest = f"sha256:{hashlib.sha256(raw).hexdigest()}"
+        if not self._blob_path(digest).exists():
+            upload = self.start_upload(repository, digest)
+            upload.write(raw)
+            upload.finish()
+        if reference.startswith("sha256:"):
+            return
+        name = f"{repository}:{reference}"
+        with self._lock:
+            self._index[name] = {
+                "mediaType": media_type,
+                "digest": digest,
+                "size": len(raw),
+                "annotations": {ANNOTATION_IMAGE_NAME: name, ANNOTATION_REF_NAME: reference},
+            }
+            self._changed = True
+
+    def blob_exists(self, repository: str, digest: str) -> bool:
+        """checks whether a blob is stored, which makes it available to every image in the layout"""
+        return self._blob_path(digest).exists()
+
+    def mount_blob(self, repository: str, digest: str, from_repository: str) -> bool:
+        """blobs aren't stored per repository, so there's never anything to mount"""
+        return False
+
+    def start_upload(self, repository: str, digest: str, budget: Optional[RetryBudget] = None) -> "LayoutUpload":
+        return LayoutUpload(self, repository, digest)
+
+    def iter_blob(self, repository: str, digest: str, chunk_size: int, budget: Optional[RetryBudget] = None) -> Iterator[bytes]:
+        """reads a blob in chunks
+
+        Args:
+            repository (str): image name, unused since blobs are shared
+            digest (str): blob digest
+            chunk_size (int): bytes per chunk
+
+        Yields:
+            Iterator[bytes]: chunks of at most chunk_size bytes
+        """
+        try:
+            blob = open(self._blob_path(digest), "rb")
+        except FileNotFoundError:
+            raise RegistryError(f"{self.host}@{digest} - blob not found in layout", 404)
+        with blob:
+            while chunk := blob.read(chunk_size):
+                yield chunk
+
+    def _write_json(self, path: Path, content: Dict[str, Any]) -> None:
+        temporary = path.with_name(f"{path.name}.tmp")
+        with open(temporary, "w", encoding="utf-8") as json_file:
+            json.dump(content, json_file, indent=3)
+        os.replace(temporary, path)
+
+    def close(self) -> None:
+        """writes index.json if images were added. It's only written once, since rewriting it for every image of a large
+        export would be quadratic; an interrupted export keeps its blobs, so running it again only adds the manifests"""
+        with self._lock:
+            if not self._changed:
+                return
+            manifests = [self._index[name] for name in sorted(self._index)]
+            index = {"schemaVersion": 2, "mediaType": MEDIA_TYPE_OCI_INDEX, "manifests": manifests}
+            self._changed = False
+        self._write_json(self.path / "index.json", index)
+        shutil.rmtree(self.incomplete, ignore_errors=True)
+        self.logger.info(f"{self.path} - wrote index.json with {len(manifests)} images")
+
+
+class LayoutUpload:
+    """a blob being written to a layout. It's streamed to a temporary file while its digest is computed, and only moved
+    into blobs/ once the digest matches, so the layout never holds a partial or corrupt blob"""
+
+    def __init__(self, layout: ImageLayout, repository: str, digest: str) -> None:
+        self.client = layout
+        self.repository = repository
+        self.digest = digest
+        self.offset = 0
+        self.path = layout._blob_path(digest)
+        self._hash = hashlib.sha256()
+        self._file = tempfile.NamedTemporaryFile(dir=layout.incomplete, prefix=f"{self.path.name}.", delete=False)
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.client.host}@{self.digest}"
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self.offset += len(chunk)
+
+    def finish(self) -> int:
+        """verifies the digest and moves the blob into place
+
+        Returns:
+            int: bytes written
+        """
+        self._file.close()
+        if f"sha256:{self._hash.hexdigest()}" != self.digest:
+            os.remove(self._file.name)
+            raise RegistryError(f"{self.endpoint} - content doesn't match its digest")
+        os.replace(self._file.name, self.path)
+        return self.offset
+
+
+def iter_layout_images(path: Path, errors: InputErrors) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """turns the named images of a layout into replication entries for --import-dir, from the layout to the registry in
+    each image's name. Images are pinned by digest, so entries of the same image are copied as one source
+
+    Args:
+        path (Path): layout directory
+        errors (InputErrors): collects a missing index and unnamed images
+
+    Yields:
+        Iterator[Tuple[str, Dict[str, Any]]]: location in index.json and entry
+    """
+    index_path = path / "index.json"
+    try:
+        with open(index_path, encoding="utf-8") as index_file:
+            manifests = json.load(index_file).get("manifests", list())
+    except (OSError, ValueError) as e:
+        errors.add(str(index_path), f"unable to read layout index: {e}")
+        return
+    for number, descriptor in enumerate(manifests, start=1):
+        location = f"{index_path}#{number}"
+        name = descriptor_name(descriptor)
+        if name is None:
+            errors.add(location, f"image has no {ANNOTATION_IMAGE_NAME} annotation naming its destination")
+            continue
+        repository, tag = split_image_name(name)
+        # the layout is read by digest, the name only labels the source like skopeo's oci:DIR:NAME does
+        yield location, {
+            "source": {"repository": f"oci:{path}", "tag": name, "sha256": str(descriptor["digest"]).removeprefix("sha256:")},
+            "destination": {"repository": repository, "tag": tag},
+        }
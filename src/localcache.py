@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Set
+
+import docker
+
+from localimages import LocalImageIndex
+from summary import format_bytes
+
+
+class LocalImageCache:
+    """keeps the images a run pulls within a disk budget. An image may only be removed once it has been pushed to every
+    destination that needs it, least recently used first, and images that were present before the cache was created are
+    never removed. With --watch one cache lasts for every pass, so an image pulled by an earlier pass is never mistaken for
+    one of those
+    """
+
+    def __init__(self, logger: Any, docker_client: Any, local_images: LocalImageIndex, budget: int) -> None:
+        self.logger = logger
+        self.docker_client = docker_client
+        self.local_images = local_images
+        self.budget = budget
+        self.preexisting: Set[str] = set(local_images.images)
+        self.sizes: "OrderedDict[str, int]" = OrderedDict()  # image ID -> size, least recently used first
+        self.pending: Dict[str, int] = dict()  # image ID -> pushes still to do
+        self.evicted = 0
+        self.bytes_evicted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def acquired(self, image: Any, pushes: int) -> None:
+        """tracks an image that is about to be pushed, pinning it until the pushes are done
+
+        Args:
+            image (Any): local image
+            pushes (int): number of destinations it will be pushed to
+        """
+        if image.id in self.preexisting:
+            return
+        with self._lock:
+            # image sizes include layers shared with other images, so the budget is an upper bound on the disk used
+            self.sizes[image.id] = int(image.attrs.get("Size", 0))
+            self.sizes.move_to_end(image.id)
+            self.pending[image.id] = self.pending.get(image.id, 0) + pushes
+        self.evict()
+
+    def pushed(self, image: Any) -> None:
+        """releases one push of an image, successful or not, making it evictable once all of them are done
+
+        Args:
+            image (Any): local image
+        """
+        with self._lock:
+            if image.id not in self.pending:
+                return
+            self.sizes.move_to_end(image.id)
+            self.pending[image.id] -= 1
+            if self.pending[image.id] > 0:
+                return
+            del self.pending[image.id]
+        self.evict()
+
+    def evict(self) -> None:
+        """removes evictable images, least recently used first, until the tracked images fit the budget again"""
+        with self._lock:
+            victims: List[str] = list()
+            remaining = self.size
+            for image_id, size in self.sizes.items():
+                if remaining <= self.budget:
+                    break
+                if image_id not in self.pending:
+                    victims.append(image_id)
+                    remaining -= size
+            sizes = {image_id: self.sizes.pop(image_id) for image_id in victims}
+
+        for image_id, size in sizes.items():
+            try:
+                # forced, because the image is also tagged for each of its destinations
+                self.docker_client.images.remove(image_id, force=True)
+            except docker.errors.APIError as e:
+                self.logger.warning(f"{image_id} - failed to remove image from the local cache: {e}")
+                continue
+            self.local_images.remove(image_id)
+            with self._lock:
+                self.evicted += 1
+                self.bytes_evicted += size
+            self.logger.debug(f"{image_id} - removed {format_bytes(size)} from the local cache")
+
+    def log(self) -> None:
+        self.logger.info(
+            f"local cache: removed {self.evicted} images ({format_bytes(self.bytes_evicted)}), "
+            f"{len(self.sizes)} pulled images ({format_bytes(self.size)}) left, budget {format_bytes(self.budget)}"
+        )
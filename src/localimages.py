@@ -0,0 +1,141 @@
+import re
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+import docker
+import requests
+
+
+def normalize_reference(reference: str) -> str:
+    """normalizes a local image reference the way the daemon shortens Docker Hub references in RepoTags and RepoDigests
+
+    Args:
+        reference (str): reference such as docker.io/library/nginx:1.23 or localhost:5000/nginx@sha256:...
+
+    Returns:
+        str: the shortest form, e.g. nginx:1.23
+    """
+    reference = re.sub(r"^(docker\.io|index\.docker\.io)/", "", reference)
+    return re.sub(r"^library/(?=[^/]+$)", "", reference)
+
+
+class LocalImageIndex:
+    """images in the local daemon by tag and by repository digest, listed once and then kept current from the daemon's
+    event stream, so presence checks are dictionary lookups instead of `images.list` calls that scan the whole image store
+    """
+
+    def __init__(self, logger: Any, docker_client: Any) -> None:
+        self.logger = logger
+        self.docker_client = docker_client
+        self.images: Dict[str, Any] = dict()  # image ID -> image
+        self.references: Dict[str, str] = dict()  # normalized reference -> image ID
+        self._lock = threading.Lock()
+        self._events: Any = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """subscribes to image events, then lists local images once. Subscribing first means nothing that happens while
+        listing is missed"""
+        started = time.monotonic()
+        self._events = self.docker_client.events(decode=True, filters={"type": "image"}, since=int(time.time()))
+        self._thread = threading.Thread(target=self._follow, name="local-image-events", daemon=True)
+        self._thread.start()
+        for image in self.docker_client.images.list():
+            self.add(image)
+        self.logger.debug(
+            f"indexed {len(self.images)} local images by {len(self.references)} references in {time.monotonic() - started:.2f}s"
+        )
+
+    def add(self, image: Any) -> None:
+        """indexes an image under all of its tags and repository digests, replacing what was indexed for it before
+
+        Args:
+            image (Any): docker-py image object
+        """
+        with self._lock:
+            self._remove(image.id)
+            self.images[image.id] = image
+            for reference in list(image.attrs.get("RepoTags") or list()) + list(image.attrs.get("RepoDigests") or list()):
+                self.references[normalize_reference(reference)] = image.id
+
+    def remove(self, image_id: str) -> None:
+        """drops an image and every reference pointing at it
+
+        Args:
+            image_id (str): image ID
+        """
+        with self._lock:
+            self._remove(image_id)
+
+    def _remove(self, image_id: str) -> None:
+        self.images.pop(image_id, None)
+        for reference in [reference for reference, indexed_id in self.references.items() if indexed_id == image_id]:
+            del self.references[reference]
+
+    def refresh(self, reference: str) -> Optional[Any]:
+        """re-reads one image from the daemon, e.g. right after pulling it, without waiting for its event to arrive
+
+        Args:
+            reference (str): image reference or ID
+
+        Returns:
+            Optional[Any]: the image, or None if the daemon doesn't have it
+        """
+        try:
+            image = self.docker_client.images.get(reference)
+        except docker.errors.ImageNotFound:
+            if reference.startswith("sha256:"):
+                self.remove(reference)
+            return None
+        # a reference that moved to another image must not keep pointing at the old one
+        with self._lock:
+            previous = self.references.get(normalize_reference(reference))
+        if previous is not None and previous != image.id:
+            self.refresh(previous)
+        self.add(image)
+        return image
+
+    def get(self, reference: str) -> Optional[Any]:
+        """looks up a local image
+
+        Args:
+            reference (str): repository:tag or repository@sha256:digest
+
+        Returns:
+            Optional[Any]: the image, or None if it isn't present locally
+        """
+        with self._lock:
+            image_id = self.references.get(normalize_reference(reference))
+            return self.images.get(image_id) if image_id is not None else None
+
+    def tagged(self, image: Any, reference: str) -> None:
+        """records a tag applied by this process, so it's visible before the daemon's tag event arrives
+
+        Args:
+            image (Any): tagged image
+            reference (str): the new repository:tag
+        """
+        with self._lock:
+            self.images.setdefault(image.id, image)
+            self.references[normalize_reference(reference)] = image.id
+
+    def _follow(self) -> None:
+        try:
+            for event in self._events:
+                action = str(event.get("Action", ""))
+                actor = event.get("Actor", dict())
+                image_id = str(actor.get("ID", ""))
+                if action == "delete":
+                    self.remove(image_id)
+                elif action in ("pull", "tag", "untag", "load", "import"):
+                    self.refresh(image_id)
+        except (docker.errors.APIError, requests.RequestException) as e:
+            # the stream also ends this way when close() is called
+            self.logger.debug(f"local image event stream ended: {e}")
+
+    def close(self) -> None:
+        if self._events is not None:
+            self._events.close()
@@ -0,0 +1,121 @@
+import heapq
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from plan import SourceJob
+from summary import format_bytes
+
+ORDER_FILE = "file"
+ORDER_SIZE = "size"
+ORDER_PRIORITY = "priority"
+ORDERS = [ORDER_FILE, ORDER_SIZE, ORDER_PRIORITY]
+
+
+def order_jobs(jobs: List[SourceJob], sizes: Dict[str, int], order: str) -> List[SourceJob]:
+    """orders jobs so the ones that take longest start first, which keeps a big image listed last from running alone
+    after every other worker is done
+
+    Args:
+        jobs (List[SourceJob]): jobs in the order their sources first appear in the input
+        sizes (Dict[str, int]): size of each job's source by key, missing ones count as 0
+        order (str): one of the ORDER_* values. ORDER_PRIORITY puts higher priorities first and the largest first within each
+
+    Returns:
+        List[SourceJob]: jobs in the order to run them
+    """
+    if order == ORDER_SIZE:
+        return sorted(jobs, key=lambda job: -sizes.get(job.key, 0))
+    if order == ORDER_PRIORITY:
+        return sorted(jobs, key=lambda job: (-job.priority, -sizes.get(job.key, 0)))
+    return list(jobs)
+
+
+def estimate_run_time(sizes: List[int], workers: int, throughput: float) -> float:
+    """simulates handing jobs to whichever worker is free first, in the given order
+
+    Args:
+        sizes (List[int]): size of each job in bytes, in the order they're started
+        workers (int): number of workers
+        throughput (float): bytes per second one worker moves
+
+    Returns:
+        float: seconds until the last job is done
+    """
+    finish_times = [0.0] * max(workers, 1)
+    for size in sizes:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + size / throughput)
+    return max(finish_times)
+
+
+class ScheduleReport:
+    """when each scheduled source started and finished, to compare the run time against an estimate from the source sizes
+
+    Args:
+        order (str): one of the ORDER_* values jobs are scheduled in
+        workers (int): number of jobs running at once
+    """
+
+    def __init__(self, order: str, workers: int) -> None:
+        self.order = order
+        self.workers = workers
+        self.batches: List[List[Tuple[SourceJob, int]]] = list()  # each batch's jobs and sizes, in input order
+        self.started: Dict[str, float] = dict()
+        self.finished: Dict[str, float] = dict()
+        self._lock = threading.Lock()
+
+    def scheduled(self, jobs: List[SourceJob], sizes: Dict[str, int]) -> None:
+        """records a batch of jobs and the sizes of their sources
+
+        Args:
+            jobs (List[SourceJob]): jobs in input order
+            sizes (Dict[str, int]): size of each job's source by key
+        """
+        with self._lock:
+            self.batches.append([(job, sizes.get(job.key, 0)) for job in jobs])
+
+    def start(self, key: str) -> None:
+        with self._lock:
+            self.started.setdefault(key, time.monotonic())
+
+    def finish(self, key: str) -> None:
+        with self._lock:
+            self.finished[key] = max(self.finished.get(key, 0.0), time.monotonic())
+
+    def run(self, key: str, func: Any, *args: Any) -> Any:
+        """calls func, recording when the job started and finished"""
+        self.start(key)
+        try:
+            return func(*args)
+        finally:
+            self.finish(key)
+
+    def log(self, logger: Any) -> None:
+        done = [key for key in self.finished if key in self.started]
+        if not done:
+            return
+        actual = max(self.finished[key] for key in done) - min(self.started[key] for key in done)
+        sizes = {job.key: size for batch in self.batches for job, size in batch}
+        busy = sum(self.finished[key] - self.started[key] for key in done if sizes.get(key))
+        if self.order == ORDER_FILE or busy <= 0:
+            logger.info(f"ran {len(done)} sources in {self.order} order in {actual:.1f}s")
+            return
+
+        # the throughput of one worker is measured from this run, so the estimates show what the order itself costs or saves
+        throughput = sum(sizes[key] for key in done if sizes.get(key)) / busy
+        in_order = [size for batch in self.batches for size in self._ordered_sizes(batch, self.order)]
+        in_file_order = [size for batch in self.batches for _, size in batch]
+        ideal = max(sum(in_order) / self.workers, max(in_order)) / throughput
+        logger.info(
+            f"ran {len(done)} sources ({format_bytes(sum(in_order))}) in {self.order} order with {self.workers} workers at "
+            f"{format_bytes(throughput)}/s each: estimated {estimate_run_time(in_order, self.workers, throughput):.1f}s "
+            f"(file order {estimate_run_time(in_file_order, self.workers, throughput):.1f}s, ideal {ideal:.1f}s), actual {actual:.1f}s"
+        )
+
+    @staticmethod
+    def _ordered_sizes(batch: List[Tuple[SourceJob, int]], order: str) -> List[int]:
+        sizes = {job.key: size for job, size in batch}
+        return [sizes[job.key] for job in order_jobs([job for job, _ in batch], sizes, order)]
@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from scheduler import HostLimiter
+from scheduler import HostQueue
+
+_DONE = object()
+
+
+class Stage:
+    """one step of a pipeline with its own worker threads, fed by a bounded queue
+
+    Args:
+        name (str): name used in the report
+        func (Callable[[Any], Optional[Any]]): processes one item and returns what to hand to the next stage, a list of items
+            to hand over separately, or None to drop it
+        workers (int): number of worker threads
+        queue_size (int): maximum number of items waiting for this stage before upstream stages block, 0 for no limit
+        hosts (Optional[Callable[[Any], Iterable[str]]]): registry hosts an item talks to. Given a limiter, workers take
+            the oldest item whose hosts have a free slot and hold the slots while processing it, instead of taking items in
+            order and waiting for a busy host
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        failed (Optional[Callable[[Any, Exception], None]]): called with an item and the error when func raises, to record
+            the item's outcome and give back what it holds
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Optional[Any]],
+        workers: int,
+        queue_size: int,
+        hosts: Optional[Callable[[Any], Iterable[str]]] = None,
+        limiter: Optional[HostLimiter] = None,
+        failed: Optional[Callable[[Any, Exception], None]] = None,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.failed = failed
+        self.workers = max(workers, 1)
+        self.queue: Any = HostQueue(limiter, hosts, queue_size) if hosts is not None and limiter is not None else queue.Queue(queue_size)
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._lock = threading.Lock()
+
+    def put(self, item: Any) -> None:
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_total += depth
+            self._depth_samples += 1
+
+    def get(self) -> Tuple[Any, Any]:
+        """takes the next item for a worker
+
+        Returns:
+            Tuple[Any, Any]: the item, or _DONE once the stage is shut down, and the hosts the worker now holds slots on
+        """
+        if isinstance(self.queue, HostQueue):
+            taken = self.queue.get()
+            return taken if taken is not None else (_DONE, None)
+        return self.queue.get(), None
+
+    def done(self, hosts: Any) -> None:
+        """gives back what get() took for an item"""
+        if hosts is not None:
+            self.queue.release(hosts)
+
+    def close(self) -> None:
+        """lets the workers finish once the queue is empty"""
+        if isinstance(self.queue, HostQueue):
+            self.queue.close()
+            return
+        for _ in range(self.workers):
+            self.queue.put(_DONE)
+
+    @property
+    def mean_depth(self) -> float:
+        return self._depth_total / self._depth_samples if self._depth_samples else 0.0
+
+
+class Pipeline:
+    """runs items through stages concurrently, so e.g. pulling image N+1 overlaps pushing image N"""
+
+    def __init__(self, logger: Any, stages: List[Stage]) -> None:
+        self.logger = logger
+        self.stages = stages
+        self.wall_seconds = 0.0
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item, hosts = stage.get()
+            if item is _DONE:
+                return
+            started = time.monotonic()
+            try:
+                result = stage.func(item)
+            except Exception as e:  # one bad image must not take the whole stage down
+                if stage.failed is not None:
+                    stage.failed(item, e)
+                else:
+                    self.logger.error(f"{stage.name} stage failed: {e}")
+                result = None
+            finally:
+                stage.done(hosts)
+            with stage._lock:
+                stage.items += 1
+                stage.busy_seconds += time.monotonic() - started
+            if result is None or next_stage is None:
+                continue
+            # a list fans out into separate items, e.g. one push per destination of a pulled image
+            for next_item in result if isinstance(result, list) else [result]:
+                next_stage.put(next_item)
+
+    def run(self, items: Iterable[Any]) -> None:
+        """feeds items into the first stage and returns once every stage has drained
+
+        Args:
+            items (Iterable[Any]): items for the first stage
+        """
+        started = time.monotonic()
+        threads = list()
+        for index, stage in enumerate(self.stages):
+            stage_threads = [threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{n}") for n in range(stage.workers)]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+
+        try:
+            for item in items:
+                self.stages[0].put(item)
+        finally:
+            # a stage can only finish once everything upstream has, so shut them down in order. This also runs when items
+            # raises, otherwise the workers would wait for more items forever
+            for stage, stage_threads in zip(self.stages, threads):
+                stage.close()
+                for thread in stage_threads:
+                    thread.join()
+            self.wall_seconds = time.monotonic() - started
+
+    def log_report(self) -> None:
+        """logs queue depth and utilization per stage"""
+        for stage in self.stages:
+            utilization = stage.busy_seconds / (stage.workers * self.wall_seconds) if self.wall_seconds else 0.0
+            self.logger.info(
+                f"{stage.name} stage: {stage.items} images, {stage.workers} workers, {utilization:.0%} utilized, "
+                f"queue depth max {stage.max_depth} mean {stage.mean_depth:.1f}"
+            )
@@ -0,0 +1,125 @@
+import hashlib
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from entries import parse_image_reference
+from entries import ReplicationEntry
+
+
+@dataclass
+class SourceJob:
+    """one source image and every entry that replicates it, so it's pulled or streamed once and pushed to all of them"""
+
+    key: str
+    entries: List[ReplicationEntry] = field(default_factory=list)
+
+    @property
+    def source(self) -> ReplicationEntry:
+        """the first entry, which carries the source repository, tag and sha256 shared by all of them"""
+        return self.entries[0]
+
+    @property
+    def force_pull(self) -> bool:
+        return any(entry.force_pull for entry in self.entries)
+
+    @property
+    def priority(self) -> int:
+        return max(entry.priority for entry in self.entries)
+
+
+def source_key(entry: ReplicationEntry) -> str:
+    """identifies the source image of an entry. Pinned digests win over tags, so two tags of one digest are one source.
+    Entries keeping different platforms of one source produce different images, so they are different sources
+
+    Args:
+        entry (ReplicationEntry): entry to identify
+
+    Returns:
+        str: normalized registry/repository@digest or registry/repository:tag
+    """
+    host, path = parse_image_reference(entry.source_repository)
+    key = f"{host}/{path}@sha256:{entry.final_sha256}" if entry.final_sha256 != "" else f"{host}/{path}:{entry.source_tag}"
+    if entry.platforms:
+        key += f" [{','.join(sorted(entry.platforms))}]"
+    return key
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """parses --shard INDEX/COUNT from the CLI
+
+    Args:
+        value (str): e.g. 2/4 for the second of four shards
+
+    Returns:
+        Tuple[int, int]: shard index (starting at 1) and shard count
+    """
+    index, _, count = value.partition("/")
+    if not (index.isdigit() and count.isdigit() and 1 <= int(index) <= int(count)):
+        raise ValueError(f"invalid shard: {value}")
+    return int(index), int(count)
+
+
+def shard_of(key: str, count: int) -> int:
+    """assigns a key to a shard. The hash is stable across hosts and runs, unlike hash(), so every node agrees on the
+    assignment without talking to each other
+
+    Args:
+        key (str): source key of an entry, so duplicate sources land on the same shard
+        count (int): number of shards
+
+    Returns:
+        int: shard index, starting at 1
+    """
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:16], 16) % count + 1
+
+
+def in_shard(key: str, shard: Optional[Tuple[int, int]]) -> bool:
+    """checks whether a key belongs to this run's shard
+
+    Args:
+        key (str): key to assign
+        shard (Optional[Tuple[int, int]]): shard index and count from --shard, or None when not sharding
+
+    Returns:
+        bool: True if this run is responsible for the key
+    """
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def build_plan(entries: List[ReplicationEntry]) -> List[SourceJob]:
+    """groups entries by source image, keeping the order in which each source first appears
+
+    Args:
+        entries (List[ReplicationEntry]): entries to group
+
+    Returns:
+        List[SourceJob]: one job per distinct source
+    """
+    jobs: Dict[str, SourceJob] = dict()
+    for entry in entries:
+        key = source_key(entry)
+        if key not in jobs:
+            jobs[key] = SourceJob(key)
+        jobs[key].entries.append(entry)
+    return list(jobs.values())
+
+
+def print_plan(logger: Any, plan: List[SourceJob]) -> None:
+    """prints the deduplicated work graph
+
+    Args:
+        plan (List[SourceJob]): jobs to print
+    """
+    destinations = sum(len(job.entries) for job in plan)
+    print(f"{len(plan)} sources, {destinations} destinations")
+    for job in plan:
+        print(job.key)
+        for entry in job.entries:
+            flags = [name for name, value in [("forcePull", entry.force_pull), ("forcePush", entry.force_push)] if value]
+            print(f"  -> {entry.destination_endpoint}" + (f" ({', '.join(flags)})" if flags else ""))
+    logger.debug(f"plan has {destinations - len(plan)} duplicate sources")
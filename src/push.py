@@ -1,25 +1,47 @@
 from typing import Any
+from typing import Optional
 
 import docker
 from typing_extensions import LiteralString
 
+from entries import parse_image_reference
+from retry import RetryBudget
+from scheduler import HostLimiter
+from throughput import current_meter
+from throughput import ProgressTracker
+from throughput import transfer_with_retries
+from tracing import span
 
-def push_image(logger: Any, docker_client: Any, repository: LiteralString, tag: LiteralString) -> bool:
-    """_summary_
+
+def push_image(
+    logger: Any,
+    docker_client: Any,
+    repository: LiteralString,
+    tag: LiteralString,
+    limiter: Optional[HostLimiter] = None,
+    budget: Optional[RetryBudget] = None,
+) -> bool:
+    """performs a `docker push`, retrying transient failures. Layers that finished uploading already exist at the
+    destination when it's retried, so only the rest are uploaded again
 
     Args:
         repository (LiteralString): destination repository FQDN
         tag (LiteralString): destination tag
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        budget (Optional[RetryBudget]): retries left for the image
 
     Returns:
         bool: success or failure
     """
-    try:
-        logger.info(f"{repository}:{tag} - pushing image")
-        docker_client.images.push(repository, tag=tag)
-        # TODO if above returns None should this then be an if condition?
-        logger.success(f"{repository}:{tag} - imaged pushed successfully")
-        return True
-    except docker.errors.APIError as e:
-        logger.error(f"{repository}:{tag} - failed to push image")
-        return False
+    with span("push", f"{repository}:{tag}") as traced:
+        try:
+            logger.info(f"{repository}:{tag} - pushing image")
+            host = parse_image_reference(repository)[0]
+            progress = ProgressTracker(current_meter(), "push", host, f"{repository}:{tag}")
+            traced.bytes = transfer_with_retries(limiter, budget, docker_client.api.push, progress, repository, tag=tag)
+            logger.success(f"{repository}:{tag} - imaged pushed successfully")
+            return True
+        except docker.errors.APIError as e:
+            logger.error(f"{repository}:{tag} - failed to push image")
+            traced.outcome = f"error: {type(e).__name__}"
+            return False
@@ -0,0 +1,931 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urljoin
+
+import docker.auth
+import requests
+from requests.adapters import HTTPAdapter
+
+from entries import DOCKER_HUB_HOST
+from entries import parse_image_reference
+from retry import call_with_retries
+from retry import is_transient
+from retry import RetryBudget
+from retry import RetryStats
+from scheduler import HostLimiter
+from scheduler import parse_registry_limits
+from summary import TransferSummary
+from throughput import current_meter
+from tracing import span
+
+MEDIA_TYPE_DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+MEDIA_TYPE_DOCKER_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+MEDIA_TYPE_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_TYPE_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+
+MANIFEST_MEDIA_TYPES = [MEDIA_TYPE_OCI_INDEX, MEDIA_TYPE_DOCKER_MANIFEST_LIST, MEDIA_TYPE_OCI_MANIFEST, MEDIA_TYPE_DOCKER_MANIFEST]
+INDEX_MEDIA_TYPES = [MEDIA_TYPE_OCI_INDEX, MEDIA_TYPE_DOCKER_MANIFEST_LIST]
+
+RATE_LIMIT_RETRIES = 5
+
+
+class RegistryError(Exception):
+    """raised when a registry returns an unexpected response"""
+
+    def __init__(self, message: str, status_code: int = 0) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_auth_challenge(header: str) -> Tuple[str, Dict[str, str]]:
+    """parses a WWW-Authenticate header
+
+    Args:
+        header (str): value of the WWW-Authenticate header
+
+    Returns:
+        Tuple[str, Dict[str, str]]: lowercased scheme and its parameters
+    """
+    scheme, _, params = header.partition(" ")
+    return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+
+class RegistryClient:
+    """talks to a single registry host over the OCI distribution API using one keep-alive session"""
+
+    def __init__(
+        self,
+        logger: Any,
+        host: str,
+        insecure: bool = False,
+        chunk_size: int = 16 * 1024 * 1024,
+        connections: int = 10,
+        limiter: Optional[HostLimiter] = None,
+    ) -> None:
+        self.logger = logger
+        self.host = host
+        self.limiter = limiter
+        self.base_url = f"{'http' if insecure else 'https'}://{host}"
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        # keep one connection alive per worker so concurrent checks and transfers don't reconnect
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "container-image-replicator"
+        self._tokens: Dict[Tuple[str, ...], Tuple[str, float]] = dict()
+        self._lock = threading.Lock()
+        self._credentials: Optional[Tuple[str, str]] = self._load_credentials()
+
+    def _load_credentials(self) -> Optional[Tuple[str, str]]:
+        """looks up credentials for this host from the docker config (including credential helpers)
+
+        Returns:
+            Optional[Tuple[str, str]]: username and password if any are configured
+        """
+        registry = "docker.io" if self.host == DOCKER_HUB_HOST else self.host
+        try:
+            auth_config = docker.auth.load_config().resolve_authconfig(registry)
+        except docker.errors.DockerException as e:
+            self.logger.debug(f"{self.host} - unable to resolve credentials: {e}")
+            return None
+        if not auth_config:
+            return None
+        username = auth_config.get("username") or auth_config.get("Username")
+        password = auth_config.get("password") or auth_config.get("Password")
+        if username and password:
+            return str(username), str(password)
+        return None
+
+    def _fetch_token(self, params: Dict[str, str], scopes: List[str]) -> Tuple[str, float]:
+        """requests a bearer token from the realm advertised by the registry
+
+        Args:
+            params (Dict[str, str]): parameters of the Bearer challenge
+            scopes (List[str]): scopes to request
+
+        Returns:
+            Tuple[str, float]: token and its expiry as a monotonic timestamp
+        """
+        query: List[Tuple[str, str]] = list()
+        if "service" in params:
+            query.append(("service", params["service"]))
+        for scope in scopes or [params.get("scope", "")]:
+            if scope:
+                query.append(("scope", scope))
+        response = self.session.get(params["realm"], params=query, auth=self._credentials, timeout=60)
+        if response.status_code != 200:
+            raise RegistryError(f"{self.host} - failed to obtain token: {response.text}", response.status_code)
+        body = response.json()
+        token = str(body.get("token") or body.get("access_token"))
+        expires_in = int(body.get("expires_in", 60))
+        # refresh a little early so long transfers don't race the expiry
+        return token, time.monotonic() + max(expires_in - 10, 1)
+
+    def request(self, method: str, url: str, scopes: List[str], **kwargs: Any) -> requests.Response:
+        """performs a request, answering auth challenges with cached bearer tokens or basic auth
+
+        Args:
+            method (str): HTTP method
+            url (str): path relative to the registry or an absolute URL returned by it
+            scopes (List[str]): token scopes required for this request
+
+        Returns:
+            requests.Response: the response
+        """
+        url = urljoin(self.base_url, url)
+        key = tuple(sorted(scopes))
+        headers = dict(kwargs.pop("headers", None) or dict())
+        with self._lock:
+            cached = self._tokens.get(key)
+        if cached and cached[1] > time.monotonic():
+            headers["Authorization"] = f"Bearer {cached[0]}"
+        timeout = kwargs.pop("timeout", 300)
+        response = self._send(method, url, headers=headers, timeout=timeout, **kwargs)
+        if response.status_code != 401:
+            return response
+
+        scheme, params = parse_auth_challenge(response.headers.get("WWW-Authenticate", ""))
+        response.close()
+        if scheme == "bearer" and "realm" in params:
+            token = self._fetch_token(params, scopes)
+            with self._lock:
+                self._tokens[key] = token
+            headers["Authorization"] = f"Bearer {token[0]}"
+        elif scheme == "basic" and self._credentials:
+            # basic auth registries want credentials on every request, so stop waiting for the challenge
+            self.session.auth = self._credentials
+        else:
+            return response
+        return self._send(method, url, headers=headers, timeout=timeout, **kwargs)
+
+    def _send(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """sends a request once the host's rate limit allows it, waiting out and retrying 429 responses
+
+        Args:
+            method (str): HTTP method
+            url (str): absolute URL
+
+        Returns:
+            requests.Response: the response
+        """
+        # registries rate limit manifest pulls, Docker Hub doesn't even count HEAD requests, so blob transfers aren't paced
+        paced = method == "GET" and "/manifests/" in url
+        for _ in range(RATE_LIMIT_RETRIES):
+            if self.limiter is not None:
+                self.limiter.wait(self.host, paced)
+            response = self.session.request(method, url, **kwargs)
+            if self.limiter is None or self.limiter.observe(self.host, response.status_code, response.headers) is None:
+                return response
+            response.close()
+        return response
+
+    def head_manifest(self, repository: str, reference: str, known_digest: Optional[str] = None) -> Tuple[Optional[str], int]:
+        """resolves a tag or digest to a manifest digest without downloading it
+
+        Args:
+            repository (str): repository path
+            reference (str): tag or digest
+            known_digest (Optional[str]): digest seen last time, sent as If-None-Match so registries that support it
+                answer 304 if it's unchanged
+
+        Returns:
+            Tuple[Optional[str], int]: manifest digest (None if missing) and the status code
+        """
+        headers = {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)}
+        if known_digest is not None:
+            # registries use the quoted digest as the manifest's ETag
+            headers["If-None-Match"] = f'"{known_digest}"'
+        response = self.request("HEAD", f"/v2/{repository}/manifests/{reference}", [f"repository:{repository}:pull"], headers=headers)
+        if response.status_code == 304:
+            return known_digest, 304
+        if response.status_code == 200:
+            etag = response.headers.get("ETag", "").removeprefix("W/").strip('"')
+            return response.headers.get("Docker-Content-Digest") or (etag if etag.startswith("sha256:") else None), 200
+        return None, response.status_code
+
+    def get_manifest(self, repository: str, reference: str) -> Tuple[bytes, str, str]:
+        """downloads a manifest
+
+        Args:
+            repository (str): repository path
+            reference (str): tag or digest
+
+        Returns:
+            Tuple[bytes, str, str]: raw manifest, media type and digest
+        """
+        response = self.request(
+            "GET",
+            f"/v2/{repository}/manifests/{reference}",
+            [f"repository:{repository}:pull"],
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+        if response.status_code != 200:
+            raise RegistryError(f"{self.host}/{repository}:{reference} - failed to get manifest: {response.text}", response.status_code)
+        raw = response.content
+        media_type = response.headers.get("Content-Type", "").split(";")[0] or MEDIA_TYPE_DOCKER_MANIFEST
+        digest = f"sha256:{hashlib.sha256(raw).hexdigest()}"
+        return raw, media_type, digest
+
+    def put_manifest(self, repository: str, reference: str, raw: bytes, media_type: str) -> None:
+        """uploads a manifest
+
+        Args:
+            repository (str): repository path
+            reference (str): tag or digest to store the manifest under
+            raw (bytes): manifest exactly as it was downloaded
+            media_type (str): manifest media type
+        """
+        response = self.request(
+            "PUT",
+            f"/v2/{repository}/manifests/{reference}",
+            [f"repository:{repository}:pull,push"],
+            headers={"Content-Type": media_type},
+            data=raw,
+        )
+        if response.status_code not in (200, 201):
+            raise RegistryError(f"{self.host}/{repository}:{reference} - failed to put manifest: {response.text}", response.status_code)
+
+    def blob_exists(self, repository: str, digest: str) -> bool:
+        """checks whether a blob is already in a repository
+
+        Args:
+            repository (str): repository path
+            digest (str): blob digest
+
+        Returns:
+            bool: True if the registry has the blob
+        """
+        response = self.request("HEAD", f"/v2/{repository}/blobs/{digest}", [f"repository:{repository}:pull"])
+        return response.status_code == 200
+
+    def mount_blob(self, repository: str, digest: str, from_repository: str) -> bool:
+        """asks the registry to link a blob from another repository instead of uploading it again
+
+        Args:
+            repository (str): repository path to mount into
+            digest (str): blob digest
+            from_repository (str): repository on the same registry that holds the blob
+
+        Returns:
+            bool: True if the blob was mounted
+        """
+        response = self.request(
+            "POST",
+            f"/v2/{repository}/blobs/uploads/",
+            [f"repository:{repository}:pull,push", f"repository:{from_repository}:pull"],
+            params={"mount": digest, "from": from_repository},
+        )
+        if response.status_code == 201:
+            return True
+        if response.status_code == 202 and "Location" in response.headers:
+            # the registry declined the mount and opened a regular upload session instead, which we don't need
+            self.request("DELETE", response.headers["Location"], [f"repository:{repository}:pull,push"])
+        return False
+
+    def get_blob(self, repository: str, digest: str, offset: int = 0) -> requests.Response:
+        """opens a streaming download of a blob
+
+        Args:
+            repository (str): repository path
+            digest (str): blob digest
+            offset (int): byte to start from, to resume an interrupted download. Registries that ignore the range answer
+                200 with the whole blob instead of 206
+
+        Returns:
+            requests.Response: response whose body hasn't been read yet
+        """
+        headers = {"Range": f"bytes={offset}-"} if offset else dict()
+        response = self.request("GET", f"/v2/{repository}/blobs/{digest}", [f"repository:{repository}:pull"], stream=True, headers=headers)
+        if response.status_code not in (200, 206):
+            response.close()
+            raise RegistryError(f"{self.host}/{repository}@{digest} - failed to get blob", response.status_code)
+        return response
+
+    def iter_blob(self, repository: str, digest: str, chunk_size: int, budget: Optional[RetryBudget] = None) -> Iterator[bytes]:
+        return iter_blob_chunks(self, repository, digest, chunk_size, budget)
+
+    def start_upload(self, repository: str, digest: str, budget: Optional[RetryBudget] = None) -> "BlobUpload":
+        return BlobUpload(self, repository, digest, budget)
+
+    def get_labels(self, repository: str, reference: str) -> Optional[Dict[str, str]]:
+        """reads the labels of an image from its config blob. For a multi-arch index the first platform's are used
+
+        Args:
+            repository (str): repository path
+            reference (str): tag or digest
+
+        Returns:
+            Optional[Dict[str, str]]: image labels, or None if the image doesn't exist
+        """
+        try:
+            raw, media_type, _ = self.get_manifest(repository, reference)
+        except RegistryError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        manifest = json.loads(raw)
+        if manifest.get("mediaType", media_type) in INDEX_MEDIA_TYPES:
+            children = [child for child in manifest["manifests"] if child.get("platform", dict()).get("os") != "unknown"]
+            if not children:
+                return None
+            manifest = json.loads(self.get_manifest(repository, children[0]["digest"])[0])
+        response = self.get_blob(repository, manifest["config"]["digest"])
+        try:
+            config = json.loads(response.content)
+        finally:
+            response.close()
+        return dict(config.get("config", dict()).get("Labels") or dict())
+
+    def get_image_size(self, repository: str, reference: str, platforms: List[str], single: bool = False) -> int:
+        """adds up the compressed size of an image's config and layers from its manifests, without downloading any blobs
+
+        Args:
+            repository (str): repository path
+            reference (str): tag or digest
+            platforms (List[str]): os/architecture[/variant] strings of a multi-arch image to count, all of them if empty
+            single (bool): only count the first matching platform, for engines that copy one platform per tag
+
+        Returns:
+            int: size in bytes
+        """
+        raw, media_type, _ = self.get_manifest(repository, reference)
+        manifest = json.loads(raw)
+        if manifest.get("mediaType", media_type) not in INDEX_MEDIA_TYPES:
+            return int(manifest.get("config", dict()).get("size", 0)) + sum(
+                int(layer.get("size", 0)) for layer in manifest.get("layers", list())
+            )
+        # attestations are small, so only the platforms themselves are counted
+        children = [
+            child
+            for child in manifest["manifests"]
+            if child.get("platform", dict()).get("os") != "unknown"
+            and (not platforms or platform_matches(child.get("platform", dict()), platforms))
+        ]
+        if single:
+            children = children[:1]
+        return sum(self.get_image_size(repository, child["digest"], list()) for child in children)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class BlobUpload:
+    """an open chunked upload session for one blob, fed a chunk at a time so one download can feed several uploads.
+    A chunk interrupted by a transient error is resumed from the offset the registry acknowledges, instead of starting over"""
+
+    def __init__(self, client: RegistryClient, repository: str, digest: str, budget: Optional[RetryBudget] = None) -> None:
+        self.client = client
+        self.repository = repository
+        self.digest = digest
+        self.budget = budget
+        self.offset = 0
+        self.scopes = [f"repository:{repository}:pull,push"]
+        response = call_with_retries(budget, self.endpoint, client.request, "POST", f"/v2/{repository}/blobs/uploads/", self.scopes)
+        if response.status_code != 202:
+            raise RegistryError(f"{self.endpoint} - failed to start upload: {response.text}", response.status_code)
+        self.location = response.headers["Location"]
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.client.host}/{self.repository}@{self.digest}"
+
+    def write(self, chunk: bytes) -> None:
+        start = self.offset
+        attempt = 0
+        while True:
+            data = chunk[self.offset - start :]
+            if not data:
+                # the whole chunk arrived before the response got lost, so there's nothing left to resend
+                return
+            error: Exception
+            try:
+                response = self.client.request(
+                    "PATCH",
+                    self.location,
+                    self.scopes,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"{self.offset}-{self.offset + len(data) - 1}",
+                    },
+                    data=data,
+                )
+                if response.status_code == 202:
+                    self.location = response.headers["Location"]
+                    self.offset += len(data)
+                    return
+                error = RegistryError(f"{self.endpoint} - failed to upload chunk: {response.text}", response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            # 416 means the registry's offset differs from ours, which resuming from its offset also fixes
+            resumable = is_transient(error) or getattr(error, "status_code", None) == 416
+            if self.budget is None or not resumable or not self.budget.spend(self.endpoint, error, attempt):
+                raise error
+            attempt += 1
+            self.resume(start, start + len(chunk))
+
+    def resume(self, chunk_start: int, chunk_end: int) -> None:
+        """asks the registry how much of the upload it has, and continues from there. Only the current chunk is still in
+        memory, so if the registry lost more than that, the upload can't be resumed and the blob has to be copied again
+
+        Args:
+            chunk_start (int): offset of the first byte of the current chunk
+            chunk_end (int): offset after its last byte
+        """
+        response = call_with_retries(self.budget, self.endpoint, self.client.request, "GET", self.location, self.scopes)
+        if response.status_code != 204:
+            raise RegistryError(f"{self.endpoint} - upload session lost, unable to resume: {response.text}", response.status_code)
+        self.location = response.headers.get("Location", self.location)
+        # Range is inclusive, e.g. 0-1048575 once the first MiB arrived
+        acknowledged = int(response.headers.get("Range", "0--1").split("-", 1)[1]) + 1
+        if not chunk_start <= acknowledged <= chunk_end:
+            raise RegistryError(f"{self.endpoint} - registry has {acknowledged} bytes of the upload, unable to resume from {chunk_start}")
+        if self.budget is not None:
+            self.budget.stats.resumed(acknowledged)
+            self.budget.stats.resent(chunk_end - acknowledged)
+        self.client.logger.debug(f"{self.endpoint} - resuming upload at byte {acknowledged}")
+        self.offset = acknowledged
+
+    def finish(self) -> int:
+        """completes the upload, which makes the registry verify the digest
+
+        Returns:
+            int: bytes uploaded
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.client.request(
+                    "PUT", self.location, self.scopes, params={"digest": self.digest}, headers={"Content-Type": "application/octet-stream"}
+                )
+                if response.status_code == 201:
+                    return self.offset
+                raise RegistryError(f"{self.endpoint} - failed to complete upload: {response.text}", response.status_code)
+            except (RegistryError, requests.ConnectionError, requests.Timeout) as e:
+                if self.budget is None or not is_transient(e) or not self.budget.spend(self.endpoint, e, attempt):
+                    raise
+                attempt += 1
+                # the upload may have completed even though the response got lost
+                if self.client.blob_exists(self.repository, self.digest):
+                    return self.offset
+
+
+class RegistryPool:
+    """hands out one RegistryClient per registry host so connections and tokens are reused across threads. With
+    --export-dir or --import-dir, an ImageLayout stands in for every destination or source registry
+
+    Args:
+        logger (Any): logger
+        arguments (Any): CLI arguments
+        export_layout (Any): ImageLayout to write every image to instead of its destination
+        import_layout (Any): ImageLayout to read every image from instead of its source
+    """
+
+    def __init__(self, logger: Any, arguments: Any, export_layout: Any = None, import_layout: Any = None) -> None:
+        self.logger = logger
+        self.export_layout = export_layout
+        self.import_layout = import_layout
+        self.insecure_registries = set(getattr(arguments, "insecure_registries", None) or list())
+        self.chunk_size = int(getattr(arguments, "blob_chunk_size", 16)) * 1024 * 1024
+        self.connections = max(int(getattr(arguments, "max_workers", 1)), int(getattr(arguments, "check_workers", 1)))
+        self.platform_workers = int(getattr(arguments, "platform_workers", 4))
+        self.limiter = HostLimiter(
+            logger,
+            int(getattr(arguments, "registry_max_workers", 0)) or int(getattr(arguments, "max_workers", 1)),
+            parse_registry_limits(getattr(arguments, "registry_limits", None) or list()),
+        )
+        self.retries = int(getattr(arguments, "retries", 5))
+        self.retry_backoff = float(getattr(arguments, "retry_backoff", 1.0))
+        self.retry_stats = RetryStats()
+        self._clients: Dict[str, RegistryClient] = dict()
+        self._blob_repositories: Dict[Tuple[str, str], str] = dict()
+        self._blob_locks: Dict[Tuple[str, str], threading.Lock] = dict()
+        self._lock = threading.Lock()
+
+    def retry_budget(self) -> RetryBudget:
+        """hands out the retry budget for one image"""
+        return RetryBudget(self.logger, self.retry_stats, self.retries, self.retry_backoff)
+
+    def get(self, host: str) -> RegistryClient:
+        with self._lock:
+            if host not in self._clients:
+                insecure = host in self.insecure_registries or host.startswith(("localhost", "127."))
+                self._clients[host] = RegistryClient(
+                    self.logger, host, insecure=insecure, chunk_size=self.chunk_size, connections=self.connections, limiter=self.limiter
+                )
+            return self._clients[host]
+
+    def resolve_source(self, repository: str) -> Tuple[Any, str]:
+        """finds where to read a source repository from
+
+        Args:
+            repository (str): source repository as given in the entry
+
+        Returns:
+            Tuple[Any, str]: RegistryClient or ImageLayout, and the repository path in it
+        """
+        if self.import_layout is not None:
+            return self.import_layout, repository
+        host, path = parse_image_reference(repository)
+        return self.get(host), path
+
+    def resolve_destination(self, repository: str) -> Tuple[Any, str]:
+        """finds where to write a destination repository to
+
+        Args:
+            repository (str): destination repository as given in the entry
+
+        Returns:
+            Tuple[Any, str]: RegistryClient or ImageLayout, and the repository path in it
+        """
+        if self.export_layout is not None:
+            return self.export_layout, repository
+        host, path = parse_image_reference(repository)
+        return self.get(host), path
+
+    def blob_lock(self, host: str, digest: str) -> threading.Lock:
+        """returns the lock serializing work on one blob at one registry, so shared layers are uploaded once and mounted after
+
+        Args:
+            host (str): registry host
+            digest (str): blob digest
+
+        Returns:
+            threading.Lock: lock for this blob
+        """
+        with self._lock:
+            return self._blob_locks.setdefault((host, digest), threading.Lock())
+
+    def blob_repository(self, host: str, digest: str) -> Optional[str]:
+        """returns a repository on a registry known to hold a blob
+
+        Args:
+            host (str): registry host
+            digest (str): blob digest
+
+        Returns:
+            Optional[str]: repository path, or None if the blob hasn't been seen on that registry
+        """
+        with self._lock:
+            return self._blob_repositories.get((host, digest))
+
+    def record_blob(self, host: str, repository: str, digest: str) -> None:
+        with self._lock:
+            self._blob_repositories[(host, digest)] = repository
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+        if self.export_layout is not None:
+            self.export_layout.close()
+
+
+def platform_matches(platform: Dict[str, Any], platforms: List[str]) -> bool:
+    """checks the platform of an index child against a platform filter. A filter without a variant matches every variant
+
+    Args:
+        platform (Dict[str, Any]): platform object of the child descriptor
+        platforms (List[str]): os/architecture[/variant] strings to keep
+
+    Returns:
+        bool: True if the child should be kept
+    """
+    for wanted in platforms:
+        parts = wanted.split("/")
+        if platform.get("os") != parts[0] or platform.get("architecture") != parts[1]:
+            continue
+        if len(parts) == 2 or platform.get("variant") == parts[2]:
+            return True
+    return False
+
+
+def filter_index(raw: bytes, media_type: str, platforms: List[str]) -> Tuple[bytes, str]:
+    """drops the children of a multi-arch index that aren't in the platform filter, along with attestation manifests
+    describing them. Single-platform manifests and indexes that keep every child are returned byte for byte, so their
+    digest still matches the source
+
+    Args:
+        raw (bytes): manifest as downloaded from the source
+        media_type (str): media type the registry returned it with
+        platforms (List[str]): os/architecture[/variant] strings to keep, all of them if empty
+
+    Returns:
+        Tuple[bytes, str]: manifest to store at the destination and its digest
+    """
+    manifest = json.loads(raw)
+    if not platforms or manifest.get("mediaType", media_type) not in INDEX_MEDIA_TYPES:
+        return raw, f"sha256:{hashlib.sha256(raw).hexdigest()}"
+
+    kept = [child for child in manifest["manifests"] if platform_matches(child.get("platform", dict()), platforms)]
+    kept_digests = {child["digest"] for child in kept}
+    # buildkit stores provenance and SBOMs as unknown/unknown children that point at the image they describe
+    kept += [
+        child
+        for child in manifest["manifests"]
+        if child.get("annotations", dict()).get("vnd.docker.reference.digest") in kept_digests and child not in kept
+    ]
+    if not kept:
+        raise RegistryError(f"no manifest in the index matches platforms {', '.join(platforms)}")
+    if len(kept) == len(manifest["manifests"]):
+        return raw, f"sha256:{hashlib.sha256(raw).hexdigest()}"
+
+    manifest["manifests"] = [child for child in manifest["manifests"] if child in kept]
+    filtered = json.dumps(manifest, separators=(",", ":")).encode("utf-8")
+    return filtered, f"sha256:{hashlib.sha256(filtered).hexdigest()}"
+
+
+def iter_blob_chunks(
+    source: RegistryClient, repository: str, digest: str, chunk_size: int, budget: Optional[RetryBudget] = None
+) -> Iterator[bytes]:
+    """downloads a blob and re-slices it into fixed size chunks so each PATCH carries a predictable amount of data.
+    A download interrupted by a transient error is resumed with a range request from the last byte received
+
+    Args:
+        source (RegistryClient): source registry
+        repository (str): source repository path
+        digest (str): blob digest
+        chunk_size (int): bytes per chunk
+        budget (Optional[RetryBudget]): retries left for the image
+
+    Yields:
+        Iterator[bytes]: chunks of at most chunk_size bytes
+    """
+    endpoint = f"{source.host}/{repository}@{digest}"
+    buffer = bytearray()
+    received = 0
+    skip = 0  # bytes to drop from a restarted download whose registry ignored the range
+    attempt = 0
+    response = call_with_retries(budget, endpoint, source.get_blob, repository, digest)
+    try:
+        while True:
+            try:
+                for data in response.iter_content(chunk_size=1024 * 1024):
+                    if skip:
+                        data, skip = data[skip:], max(skip - len(data), 0)
+                    received += len(data)
+                    buffer.extend(data)
+                    while len(buffer) >= chunk_size:
+                        yield bytes(buffer[:chunk_size])
+                        del buffer[:chunk_size]
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                response.close()
+                if budget is None or not budget.spend(endpoint, e, attempt):
+                    raise
+                attempt += 1
+                response = call_with_retries(budget, endpoint, source.get_blob, repository, digest, received)
+                if response.status_code == 206:
+                    budget.stats.resumed(received)
+                else:
+                    budget.stats.resent(received)
+                    skip = received
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        response.close()
+
+
+def reuse_blob(
+    logger: Any,
+    registry_pool: RegistryPool,
+    summary: TransferSummary,
+    destination: RegistryClient,
+    repository: str,
+    digest: str,
+    size: int,
+    budget: Optional[RetryBudget] = None,
+) -> bool:
+    """makes a blob available in a repository without uploading it, if the registry already has it somewhere we know of
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients and known blob locations
+        summary (TransferSummary): counters for the run summary
+        destination (RegistryClient): destination registry
+        repository (str): destination repository path
+        digest (str): blob digest
+        size (int): blob size from the manifest
+        budget (Optional[RetryBudget]): retries left for the image
+
+    Returns:
+        bool: True if the blob is now in the repository
+    """
+    endpoint = f"{destination.host}/{repository}@{digest}"
+    if call_with_retries(budget, endpoint, destination.blob_exists, repository, digest):
+        logger.debug(f"{endpoint} - blob exists, skipping")
+        summary.skipped(size)
+        registry_pool.record_blob(destination.host, repository, digest)
+        return True
+
+    from_repository = registry_pool.blob_repository(destination.host, digest)
+    if from_repository is not None and from_repository != repository:
+        if call_with_retries(budget, endpoint, destination.mount_blob, repository, digest, from_repository):
+            logger.debug(f"{endpoint} - blob mounted from {from_repository}")
+            summary.mounted(size)
+            registry_pool.record_blob(destination.host, repository, digest)
+            return True
+    return False
+
+
+def stream_blob(
+    logger: Any,
+    registry_pool: RegistryPool,
+    summary: TransferSummary,
+    source: RegistryClient,
+    source_repository: str,
+    targets: List[Tuple[RegistryClient, str]],
+    digest: str,
+    budget: Optional[RetryBudget] = None,
+) -> None:
+    """downloads a blob once and uploads each chunk to every target as it arrives
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients and known blob locations
+        summary (TransferSummary): counters for the run summary
+        source (RegistryClient): source registry
+        source_repository (str): source repository path
+        targets (List[Tuple[RegistryClient, str]]): destination registries and repository paths
+        digest (str): blob digest
+        budget (Optional[RetryBudget]): retries left for the image
+    """
+    started = time.monotonic()
+    uploads = [destination.start_upload(repository, digest, budget) for destination, repository in targets]
+    chunk_size = min(destination.chunk_size for destination, _ in targets)
+    chunks = source.iter_blob(source_repository, digest, chunk_size, budget)
+    # counted as they arrive, iter_blob_chunks carries on from where an interrupted download left off
+    pulled = 0
+    if len(uploads) == 1:
+        for chunk in chunks:
+            pulled += len(chunk)
+            uploads[0].write(chunk)
+    else:
+        with ThreadPoolExecutor(max_workers=len(uploads)) as thread_pool:
+            for chunk in chunks:
+                pulled += len(chunk)
+                # list() waits for every destination to take the chunk, and re-raises the first failure
+                list(thread_pool.map(lambda upload: upload.write(chunk), uploads))
+
+    meter = current_meter()
+    for upload in uploads:
+        transferred = upload.finish()
+        logger.debug(f"{upload.endpoint} - copied {transferred} bytes")
+        summary.transferred(transferred)
+        registry_pool.record_blob(upload.client.host, upload.repository, digest)
+        meter.record("push", upload.client.host, f"{upload.client.host}/{upload.repository}", started, time.monotonic(), transferred)
+    meter.record("pull", source.host, f"{source.host}/{source_repository}", started, time.monotonic(), pulled)
+
+
+def copy_blob(
+    logger: Any,
+    registry_pool: RegistryPool,
+    summary: TransferSummary,
+    source: RegistryClient,
+    source_repository: str,
+    targets: List[Tuple[RegistryClient, str]],
+    descriptor: Dict[str, Any],
+    budget: Optional[RetryBudget] = None,
+) -> None:
+    """makes a blob available in every target repository. The source is read at most once: the blob is streamed to one
+    repository per destination registry that doesn't have it, and mounted from there into the others
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients and known blob locations
+        summary (TransferSummary): counters for the run summary
+        source (RegistryClient): source registry
+        source_repository (str): source repository path
+        targets (List[Tuple[RegistryClient, str]]): destination registries and repository paths
+        descriptor (Dict[str, Any]): blob descriptor from the manifest
+        budget (Optional[RetryBudget]): retries left for the image
+    """
+    digest = str(descriptor["digest"])
+    size = int(descriptor.get("size", 0))
+    endpoint = f"{source.host}/{source_repository}@{digest}"
+
+    with ExitStack() as stack, span("blob", endpoint) as traced:
+        # sorted, so two jobs sharing destinations can't deadlock on each other's locks
+        for host in sorted({destination.host for destination, _ in targets}):
+            stack.enter_context(registry_pool.blob_lock(host, digest))
+
+        streamed: Dict[str, Tuple[RegistryClient, str]] = dict()
+        mount_later = list()
+        for destination, repository in targets:
+            if reuse_blob(logger, registry_pool, summary, destination, repository, digest, size, budget):
+                continue
+            if destination.host in streamed:
+                mount_later.append((destination, repository))
+            else:
+                streamed[destination.host] = (destination, repository)
+
+        traced.outcome = "streamed" if streamed else "reused"
+        traced.bytes = size * len(streamed)
+        # an upload that can't be resumed starts over, with a new session for every target
+        if streamed:
+            call_with_retries(
+                budget,
+                endpoint,
+                stream_blob,
+                logger,
+                registry_pool,
+                summary,
+                source,
+                source_repository,
+                list(streamed.values()),
+                digest,
+                budget,
+                resend=size * len(streamed),
+            )
+        for destination, repository in mount_later:
+            if not reuse_blob(logger, registry_pool, summary, destination, repository, digest, size, budget):
+                call_with_retries(
+                    budget,
+                    endpoint,
+                    stream_blob,
+                    logger,
+                    registry_pool,
+                    summary,
+                    source,
+                    source_repository,
+                    [(destination, repository)],
+                    digest,
+                    budget,
+                    resend=size,
+                )
+
+
+def copy_manifest(
+    logger: Any,
+    registry_pool: RegistryPool,
+    summary: TransferSummary,
+    source: RegistryClient,
+    source_repository: str,
+    targets: List[Tuple[RegistryClient, str]],
+    reference: str,
+    tags: List[Optional[str]],
+    platforms: Optional[List[str]] = None,
+    budget: Optional[RetryBudget] = None,
+) -> str:
+    """copies a manifest and everything it references to every target, children and blobs first so the manifest is never
+    dangling. The children of a multi-arch index are copied in parallel and the index is only written once all of them are there
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients and known blob locations
+        summary (TransferSummary): counters for the run summary
+        source (RegistryClient): source registry
+        source_repository (str): source repository path
+        targets (List[Tuple[RegistryClient, str]]): destination registries and repository paths
+        reference (str): tag or digest in the source repository
+        tags (List[Optional[str]]): tag to store the manifest under for each target, or None to store it by digest
+        platforms (Optional[List[str]]): os/architecture[/variant] to keep from a multi-arch index, all of them if empty
+        budget (Optional[RetryBudget]): retries left for the image, shared by its platforms and blobs
+
+    Returns:
+        str: digest of the copied manifest
+    """
+    endpoint = f"{source.host}/{source_repository}:{reference}"
+    raw, media_type, _ = call_with_retries(budget, endpoint, source.get_manifest, source_repository, reference)
+    raw, digest = filter_index(raw, media_type, platforms or list())
+    manifest = json.loads(raw)
+    media_type = manifest.get("mediaType", media_type)
+
+    if media_type in INDEX_MEDIA_TYPES:
+        children = [child["digest"] for child in manifest["manifests"]]
+        logger.debug(f"{endpoint} - copying {len(children)} platform manifests")
+        with ThreadPoolExecutor(max_workers=max(min(len(children), registry_pool.platform_workers), 1)) as thread_pool:
+            futures = [
+                thread_pool.submit(
+                    copy_manifest,
+                    logger,
+                    registry_pool,
+                    summary,
+                    source,
+                    source_repository,
+                    targets,
+                    child,
+                    [None] * len(targets),
+                    None,
+                    budget,
+                )
+                for child in children
+            ]
+            # result() re-raises, so a failed platform keeps the index from being written
+            for future in futures:
+                future.result()
+    else:
+        for descriptor in [manifest["config"]] + list(manifest.get("layers", list())):
+            copy_blob(logger, registry_pool, summary, source, source_repository, targets, descriptor, budget)
+
+    for (destination, repository), tag in zip(targets, tags):
+        call_with_retries(budget, f"{destination.host}/{repository}", destination.put_manifest, repository, tag or digest, raw, media_type)
+    return digest
@@ -1,86 +1,429 @@
-import re
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import wait
-from sys import exit
+import threading
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from functools import partial
 from typing import Any
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
 from typing import Tuple
 
 import docker
+import requests
 from typing_extensions import LiteralString
 
+from check import check_destinations
+from check import DESTINATION_EXISTS
+from check import DESTINATION_MISSING
+from check import measure_sources
+from engines import DockerEngine
+from engines import EnginePool
+from entries import build_replication_entry
+from entries import parse_image_reference
+from entries import ReplicationEntry
+from layout import ImageLayout
+from localcache import LocalImageCache
+from localimages import LocalImageIndex
+from ordering import ORDER_FILE
+from ordering import order_jobs
+from ordering import ScheduleReport
+from pipeline import Pipeline
+from pipeline import Stage
+from plan import build_plan
+from plan import in_shard
+from plan import source_key
+from plan import SourceJob
 from push import push_image
+from registry import copy_manifest
+from registry import RegistryError
+from registry import RegistryPool
+from results import RESULT_FAILED
+from results import RESULT_REPLICATED
+from results import RESULT_UP_TO_DATE
+from results import RunResults
+from retry import call_with_retries
+from retry import RetryBudget
+from scheduler import HostLimiter
+from state import STATE_CONFIRMED
+from state import SyncState
+from summary import TransferSummary
+from throughput import current_meter
+from throughput import ProgressTracker
+from throughput import transfer_with_retries
+from tracing import span
+
+
+def parse_image_list_replicate(logger: Any, image: Dict[LiteralString, Any]) -> Optional[str]:
+    """validates a replication entry from the input file
 
+    Args:
+        image (Dict[LiteralString, Any]): single element of images from the input file
 
-def parse_image_list_replicate(logger: Any, image: Dict[LiteralString, Any]) -> None:
+    Returns:
+        Optional[str]: what's wrong with the entry, or None if it's valid
+    """
     try:
         isinstance(image["source"]["repository"], str)
         isinstance(image["source"]["tag"], str)
+        isinstance(image["destination"]["repository"], str)
         try:
             isinstance(image["destination"]["tag"], str | int | float)
         except KeyError:
             logger.debug("no destination tag provided - using source tag as a fallback")
-    except KeyError as e:
-        logger.critical(f"syntax error in list file provided: {e}")
-        exit(1)
+    except (KeyError, TypeError) as e:
+        return f"syntax error in list file provided: missing {e}"
+    return None
+
+
+@dataclass
+class DaemonJob:
+    """a source image travelling through the daemon pipeline on the engine it was routed to, picking up the local image on
+    the way"""
+
+    job: SourceJob
+    destination_statuses: List[str]
+    engine: DockerEngine
+    budget: Optional[RetryBudget] = None
+    local_image: Any = None
+    started: float = 0.0
+    pushes_left: int = 0
+    succeeded: bool = True
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def pushed(self, succeeded: bool) -> None:
+        """counts a finished push, and records the task on its engine once the last one is done"""
+        with self._lock:
+            self.pushes_left -= 1
+            self.succeeded = self.succeeded and succeeded
+            if self.pushes_left > 0:
+                return
+        self.engine.finished(time.monotonic() - self.started, self.succeeded)
+
+
+def check_stage(logger: Any, arguments: Any, state: Optional[SyncState], results: RunResults, job: DaemonJob) -> Optional[DaemonJob]:
+    """figure out whether to force pull/push, and if not, check destinations to see if pushing is required
 
+    Args:
+        arguments (Any): cli arguments
+        state (Optional[SyncState]): state file to record entries found at the destination in
+        results (RunResults): outcome of each entry
+        job (DaemonJob): source with the check phase result of each destination, the daemon is only asked when it's inconclusive
 
-def check_remote(
+    Returns:
+        Optional[DaemonJob]: the job with only the destinations that need pushing, or None if there are none
+    """
+    entries = list()
+    for entry, destination_status in zip(job.job.entries, job.destination_statuses):
+        if arguments.force_pull_push or entry.forced:
+            entries.append(entry)
+            continue
+
+        if destination_status == DESTINATION_MISSING:
+            verify_destination, status_code = DESTINATION_MISSING, 404
+        else:
+            with span("verify", entry.destination_endpoint) as traced:
+                verify_destination, status_code = verify_destination_image(
+                    logger, job.engine.client, entry.destination_endpoint, job.budget
+                )
+                traced.outcome = verify_destination
+        if verify_destination == "exists":
+            logger.info(f"{entry.destination_endpoint} - destination image exists in registry")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_UP_TO_DATE)
+            if state is not None:
+                state.record(entry)
+        elif verify_destination == "does not exist" or status_code == 404:
+            logger.warning(f"{entry.destination_endpoint} - destination image not found in registry")
+            entries.append(entry)
+        else:
+            logger.error(f"{entry.destination_endpoint} - {verify_destination}")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_FAILED, verify_destination)
+
+    if not entries:
+        return None
+    job.job = SourceJob(job.job.key, entries)
+    return job
+
+
+def pull_stage(
     logger: Any,
     arguments: Any,
-    docker_api: Any,
-    docker_client: Any,
-    source_endpoint: LiteralString,
-    source_repository: LiteralString,
-    source_tag: LiteralString,
-    destination_endpoint: LiteralString,
-    destination_repository: LiteralString,
-    destination_tag: LiteralString,
-    final_sha256: LiteralString,
-    force_pull: bool,
-    force_push: bool,
+    limiter: Optional[HostLimiter],
+    report: ScheduleReport,
+    results: RunResults,
+    job: DaemonJob,
+) -> Optional[DaemonJob]:
+    """makes sure the source image is available locally on the job's engine, pulling it at most once for all of its
+    destinations
+
+    Args:
+        arguments (Any): cli arguments
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        report (ScheduleReport): records when the job started
+        results (RunResults): outcome of each entry
+        job (DaemonJob): job to pull
+
+    Returns:
+        Optional[DaemonJob]: the job with its local image, or None if it couldn't be found or pulled
+    """
+    source = job.job.source
+    platform = source.platforms[0] if source.platforms else None
+    engine = job.engine
+    report.start(job.job.key)
+    job.started = time.monotonic()
+    if arguments.force_pull_push or job.job.force_pull:
+        pull_image(logger, engine.client, source.source_repository, source.source_tag, limiter, platform, engine.local_images, job.budget)
+    job.local_image = verify_local_image(
+        logger,
+        engine.client.api,
+        engine.client,
+        engine.local_images,
+        source.source_endpoint,
+        source.source_repository,
+        source.source_tag,
+        source.final_sha256,
+        limiter,
+        platform,
+        job.budget,
+    )
+    if job.local_image is None:
+        for entry in job.job.entries:
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_FAILED, "source image could not be pulled")
+        report.finish(job.job.key)
+        engine.finished(time.monotonic() - job.started, False)
+        return None
+    if engine.cache is not None:
+        engine.cache.acquired(job.local_image, len(job.job.entries))
+    return job
+
+
+def pull_hosts(job: DaemonJob) -> List[str]:
+    """the registry a job is pulled from, so pull workers only take jobs whose registry has a free slot"""
+    return [parse_image_reference(job.job.source.source_repository)[0]]
+
+
+def tag_stage(logger: Any, job: DaemonJob) -> List[Tuple[DaemonJob, ReplicationEntry]]:
+    """re-tags the local image for every destination
+
+    Args:
+        job (DaemonJob): job with its local image
+
+    Returns:
+        List[Tuple[DaemonJob, ReplicationEntry]]: one push per destination, so the push stage handles them concurrently
+    """
+    for entry in job.job.entries:
+        with span("tag", entry.destination_endpoint):
+            job.local_image.tag(repository=entry.destination_repository, tag=entry.destination_tag)
+        job.engine.local_images.tagged(job.local_image, entry.destination_endpoint)
+        logger.debug(f"{entry.source_endpoint} - tagged as {entry.destination_endpoint}")
+    job.pushes_left = len(job.job.entries)
+    return [(job, entry) for entry in job.job.entries]
+
+
+def push_stage(
+    logger: Any,
+    limiter: Optional[HostLimiter],
+    report: ScheduleReport,
+    state: Optional[SyncState],
+    results: RunResults,
+    push: Tuple[DaemonJob, ReplicationEntry],
+) -> None:
+    """pushes the re-tagged image to one destination from the job's engine
+
+    Args:
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        report (ScheduleReport): records when the job's last push finished
+        state (Optional[SyncState]): state file to record pushed entries in
+        results (RunResults): outcome of each entry
+        push (Tuple[DaemonJob, ReplicationEntry]): tagged job and the destination to push to
+    """
+    job, entry = push
+    pushed = False
+    try:
+        pushed = push_image(logger, job.engine.client, entry.destination_repository, entry.destination_tag, limiter, job.budget)
+        if pushed:
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_REPLICATED)
+            if state is not None:
+                state.record(entry)
+        else:
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_FAILED, "push failed")
+    finally:
+        report.finish(job.job.key)
+        job.pushed(pushed)
+        if job.engine.cache is not None:
+            job.engine.cache.pushed(job.local_image)
+
+
+def record_failures(logger: Any, results: RunResults, stage: str, entries: List[ReplicationEntry], error: Exception) -> None:
+    """records entries as failed because a stage raised, leaving those that already have an outcome alone
+
+    Args:
+        results (RunResults): outcome of each entry
+        stage (str): stage that raised
+        entries (List[ReplicationEntry]): entries the stage was working on
+        error (Exception): what it raised
+    """
+    for entry in entries:
+        if results.pending(entry.source_endpoint, entry.destination_endpoint):
+            logger.error(f"{entry.source_endpoint} - {stage} failed, not replicated to {entry.destination_endpoint}: {error}")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_FAILED, f"{stage} failed: {error}")
+
+
+def job_failed(logger: Any, report: ScheduleReport, results: RunResults, stage: str, job: DaemonJob, error: Exception) -> None:
+    """handles a job whose check, pull or tag stage raised, recording its entries as failed and giving back what the job
+    held on its engine
+
+    Args:
+        report (ScheduleReport): records when the job finished
+        results (RunResults): outcome of each entry
+        stage (str): stage that raised
+        job (DaemonJob): job the stage was working on
+        error (Exception): what it raised
+    """
+    record_failures(logger, results, stage, job.job.entries, error)
+    if not job.started:
+        # still in the check stage, the job hasn't started on its engine
+        return
+    report.finish(job.job.key)
+    job.engine.finished(time.monotonic() - job.started, False)
+    if job.local_image is not None and job.engine.cache is not None:
+        # the pull stage pinned the image once for every destination
+        for _ in job.job.entries:
+            job.engine.cache.pushed(job.local_image)
+
+
+def push_failed(logger: Any, results: RunResults, push: Tuple[DaemonJob, ReplicationEntry], error: Exception) -> None:
+    """handles a push that raised, push_stage has already given back what it held
+
+    Args:
+        results (RunResults): outcome of each entry
+        push (Tuple[DaemonJob, ReplicationEntry]): job and the destination it was pushed to
+        error (Exception): what it raised
+    """
+    record_failures(logger, results, "push", [push[1]], error)
+
+
+def push_hosts(push: Tuple[DaemonJob, ReplicationEntry]) -> List[str]:
+    """the registry a push goes to, so push workers only take pushes whose registry has a free slot"""
+    return [parse_image_reference(push[1].destination_repository)[0]]
+
+
+def job_hosts(registry_pool: RegistryPool, job: SourceJob) -> List[str]:
+    """lists the hosts a registry engine job reads from and writes to
+
+    Args:
+        registry_pool (RegistryPool): shared registry clients
+        job (SourceJob): job to copy
+
+    Returns:
+        List[str]: source host and destination hosts, a slot is held on each of them for the whole copy
+    """
+    hosts = [registry_pool.resolve_source(job.source.source_repository)[0].host]
+    for entry in job.entries:
+        hosts.append(registry_pool.resolve_destination(entry.destination_repository)[0].host)
+    return hosts
+
+
+def copy_stage(
+    logger: Any,
+    arguments: Any,
+    registry_pool: RegistryPool,
+    report: ScheduleReport,
+    summary: TransferSummary,
+    state: Optional[SyncState],
+    results: RunResults,
+    job: SourceJob,
+) -> None:
+    """copies one job with the registry engine once its hosts have a free slot
+
+    Args:
+        arguments (Any): cli arguments
+        registry_pool (RegistryPool): shared registry clients
+        report (ScheduleReport): records when the job started and finished
+        summary (TransferSummary): counters for the run summary
+        state (Optional[SyncState]): state file to record copied entries in
+        results (RunResults): outcome of each entry
+        job (SourceJob): job to copy
+    """
+    report.run(job.key, registry_copy, logger, arguments, registry_pool, summary, state, results, job)
+
+
+def copy_failed(logger: Any, results: RunResults, job: SourceJob, error: Exception) -> None:
+    """handles a registry engine job that raised something registry_copy doesn't handle itself
+
+    Args:
+        results (RunResults): outcome of each entry
+        job (SourceJob): job that was being copied
+        error (Exception): what it raised
+    """
+    record_failures(logger, results, "copy", job.entries, error)
+
+
+def registry_copy(
+    logger: Any,
+    arguments: Any,
+    registry_pool: RegistryPool,
+    summary: TransferSummary,
+    state: Optional[SyncState],
+    results: RunResults,
+    job: SourceJob,
 ) -> bool:
-    """figure out whether to force pull/push, and if not, check destination to see if pushing is required
+    """replicates an image registry-to-registry without going through the docker daemon, reading the source once for
+    all of the job's destinations
 
     Args:
         arguments (Any): cli arguments
-        docker_api (Any): api object
-        source_endpoint (LiteralString): source endpoint to look for (repository+tag)
-        source_repository (LiteralString): source repository to look for
-        source_tag (LiteralString): source tag to look for
-        destination_endpoint (LiteralString): full endpoint URI including tag
-        destination_repository (LiteralString): destination repository for re-tagging
-        destination_tag (LiteralString): destination tag tag for re-tagging
-        final_sha256 (LiteralString): sha256 to look for
-        force_pull (bool): force pull, used for immutable tags
-        force_push (bool): force push, used for immutable tags
+        registry_pool (RegistryPool): shared registry clients
+        summary (TransferSummary): counters for the run summary
+        state (Optional[SyncState]): state file to record copied entries in
+        results (RunResults): outcome of each entry
+        job (SourceJob): source and the entries to copy it to, already known to be missing or outdated at their destinations
+
+    Returns:
+        bool: True if every destination succeeded
     """
-    if arguments.force_pull_push or force_pull:
-        pull_image(logger, docker_client, source_repository, source_tag)
-    if arguments.force_pull_push or force_push:
-        push_image(logger, docker_client, destination_repository, destination_tag)
-
-    verify_destination, status_code = verify_destination_image(logger, docker_client, destination_endpoint)
-    if verify_destination == "exists":
-        logger.info(f"{destination_endpoint} - destination image exists in registry")
-    elif verify_destination == "does not exist" or status_code == 404:
-        logger.warning(f"{destination_endpoint} - destination image not found in registry")
-        # see if image exists locally and pull from the source registry if it doesn't
-        verify_local_image(
-            logger,
-            docker_api,
-            docker_client,
-            source_endpoint,
-            source_repository,
-            source_tag,
-            destination_repository,
-            destination_tag,
-            final_sha256,
+    source, source_path = registry_pool.resolve_source(job.source.source_repository)
+    source_reference = f"sha256:{job.source.final_sha256}" if job.source.final_sha256 != "" else job.source.source_tag
+    targets = list()
+    for entry in job.entries:
+        targets.append(registry_pool.resolve_destination(entry.destination_repository))
+
+    try:
+        with span("copy", job.source.source_endpoint):
+            logger.info(f"{job.source.source_endpoint} - copying image to {', '.join(entry.destination_endpoint for entry in job.entries)}")
+            digest = copy_manifest(
+                logger,
+                registry_pool,
+                summary,
+                source,
+                source_path,
+                targets,
+                source_reference,
+                [entry.destination_tag for entry in job.entries],
+                job.source.platforms,
+                registry_pool.retry_budget(),
+            )
+    except (RegistryError, requests.RequestException) as e:
+        if len(job.entries) == 1:
+            logger.error(f"{job.source.destination_endpoint} - failed to copy image: {e}")
+            results.record(job.source.source_endpoint, job.source.destination_endpoint, RESULT_FAILED, str(e))
+            return False
+        # don't let one broken destination fail the others
+        logger.warning(f"{job.source.source_endpoint} - failed to copy image to all destinations at once, retrying one at a time: {e}")
+        return all(
+            [registry_copy(logger, arguments, registry_pool, summary, state, results, SourceJob(job.key, [entry])) for entry in job.entries]
         )
-        push_image(logger, docker_client, destination_repository, destination_tag)
-    else:
-        logger.error(f"{destination_endpoint} - {verify_destination}")
 
+    for entry in job.entries:
+        if not entry.platforms:
+            entry.source_digest = digest
+        logger.success(f"{entry.destination_endpoint} - image copied successfully ({digest})")
+        results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_REPLICATED, digest)
+        if state is not None:
+            state.record(entry)
     return True
 
 
@@ -88,185 +431,416 @@ def verify_local_image(
     logger: Any,
     docker_api: Any,
     docker_client: Any,
+    local_images: LocalImageIndex,
     source_endpoint: LiteralString,
     source_repository: LiteralString,
     source_tag: LiteralString,
-    destination_repository: LiteralString,
-    destination_tag: LiteralString,
     final_sha256: LiteralString,
-) -> bool:
-    """checks for the image locally, pulls if it isn't, and re-tags it
+    limiter: Optional[HostLimiter] = None,
+    platform: Optional[str] = None,
+    budget: Optional[RetryBudget] = None,
+) -> Any:
+    """checks for the image locally and pulls it if it isn't there
 
     Args:
         docker_api (Any): API object
+        local_images (LocalImageIndex): index of the images in the daemon
         source_endpoint (LiteralString): source endpoint to look for (repository+tag)
         source_repository (LiteralString): source repository to look for
         source_tag (LiteralString): source tag to look for
-        destination_repository (LiteralString): destination repository for re-tagging
-        destination_tag (LiteralString): destination tag tag for re-tagging
         final_sha256 (LiteralString): sha256 to look for
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        platform (Optional[str]): os/architecture[/variant] to pull instead of the daemon's own
+        budget (Optional[RetryBudget]): retries left for the image
 
     Returns:
-        bool: True if local image tag is found
+        Any: the local image, or None if it couldn't be pulled
     """
-    matched_images = list()
-    try:  # append sha256 if needed
-        if final_sha256 != "":
-            source_endpoint_and_sha256: str = str(f"{source_endpoint}@{final_sha256}")
-            matched_images = docker_client.images.list(filters={"reference": f"{source_endpoint_and_sha256}"})
-            if len(matched_images) > 0:
-                logger.info(f"{source_endpoint_and_sha256} - source image exists locally")
-            else:
-                logger.warning(f"{source_endpoint_and_sha256} - image not found locally")
-                pull_image(logger, docker_client, source_repository, source_tag)
-                return False
-        else:  # no sha256, just a tag
-            matched_images = docker_client.images.list(filters={"reference": f"{source_endpoint}"})
-            if len(matched_images) > 0:
-                logger.info(f"{source_endpoint} - source image exists locally")
-            else:
-                logger.warning(f"{source_endpoint} - image not found locally")
-                pull_image(logger, docker_client, source_repository, source_tag)
-                matched_images = docker_client.images.list(filters={"reference": f"{source_endpoint}"})
-
-        # tag it
-        matched_images[0].tag(repository=destination_repository, tag=destination_tag)
-        return True
+    # pinned images are looked up by their repository digest
+    reference = f"{source_repository}@sha256:{final_sha256}" if final_sha256 != "" else source_endpoint
+    try:
+        image = local_images.get(reference)
+        if image is not None and platform is not None and local_platform(image) != platform.split("/")[:2]:
+            # a local copy of another platform has to be replaced by a pull of the requested one
+            image = None
+        if image is not None:
+            logger.info(f"{reference} - source image exists locally")
+            return image
+
+        logger.warning(f"{reference} - image not found locally")
+        pull_image(logger, docker_client, source_repository, source_tag, limiter, platform, local_images, budget)
+        image = local_images.get(reference) or local_images.refresh(reference)
+        if image is not None:
+            return image
+        logger.error(f"{reference} - image still not found locally after pulling")
+        return None
     except docker.errors.ImageNotFound as e:
         logger.warning(f"{source_endpoint} - image not found locally")
         logger.debug(e)
-        pull_image(logger, docker_client, source_repository, source_tag)
-        return False
+        return None
 
 
-def pull_image(logger: Any, docker_client: Any, repository: LiteralString, tag: LiteralString) -> bool:
-    """performs a `docker pull`
+def local_platform(image: Any) -> List[str]:
+    """reads the os and architecture of a local image
 
     Args:
-        repository (LiteralString): URI of repository
-        tag (LiteralString): image tag
+        image (Any): docker-py image object
 
     Returns:
-        bool: success or failure
+        List[str]: os and architecture, e.g. ["linux", "amd64"]
     """
-    try:
-        logger.info(f"{repository}:{tag} - pulling image")
-        docker_client.images.pull(repository, tag=tag)
-        logger.success(f"{repository}:{tag} - image pulled successfully")
-        return True
-    except docker.errors.APIError or docker.errors.ImageNotFound as e:
-        logger.warning(e)
-        return False
+    return [str(image.attrs.get("Os", "")), str(image.attrs.get("Architecture", ""))]
 
 
-def replicate(logger: Any, arguments: Any, docker_api: Any, docker_client: Any, image_list: list[dict[str, Any]]) -> bool:
-    """performs bulk of logic with replicating images from one place to another
+def pull_image(
+    logger: Any,
+    docker_client: Any,
+    repository: LiteralString,
+    tag: LiteralString,
+    limiter: Optional[HostLimiter] = None,
+    platform: Optional[str] = None,
+    local_images: Optional[LocalImageIndex] = None,
+    budget: Optional[RetryBudget] = None,
+) -> bool:
+    """performs a `docker pull`, retrying transient failures. The daemon keeps layers that finished downloading, so a retry
+    only downloads the rest
 
     Args:
-        arguments (Any): CLI arguments
-        docker_api (Any): client object
-        image_list (Dict[LiteralString, Any]): list of images to parse to perform pull/push
+        repository (LiteralString): URI of repository
+        tag (LiteralString): image tag
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        platform (Optional[str]): os/architecture[/variant] to pull instead of the daemon's own
+        local_images (Optional[LocalImageIndex]): index to update with the pulled image
+        budget (Optional[RetryBudget]): retries left for the image
 
     Returns:
-        bool: _description_
+        bool: success or failure
     """
-    logger.info(f"preparing threads for replicating. Maximum threads: {arguments.max_workers}")
-    thread_pool = ThreadPoolExecutor(max_workers=arguments.max_workers)
-    for image in list(image_list):
-        # remove docker.io registry prefix as its implicit and not returned by the API when doing lookups
-        source_repository: str = re.sub(r"^docker.io/", "", str(image["source"]["repository"]))
-        source_tag: str = str(image["source"]["tag"])
-        destination_repository: str = str(image["destination"]["repository"])
-        destination_tag: str = str()
-
-        # check forcePull and forcePush values
+    with span("pull", f"{repository}:{tag}") as traced:
         try:
-            force_pull: bool = bool(image["source"]["forcePull"])
-        except KeyError:
-            force_pull = False
-        try:
-            force_push: bool = bool(image["source"]["forcePush"])
-        except KeyError:
-            force_push = False
+            logger.info(f"{repository}:{tag} - pulling image")
+            host = parse_image_reference(repository)[0]
+            progress = ProgressTracker(current_meter(), "pull", host, f"{repository}:{tag}")
+            traced.bytes = transfer_with_retries(limiter, budget, docker_client.api.pull, progress, repository, tag=tag, platform=platform)
+            if local_images is not None:
+                local_images.refresh(f"{repository}:{tag}")
+            logger.success(f"{repository}:{tag} - image pulled successfully")
+            return True
+        except docker.errors.APIError as e:  # ImageNotFound included
+            logger.warning(e)
+            traced.outcome = f"error: {type(e).__name__}"
+            return False
+
+
+def open_registry_pool(logger: Any, arguments: Any, writable: bool = True) -> RegistryPool:
+    """opens the registry clients of a run, with the layouts of --export-dir and --import-dir in place of registries
 
-        # destination tag is optional, falls back to source tag
-        try:
-            destination_tag = str(image["destination"]["tag"])
-        except KeyError:
-            logger.debug("no destination tag provided - using source tag as a fallback")
-            destination_tag = str(image["source"]["tag"])
+    Args:
+        arguments (Any): CLI arguments
+        writable (bool): create the --export-dir layout for writing, False to only read whatever is there already
 
-        # use images.[]source.sha256 if its valid
-        final_sha256: str = ""
-        try:
-            source_sha256: str = str(image["source"]["sha256"])
-            if validate_sha256(source_sha256):
-                final_sha256 = source_sha256
-                logger.debug(f"{final_sha256} - using this valid sha256")
-            else:
-                logger.warning(f"{source_repository}:@sha256:{source_sha256} - skipping image because sha256 is not valid")
-                break
-        except KeyError:
-            logger.debug("no valid source sha256 provided, not using sha256 suffix on image URI")
+    Returns:
+        RegistryPool: shared registry clients
+    """
+    chunk_size = arguments.blob_chunk_size * 1024 * 1024
+    export_layout = ImageLayout(logger, arguments.export_dir, chunk_size) if arguments.export_dir is not None else None
+    if export_layout is not None and writable:
+        export_layout.open()
+    import_layout = ImageLayout(logger, arguments.import_dir, chunk_size) if arguments.import_dir is not None else None
+    return RegistryPool(logger, arguments, export_layout, import_layout)
 
-        # combine repositories and tags
-        source_endpoint: str = str(f"{source_repository}:{source_tag}")
-        destination_endpoint: str = str(f"{destination_repository}:{destination_tag}")
 
-        # create threads
-        threads = [
-            thread_pool.submit(
-                check_remote,
-                logger,
-                arguments,
-                docker_api,
-                docker_client,
-                source_endpoint,
-                source_repository,
-                source_tag,
-                destination_endpoint,
-                destination_repository,
-                destination_tag,
-                final_sha256,
-                force_pull,
-                force_push,
-            )
-        ]
+def replicate(
+    logger: Any,
+    arguments: Any,
+    engines: EnginePool,
+    image_list: Iterable[Dict[LiteralString, Any]],
+    results: RunResults,
+    registry_pool: Optional[RegistryPool] = None,
+) -> bool:
+    """performs bulk of logic with replicating images from one place to another
 
-    wait(threads, return_when="ALL_COMPLETED")
+    Args:
+        arguments (Any): CLI arguments
+        engines (EnginePool): docker engines to spread images over with --engine daemon
+        image_list (Iterable[Dict[LiteralString, Any]]): images to parse to perform pull/push, consumed as replication goes
+        results (RunResults): outcome of each entry of this shard
+        registry_pool (Optional[RegistryPool]): registry clients to reuse, kept open afterwards. A pool is opened and
+            closed for this run if None
+
+    Returns:
+        bool: always True. Failed entries don't raise, they're recorded in results
+    """
+    state = SyncState(logger, arguments.state_file) if arguments.state_file is not None else None
+    shared_pool = registry_pool is not None
+    if registry_pool is None:
+        registry_pool = open_registry_pool(logger, arguments)
+    workers = arguments.max_workers if arguments.engine == "registry" else arguments.pull_workers or arguments.max_workers
+    report = ScheduleReport(arguments.order, workers)
+    jobs = schedule_jobs(logger, arguments, registry_pool, report, state, results, image_list)
+
+    if arguments.engine == "registry":
+        summary = TransferSummary()
+        logger.info(f"preparing threads for replicating. Maximum threads: {arguments.max_workers}")
+        copy = Stage(
+            "copy",
+            partial(copy_stage, logger, arguments, registry_pool, report, summary, state, results),
+            arguments.max_workers,
+            0,
+            partial(job_hosts, registry_pool),
+            registry_pool.limiter,
+            partial(copy_failed, logger, results),
+        )
+        Pipeline(logger, [copy]).run(job for job, _ in jobs)
+        summary.log(logger)
+    else:
+        # routed as they're scheduled, so engines that turned out slow get fewer of the later images
+        daemon_jobs = (
+            DaemonJob(job, destination_statuses, engines.route(job.key), registry_pool.retry_budget()) for job, destination_statuses in jobs
+        )
+        replicate_with_daemon(logger, arguments, engines, registry_pool.limiter, report, state, results, daemon_jobs)
+    report.log(logger)
+    registry_pool.retry_stats.log(logger)
+
+    if not shared_pool:
+        registry_pool.close()
+    if state is not None:
+        state.close()
     return True
 
 
-def validate_sha256(sha256_hash: LiteralString) -> bool:
-    """validates sha256 string
+def schedule_jobs(
+    logger: Any,
+    arguments: Any,
+    registry_pool: RegistryPool,
+    report: ScheduleReport,
+    state: Optional[SyncState],
+    results: RunResults,
+    image_list: Iterable[Dict[LiteralString, Any]],
+) -> Iterator[Tuple[SourceJob, List[str]]]:
+    """reads entries as they come in and checks the destinations of each batch of --batch-size entries together, handing
+    out the batch's jobs right away so the first images replicate while later entries are still being read. With --order
+    size or priority all entries are read and ordered first, as one batch. A source that
+    turns up again in a later batch can't join its job, which is already running or queued, so those entries are held back
+    and handed out as one job per source once the input is read. By then the first job is most likely done, so the daemon
+    engine finds the image locally instead of pulling it again
 
     Args:
-        sha256_hash (LiteralString): string containing sha256 for image
+        arguments (Any): CLI arguments
+        registry_pool (RegistryPool): shared registry clients
+        report (ScheduleReport): records the scheduled jobs and their sizes
+        state (Optional[SyncState]): state file to skip recently confirmed entries with
+        results (RunResults): outcome of each entry of this shard
+        image_list (Iterable[Dict[LiteralString, Any]]): validated entries from the input files
+
+    Yields:
+        Tuple[SourceJob, List[str]]: one job per distinct source, with the check phase status of each of its destinations
+    """
+    read = 0
+    assigned = 0
+    fresh = 0
+    scheduled = 0
+    batch: List[ReplicationEntry] = list()
+    handed_out: Set[str] = set()  # sources of the jobs handed out so far
+    held_back: Dict[str, Tuple[SourceJob, List[str]]] = dict()  # later entries of those sources
+
+    def hand_out(jobs: List[Tuple[SourceJob, List[str]]]) -> Iterator[Tuple[SourceJob, List[str]]]:
+        nonlocal scheduled
+        for job, destination_statuses in jobs:
+            if job.key not in handed_out:
+                handed_out.add(job.key)
+                scheduled += len(job.entries)
+                yield job, destination_statuses
+            elif job.key in held_back:
+                held_back[job.key][0].entries.extend(job.entries)
+                held_back[job.key][1].extend(destination_statuses)
+            else:
+                held_back[job.key] = (job, destination_statuses)
+
+    for image in image_list:
+        read += 1
+        entry = build_replication_entry(logger, image)
+        if entry is None:
+            # invalid entries are reported by the shard their repository hashes to, so a merged report lists them once
+            source = f"{image['source']['repository']}:{image['source']['tag']}"
+            if in_shard(str(image["source"]["repository"]), arguments.shard):
+                results.record(source, str(image["destination"]["repository"]), RESULT_FAILED, "invalid entry")
+            continue
+        if not in_shard(source_key(entry), arguments.shard):
+            continue
+        assigned += 1
+        results.expect(entry.source_endpoint, entry.destination_endpoint)
+        if arguments.engine == "daemon" and len(entry.platforms) > 1:
+            # the daemon stores one platform per tag, so it can't push a multi-arch index
+            logger.error(f"{entry.source_endpoint} - replicating more than one platform requires --engine registry, skipping image")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_FAILED, "multiple platforms require --engine registry")
+            continue
+        if state is not None and not arguments.force_pull_push and state.is_fresh(entry, arguments.state_ttl, arguments.state_ttl_mutable):
+            logger.debug(f"{entry.destination_endpoint} - confirmed recently according to state file, skipping")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_UP_TO_DATE, STATE_CONFIRMED)
+            fresh += 1
+            continue
+        batch.append(entry)
+        # ordering only helps across everything there is to run, so with --order the whole input is one batch
+        if arguments.order == ORDER_FILE and len(batch) >= arguments.batch_size:
+            yield from hand_out(check_batch(logger, arguments, registry_pool, report, state, results, batch))
+            batch = list()
+    if batch:
+        yield from hand_out(check_batch(logger, arguments, registry_pool, report, state, results, batch))
+    if held_back:
+        logger.info(f"{len(held_back)} sources turned up again in later batches, replicating them to those destinations last")
+    for job, destination_statuses in held_back.values():
+        scheduled += len(job.entries)
+        yield job, destination_statuses
+
+    if arguments.shard is not None:
+        logger.info(f"shard {arguments.shard[0]}/{arguments.shard[1]} - {assigned} of {read} entries assigned to this shard")
+    if state is not None:
+        logger.info(f"{fresh} entries confirmed within their TTL in {arguments.state_file}, skipped them")
+    logger.info(f"read {read} entries, scheduled {scheduled} destinations for replication")
+
+
+def check_batch(
+    logger: Any,
+    arguments: Any,
+    registry_pool: RegistryPool,
+    report: ScheduleReport,
+    state: Optional[SyncState],
+    results: RunResults,
+    batch: List[ReplicationEntry],
+) -> List[Tuple[SourceJob, List[str]]]:
+    """checks the destinations of a batch of entries up front and groups the ones that need replicating by source. With
+    --order size or priority the sources are measured and the jobs ordered largest first
+
+    Args:
+        arguments (Any): CLI arguments
+        registry_pool (RegistryPool): shared registry clients
+        report (ScheduleReport): records the scheduled jobs and their sizes
+        state (Optional[SyncState]): state file to record entries found at the destination in
+        results (RunResults): outcome of each entry of this shard
+        batch (List[ReplicationEntry]): entries to check
 
     Returns:
-        bool: True if it is a valid sha256 string
+        List[Tuple[SourceJob, List[str]]]: one job per distinct source, with the check phase status of each of its destinations
     """
-    if re.search(r"\b[A-Fa-f0-9]{64}\b", sha256_hash):  # https://stackoverflow.com/a/43599586/11051914
-        return True
-    else:
-        return False
-
+    statuses = check_destinations(logger, arguments, registry_pool, batch)
+
+    pending = list()
+    destination_statuses = dict()
+    for entry, (destination_status, digest) in zip(batch, statuses):
+        if destination_status == DESTINATION_EXISTS:
+            logger.info(f"{entry.destination_endpoint} - destination image exists in registry")
+            results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_UP_TO_DATE)
+            if state is not None:
+                # only the registry engine compares digests, the daemon engine re-pushes manifests so theirs differ from the source.
+                # With a platform filter the destination holds a new index, whose digest isn't the source's either
+                state.record(entry, digest if arguments.engine == "registry" and not entry.platforms else None)
+            continue
+        pending.append(entry)
+        destination_statuses[id(entry)] = destination_status
+    plan = build_plan(pending)
+    logger.info(f"{len(pending)} destinations to replicate from {len(plan)} distinct sources")
+    sizes: Dict[str, int] = dict()
+    if arguments.order != ORDER_FILE and plan:
+        sizes = measure_sources(logger, arguments, registry_pool, plan)
+    report.scheduled(plan, sizes)
+    plan = order_jobs(plan, sizes, arguments.order)
+    return [(job, [destination_statuses[id(entry)] for entry in job.entries]) for job in plan]
+
+
+def replicate_with_daemon(
+    logger: Any,
+    arguments: Any,
+    engines: EnginePool,
+    limiter: HostLimiter,
+    report: ScheduleReport,
+    state: Optional[SyncState],
+    results: RunResults,
+    jobs: Iterable[DaemonJob],
+) -> None:
+    """runs jobs through check, pull, tag and push stages that each have their own workers, joined by bounded queues.
+    Pulls of the next images overlap pushes of earlier ones, and the queues bound how many pulled images wait to be pushed
 
-def verify_destination_image(logger: Any, docker_client: Any, uri: LiteralString) -> Tuple[str, int]:
-    """verify the image exists in the destination
+    Args:
+        arguments (Any): CLI arguments
+        engines (EnginePool): docker engines the jobs were routed to
+        limiter (HostLimiter): per-registry concurrency and rate limits to honor
+        report (ScheduleReport): records when each job started and finished
+        state (Optional[SyncState]): state file to record replicated entries in
+        results (RunResults): outcome of each entry
+        jobs (Iterable[DaemonJob]): sources with the destinations that weren't found by the check phase, consumed as the pipeline has room
+    """
+    pull_workers = arguments.pull_workers or arguments.max_workers
+    push_workers = arguments.push_workers or arguments.max_workers
+    queue_size = arguments.queue_size or arguments.max_workers
+    logger.info(f"preparing pipeline for replicating. Pull threads: {pull_workers}, push threads: {push_workers}, queue size: {queue_size}")
+    for engine in engines.engines:
+        # every daemon has its own images and disk
+        engine.local_images = LocalImageIndex(logger, engine.client)
+        engine.local_images.start()
+        if engine.cache is not None:
+            engine.cache.local_images = engine.local_images
+        elif arguments.local_cache_budget:
+            # kept for every --watch pass, so images pulled by an earlier pass are still evictable, not taken for images
+            # that were there before
+            engine.cache = LocalImageCache(logger, engine.client, engine.local_images, arguments.local_cache_budget)
+    pipeline = Pipeline(
+        logger,
+        [
+            Stage(
+                "check",
+                partial(check_stage, logger, arguments, state, results),
+                arguments.max_workers,
+                queue_size,
+                failed=partial(job_failed, logger, report, results, "check"),
+            ),
+            Stage(
+                "pull",
+                partial(pull_stage, logger, arguments, limiter, report, results),
+                pull_workers,
+                queue_size,
+                pull_hosts,
+                limiter,
+                partial(job_failed, logger, report, results, "pull"),
+            ),
+            Stage("tag", partial(tag_stage, logger), 1, queue_size, failed=partial(job_failed, logger, report, results, "tag")),
+            Stage(
+                "push",
+                partial(push_stage, logger, limiter, report, state, results),
+                push_workers,
+                queue_size,
+                push_hosts,
+                limiter,
+                partial(push_failed, logger, results),
+            ),
+        ],
+    )
+    pipeline.run(jobs)
+    pipeline.log_report()
+    for engine in engines.engines:
+        engine.local_images.close()
+        engine.local_images = None
+        if engine.cache is not None:
+            engine.cache.log()
+    engines.log(logger)
+
+
+def verify_destination_image(logger: Any, docker_client: Any, uri: LiteralString, budget: Optional[RetryBudget] = None) -> Tuple[str, int]:
+    """verify the image exists in the destination, retrying transient failures
 
     Args:
         docker_client (Any): docker client object
         uri (LiteralString): container image:tag
+        budget (Optional[RetryBudget]): retries left for the image
 
     Returns:
         Tuple[str, int]: status in the form of text (potentially including error), and error code
     """
     try:
-        docker_client.images.get_registry_data(uri)
+        call_with_retries(budget, uri, docker_client.images.get_registry_data, uri)
         logger.debug(f"{uri} - verified this exists in destination")
         return "exists", 200
     except docker.errors.ImageNotFound as e:  # reasonable error
-        return "does not exist", int(e.status_code)
+        return "does not exist", int(e.status_code or 404)
     except docker.errors.APIError as e:  # bad error
-        return f"{e.explanation}", int(e.status_code)
+        return str(e.explanation or e), int(e.status_code or 0)
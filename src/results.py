@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+RESULT_REPLICATED = "replicated"
+RESULT_BUILT = "built"
+RESULT_UP_TO_DATE = "up to date"
+RESULT_FAILED = "failed"
+NO_OUTCOME = "no outcome recorded"
+
+
+class RunResults:
+    """thread-safe outcome of every entry a run (or one shard of it) was responsible for"""
+
+    def __init__(self, shard: Optional[Tuple[int, int]] = None) -> None:
+        self.shard = shard
+        self.started = time.time()
+        self.results: Dict[str, Dict[str, str]] = dict()
+        self._lock = threading.Lock()
+
+    def record(self, source: str, destination: str, status: str, detail: str = "") -> None:
+        """records the outcome of one entry, replacing an earlier one
+
+        Args:
+            source (str): source image, or the build folder for builds
+            destination (str): destination image
+            status (str): one of the RESULT_* statuses
+            detail (str): error message or other context
+        """
+        with self._lock:
+            self.results[f"{source} -> {destination}"] = {"source": source, "destination": destination, "status": status, "detail": detail}
+
+    def expect(self, source: str, destination: str) -> None:
+        """records an entry as failed unless an outcome is recorded for it later, so entries dropped by an unexpected error
+        don't silently disappear from the report
+
+        Args:
+            source (str): source image
+            destination (str): destination image
+        """
+        with self._lock:
+            self.results.setdefault(
+                f"{source} -> {destination}",
+                {"source": source, "destination": destination, "status": RESULT_FAILED, "detail": NO_OUTCOME},
+            )
+
+    def pending(self, source: str, destination: str) -> bool:
+        """tells whether an entry still has no outcome, see expect()
+
+        Args:
+            source (str): source image
+            destination (str): destination image
+
+        Returns:
+            bool: True unless an outcome was recorded for the entry
+        """
+        with self._lock:
+            result = self.results.get(f"{source} -> {destination}")
+            return result is None or result["detail"] == NO_OUTCOME
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = dict()
+            for result in self.results.values():
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+            return counts
+
+    def write(self, path: Path) -> None:
+        """writes the results as JSON, replacing the file atomically so a merge never reads a partial one
+
+        Args:
+            path (Path): result file
+        """
+        with self._lock:
+            report: Dict[str, Any] = {
+                "shard": f"{self.shard[0]}/{self.shard[1]}" if self.shard is not None else None,
+                "started": self.started,
+                "finished": time.time(),
+                "results": list(self.results.values()),
+            }
+        report["counts"] = self.counts()
+        temporary = path.with_name(f"{path.name}.tmp")
+        with open(temporary, "w", encoding="utf-8") as result_file:
+            json.dump(report, result_file, indent=2)
+        os.replace(temporary, path)
+
+
+def merge_results(logger: Any, paths: List[Path], output: Optional[Path] = None) -> int:
+    """combines the result files of a sharded run into one report
+
+    Args:
+        paths (List[Path]): result files, one per shard
+        output (Optional[Path]): where to write the merged result file, if anywhere
+
+    Returns:
+        int: exit status, 0 if every shard reported and no entry failed
+    """
+    merged = RunResults()
+    status = 0
+    shards: Dict[int, Path] = dict()
+    counts = set()
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as result_file:
+                report = json.load(result_file)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"{path} - unable to read result file: {e}")
+            status = 1
+            continue
+        if report.get("shard"):
+            index, count = (int(number) for number in str(report["shard"]).split("/"))
+            if index in shards:
+                logger.error(f"{path} - shard {index}/{count} was already read from {shards[index]}")
+                status = 1
+                continue
+            shards[index] = path
+            counts.add(count)
+        merged.started = min(merged.started, float(report.get("started", merged.started)))
+        for result in report.get("results", list()):
+            merged.record(result["source"], result["destination"], result["status"], result.get("detail", ""))
+
+    if len(counts) > 1:
+        logger.error(f"result files disagree on the number of shards: {', '.join(str(count) for count in sorted(counts))}")
+        status = 1
+    for count in counts:
+        missing = [str(index) for index in range(1, count + 1) if index not in shards]
+        if missing:
+            logger.error(f"missing result files for shards {', '.join(missing)} of {count}")
+            status = 1
+
+    failed = [result for result in merged.results.values() if result["status"] == RESULT_FAILED]
+    for result in failed:
+        logger.error(f"{result['destination']} - failed: {result['detail']}")
+    counts_text = ", ".join(f"{number} {name}" for name, number in sorted(merged.counts().items()))
+    print(f"{len(paths)} result files, {len(merged.results)} entries: {counts_text or 'nothing to report'}")
+    if output is not None:
+        merged.write(output)
+    return 1 if failed else status
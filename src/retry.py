@@ -0,0 +1,156 @@
+import random
+import threading
+import time
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import TypeVar
+
+import docker
+import requests
+
+from summary import format_bytes
+
+T = TypeVar("T")
+
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRY_MAX_DELAY = 60.0
+# the daemon only passes on the registry's error message, so transient failures are recognized by it
+TRANSIENT_DAEMON_ERRORS = [
+    "connection reset",
+    "broken pipe",
+    "unexpected eof",
+    "i/o timeout",
+    "tls handshake timeout",
+    "toomanyrequests",
+    "too many requests",
+    "500 internal server error",
+    "502 bad gateway",
+    "503 service unavailable",
+    "504 gateway timeout",
+]
+
+
+def is_transient(error: Exception) -> bool:
+    """recognizes failures worth retrying: connection resets and timeouts, 5xx and 429 responses
+
+    Args:
+        error (Exception): error raised by requests, the registry client or docker-py
+
+    Returns:
+        bool: True if trying again may succeed
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(error, docker.errors.APIError):
+        message = str(error).lower()
+        return any(transient in message for transient in TRANSIENT_DAEMON_ERRORS)
+    return getattr(error, "status_code", None) in RETRY_STATUS_CODES
+
+
+class RetryStats:
+    """retries of a run, and the bytes they re-sent or that resuming kept from being re-sent"""
+
+    def __init__(self) -> None:
+        self.retries = 0
+        self.exhausted = 0
+        self.bytes_retried = 0
+        self.bytes_resumed = 0
+        self._lock = threading.Lock()
+
+    def retried(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def ran_out(self) -> None:
+        with self._lock:
+            self.exhausted += 1
+
+    def resent(self, size: int) -> None:
+        """counts bytes that have to be sent again because of a retry"""
+        with self._lock:
+            self.bytes_retried += size
+
+    def resumed(self, size: int) -> None:
+        """counts bytes that a retry didn't have to send again, because the interrupted transfer was resumed"""
+        with self._lock:
+            self.bytes_resumed += size
+
+    def log(self, logger: Any) -> None:
+        if self.retries == 0 and self.exhausted == 0:
+            return
+        logger.info(
+            f"retried {self.retries} times after transient errors, re-sending {format_bytes(self.bytes_retried)}. "
+            f"Resuming interrupted transfers saved re-sending {format_bytes(self.bytes_resumed)}"
+            + (f". {self.exhausted} images ran out of retries" if self.exhausted else "")
+        )
+
+
+class RetryBudget:
+    """retries left for one image, shared by all of its requests, blobs and platforms, so a flaky registry can't keep a
+    worker busy with one image forever
+
+    Args:
+        logger (Any): logger
+        stats (RetryStats): totals of the run to count retries in
+        retries (int): retries allowed for the image
+        backoff (float): base delay in seconds, doubled on every attempt of the same operation
+    """
+
+    def __init__(self, logger: Any, stats: RetryStats, retries: int, backoff: float) -> None:
+        self.logger = logger
+        self.stats = stats
+        self.remaining = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+
+    def spend(self, what: str, error: Exception, attempt: int) -> bool:
+        """takes one retry from the budget and sleeps before it, with full jitter so retries from many workers spread out
+
+        Args:
+            what (str): what is being retried, for the log
+            error (Exception): the transient error
+            attempt (int): how many times this operation has been retried already
+
+        Returns:
+            bool: True if the caller should retry, False if the budget is used up
+        """
+        with self._lock:
+            if self.remaining <= 0:
+                if self.remaining == 0:
+                    # counted once per image, however many operations find the budget empty
+                    self.stats.ran_out()
+                    self.remaining = -1
+                return False
+            self.remaining -= 1
+            remaining = self.remaining
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, self.backoff * 2**attempt))
+        # registry errors already start with the endpoint
+        message = str(error) if str(error).startswith(what) else f"{what} - {error}"
+        self.logger.warning(f"{message}, retrying in {delay:.1f}s ({remaining} retries left for this image)")
+        self.stats.retried()
+        time.sleep(delay)
+        return True
+
+
+def call_with_retries(budget: Optional[RetryBudget], what: str, func: Callable[..., T], *args: Any, resend: int = 0, **kwargs: Any) -> T:
+    """calls func, retrying transient failures while the budget lasts
+
+    Args:
+        budget (Optional[RetryBudget]): budget of the image, or None to just call func
+        what (str): what is being called, for the log
+        func (Callable[..., T]): idempotent call
+        resend (int): bytes func sends again when it's retried
+
+    Returns:
+        T: whatever func returns
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if budget is None or not is_transient(e) or not budget.spend(what, e, attempt):
+                raise
+            budget.stats.resent(resend)
+            attempt += 1
@@ -0,0 +1,330 @@
+import math
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any
+from typing import Callable
+from typing import Collection
+from typing import Deque
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TypeVar
+
+DOCKER_HUB_ALIASES = ("docker.io", "index.docker.io")
+DAEMON_RATE_LIMIT_BACKOFF = 60
+DAEMON_RATE_LIMIT_RETRIES = 3
+# pacing never spaces requests further apart than this, however few a registry says are left in a long window
+RATE_LIMIT_MAX_INTERVAL = 30.0
+
+T = TypeVar("T")
+
+
+def parse_registry_limits(values: List[str]) -> Dict[str, int]:
+    """parses HOST=N pairs from the CLI
+
+    Args:
+        values (List[str]): pairs like docker.io=2
+
+    Returns:
+        Dict[str, int]: concurrency limit per registry host
+    """
+    limits = dict()
+    for value in values:
+        host, _, limit = value.partition("=")
+        # hosts are matched against what parse_image_reference() returns, which uses the real Docker Hub API host
+        host = "registry-1.docker.io" if host in DOCKER_HUB_ALIASES else host
+        limits[host] = int(limit)
+    return limits
+
+
+def parse_header_seconds(value: Optional[str]) -> Optional[float]:
+    """reads the leading number of a rate limit header such as `76;w=21600`
+
+    Args:
+        value (Optional[str]): header value
+
+    Returns:
+        Optional[float]: the number, or None if there isn't one
+    """
+    if value is None:
+        return None
+    match = re.match(r"\s*(\d+(?:\.\d+)?)", value)
+    return float(match.group(1)) if match else None
+
+
+class HostLimiter:
+    """caps concurrent work per registry host and pauses or paces a host when it signals rate limiting"""
+
+    def __init__(self, logger: Any, default_limit: int, limits: Dict[str, int]) -> None:
+        self.logger = logger
+        self.default_limit = default_limit
+        self.limits = limits
+        self._in_use: Dict[str, int] = dict()
+        self._paused_until: Dict[str, float] = dict()
+        self._interval: Dict[str, float] = dict()
+        self._next_request: Dict[str, float] = dict()
+        self._lock = threading.RLock()
+        # notified whenever a slot is released, shared with the HostQueues waiting for one
+        self.changed = threading.Condition(self._lock)
+        self._held = threading.local()
+
+    def held(self) -> Set[str]:
+        """returns the hosts the calling thread holds a slot on"""
+        if not hasattr(self._held, "hosts"):
+            self._held.hosts = set()
+        hosts: Set[str] = self._held.hosts
+        return hosts
+
+    def ready_in(self, hosts: Collection[str]) -> float:
+        """tells how long until a slot could be taken on every host
+
+        Args:
+            hosts (Collection[str]): registry hosts
+
+        Returns:
+            float: 0 if it can be taken now, the rest of the longest pause if a host is paused, or infinity if a host has
+                no free slot
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            for host in hosts:
+                if self._in_use.get(host, 0) >= self.limits.get(host, self.default_limit):
+                    return math.inf
+                wait = max(wait, self._paused_until.get(host, 0.0) - now)
+            return wait
+
+    def acquire(self, hosts: Collection[str]) -> None:
+        """takes a slot on every host for the calling thread without waiting. Only call it with `changed` held, after
+        checking the slots are free
+
+        Args:
+            hosts (Collection[str]): registry hosts
+        """
+        with self._lock:
+            for host in hosts:
+                self._in_use[host] = self._in_use.get(host, 0) + 1
+        self.held().update(hosts)
+
+    def release(self, hosts: Collection[str]) -> None:
+        """gives back the calling thread's slots on the hosts
+
+        Args:
+            hosts (Collection[str]): registry hosts
+        """
+        self.held().difference_update(hosts)
+        with self.changed:
+            for host in hosts:
+                self._in_use[host] -= 1
+            self.changed.notify_all()
+
+    @contextmanager
+    def slot(self, *hosts: str) -> Iterator[None]:
+        """holds a concurrency slot on each host for the duration of the block. Slots on every host are taken at once, so
+        two threads can't deadlock on each other's hosts, and hosts the thread already holds are skipped
+
+        Args:
+            hosts (str): registry hosts
+        """
+        wanted = set(hosts) - self.held()
+        with self.changed:
+            while self.ready_in(wanted) == math.inf:
+                self.changed.wait()
+            self.acquire(wanted)
+        try:
+            yield
+        finally:
+            self.release(wanted)
+
+    def wait(self, host: str, paced: bool = True) -> None:
+        """blocks until the host may receive another request, honoring pauses and pacing
+
+        Args:
+            host (str): registry host
+            paced (bool): whether the request counts against the rate limit the host advertises, only those are paced
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready_at = self._paused_until.get(host, 0.0)
+                if paced:
+                    ready_at = max(ready_at, self._next_request.get(host, 0.0))
+                if ready_at <= now:
+                    if paced:
+                        self._next_request[host] = now + self._interval.get(host, 0.0)
+                    return
+            time.sleep(ready_at - now)
+
+    def pause(self, host: str, seconds: float) -> None:
+        """stops sending requests to a host for a while, without affecting other hosts
+
+        Args:
+            host (str): registry host
+            seconds (float): how long to pause
+        """
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until.get(host, 0.0):
+                self._paused_until[host] = until
+                self.logger.warning(f"{host} - rate limited, pausing requests for {seconds:.0f}s")
+
+    def observe(self, host: str, status_code: int, headers: Mapping[str, str]) -> Optional[float]:
+        """adjusts pacing for a host from the rate limit headers of one of its responses
+
+        Args:
+            host (str): registry host
+            status_code (int): response status
+            headers (Mapping[str, str]): response headers
+
+        Returns:
+            Optional[float]: seconds to wait before retrying if the response was a 429, otherwise None
+        """
+        retry_after = parse_header_seconds(headers.get("Retry-After"))
+        remaining = parse_header_seconds(headers.get("RateLimit-Remaining"))
+        window = parse_header_seconds(headers.get("RateLimit-Reset"))
+        if window is None:
+            match = re.search(r"w=(\d+)", headers.get("RateLimit-Remaining", ""))
+            window = float(match.group(1)) if match else None
+
+        if status_code == 429:
+            delay = retry_after if retry_after is not None else 60.0
+            self.pause(host, delay)
+            return delay
+        if retry_after is not None:
+            self.pause(host, retry_after)
+        if remaining is not None and window is not None:
+            with self._lock:
+                if remaining < 2 * self.limits.get(host, self.default_limit):
+                    # spread the requests we have left over the rest of the window instead of spending them in a burst. The
+                    # window can be hours long, so the registry's 429 and Retry-After take over once requests get that scarce
+                    self._interval[host] = min(window / max(remaining, 1.0), RATE_LIMIT_MAX_INTERVAL)
+                else:
+                    self._interval.pop(host, None)
+        return None
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """recognizes a rate limit passed through by the docker daemon, which only keeps the registry's error message
+
+    Args:
+        error (Exception): error raised by docker-py
+
+    Returns:
+        bool: True if the registry refused the request because of rate limiting
+    """
+    return getattr(error, "status_code", None) == 429 or "toomanyrequests" in str(error).lower().replace(" ", "")
+
+
+def call_with_limits(limiter: Optional[HostLimiter], host: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """runs a daemon call that talks to a registry inside that registry's concurrency slot, pausing the host and retrying
+    when the registry rate limits it
+
+    Args:
+        limiter (Optional[HostLimiter]): limiter to honor, or None to just call func
+        host (str): registry host the daemon will talk to
+        func (Callable[..., T]): docker-py call such as docker_client.images.pull
+
+    Returns:
+        T: whatever func returns
+    """
+    if limiter is None:
+        return func(*args, **kwargs)
+    attempt = 0
+    while True:
+        with limiter.slot(host):
+            limiter.wait(host)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                if not is_rate_limit_error(e) or attempt >= DAEMON_RATE_LIMIT_RETRIES:
+                    raise
+        # the daemon doesn't pass Retry-After through, so fall back to a fixed, growing pause
+        limiter.pause(host, DAEMON_RATE_LIMIT_BACKOFF * attempt)
+
+
+class HostQueue:
+    """a work queue that hands out the oldest item whose registry hosts all have a free slot and aren't paused, so a
+    worker never picks up work for a host that's at its limit while work for other hosts is waiting. The worker holds the
+    slots until it calls release()
+
+    Args:
+        limiter (HostLimiter): limits to honor
+        hosts (Callable[[Any], Iterable[str]]): registry hosts an item talks to
+        maxsize (int): maximum number of items waiting for each set of hosts before put() blocks, 0 for no limit. It's
+            counted per set of hosts so a backlog for a capped registry doesn't hold back work for the others
+    """
+
+    def __init__(self, limiter: HostLimiter, hosts: Callable[[Any], Iterable[str]], maxsize: int = 0) -> None:
+        self.limiter = limiter
+        self.hosts = hosts
+        self.maxsize = maxsize
+        self._waiting: Dict[FrozenSet[str], Deque[Tuple[int, Any]]] = dict()
+        self._count = 0
+        self._size = 0
+        self._closed = False
+
+    def put(self, item: Any) -> None:
+        key = frozenset(self.hosts(item))
+        with self.limiter.changed:
+            while self.maxsize and len(self._waiting.get(key, ())) >= self.maxsize:
+                self.limiter.changed.wait()
+            self._waiting.setdefault(key, deque()).append((self._count, item))
+            self._count += 1
+            self._size += 1
+            self.limiter.changed.notify_all()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        """lets get() return None once the queue is empty"""
+        with self.limiter.changed:
+            self._closed = True
+            self.limiter.changed.notify_all()
+
+    def get(self) -> Optional[Tuple[Any, FrozenSet[str]]]:
+        """takes the oldest item that can run now, holding a slot on its hosts for the calling thread
+
+        Returns:
+            Optional[Tuple[Any, FrozenSet[str]]]: the item and its hosts, or None once the queue is closed and empty
+        """
+        with self.limiter.changed:
+            while True:
+                ready = None
+                wait = math.inf
+                for key, items in self._waiting.items():
+                    delay = self.limiter.ready_in(key)
+                    if delay > 0:
+                        wait = min(wait, delay)
+                    elif ready is None or items[0][0] < self._waiting[ready][0][0]:
+                        ready = key
+                if ready is not None:
+                    item = self._waiting[ready].popleft()[1]
+                    if not self._waiting[ready]:
+                        del self._waiting[ready]
+                    self._size -= 1
+                    self.limiter.acquire(ready)
+                    self.limiter.changed.notify_all()
+                    return item, ready
+                if self._closed and not self._waiting:
+                    return None
+                # woken by a released slot or a new item, or once the shortest pause is over
+                self.limiter.changed.wait(None if wait == math.inf else wait)
+
+    def release(self, hosts: FrozenSet[str]) -> None:
+        """gives back the slots get() took for an item once the worker is done with it
+
+        Args:
+            hosts (FrozenSet[str]): hosts returned with the item
+        """
+        self.limiter.release(hosts)
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+from entries import ReplicationEntry
+
+STATE_CONFIRMED = "confirmed by state file"  # result detail of entries skipped because of the state file
+
+
+def state_key(entry: ReplicationEntry) -> str:
+    """identifies an entry in the state file. A changed sha256 pin or platform list is a different key, so it's never
+    considered fresh
+
+    Args:
+        entry (ReplicationEntry): entry to identify
+
+    Returns:
+        str: key for the entry
+    """
+    source = f"{entry.source_endpoint}@sha256:{entry.final_sha256}" if entry.final_sha256 != "" else entry.source_endpoint
+    if entry.platforms:
+        source += f" [{','.join(sorted(entry.platforms))}]"
+    return f"{source} -> {entry.destination_endpoint}"
+
+
+class SyncState:
+    """append-only JSON-lines record of when each entry was last confirmed at its destination"""
+
+    def __init__(self, logger: Any, path: Path) -> None:
+        self.logger = logger
+        self.path = path
+        self.records: Dict[str, Dict[str, Any]] = dict()
+        self._lock = threading.Lock()
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        """reads the state file, keeping the newest record per key, and compacts it when it's mostly superseded lines"""
+        if not self.path.exists():
+            return
+        lines = 0
+        with open(self.path, encoding="utf-8") as state_file:
+            for line in state_file:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                    self.records[record["key"]] = record
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # a run killed mid-write leaves a partial last line, which is safe to drop
+                    self.logger.debug(f"{self.path} - ignoring malformed state line {lines}")
+        self.logger.debug(f"{self.path} - loaded {len(self.records)} state records from {lines} lines")
+        if lines > 2 * len(self.records) + 100:
+            self._compact()
+
+    def _compact(self) -> None:
+        temporary = self.path.with_name(f"{self.path.name}.tmp")
+        with open(temporary, "w", encoding="utf-8") as state_file:
+            for record in self.records.values():
+                state_file.write(json.dumps(record) + "\n")
+        os.replace(temporary, self.path)
+        self.logger.debug(f"{self.path} - compacted state file to {len(self.records)} records")
+
+    def is_fresh(self, entry: ReplicationEntry, ttl: int, mutable_ttl: int) -> bool:
+        """checks whether an entry was confirmed recently enough to skip it without any network or daemon calls. When the
+        source digest is already known (pinned, or polled by --watch), it also has to be the digest that was confirmed, so a
+        moved tag is never skipped. Otherwise a moved tag is only noticed once the confirmation expires
+
+        Args:
+            entry (ReplicationEntry): entry to look up
+            ttl (int): seconds a confirmation stays valid
+            mutable_ttl (int): seconds a confirmation stays valid for entries with forcePull
+
+        Returns:
+            bool: True if the entry can be skipped
+        """
+        with self._lock:
+            record = self.records.get(state_key(entry))
+        if record is None:
+            return False
+        if entry.source_digest is not None and record.get("digest") != entry.source_digest:
+            return False
+        age = time.time() - float(record["confirmed"])
+        return age < (mutable_ttl if entry.force_pull else ttl)
+
+    def record(self, entry: ReplicationEntry, digest: Optional[str] = None) -> None:
+        """records that an entry was confirmed at its destination just now
+
+        Args:
+            entry (ReplicationEntry): confirmed entry
+            digest (Optional[str]): source digest the destination was confirmed with, if it's known. Defaults to the
+                entry's own
+        """
+        key = state_key(entry)
+        with self._lock:
+            record = {
+                "key": key,
+                "destination": entry.destination_endpoint,
+                "digest": digest or entry.source_digest,
+                "confirmed": time.time(),
+            }
+            self.records[key] = record
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,79 @@
+import re
+import threading
+from typing import Any
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1000, "kb": 1000, "kib": 1024, "m": 1000**2, "mb": 1000**2, "mib": 1024**2}
+SIZE_UNITS.update({"g": 1000**3, "gb": 1000**3, "gib": 1024**3, "t": 1000**4, "tb": 1000**4, "tib": 1024**4})
+
+
+def format_bytes(size: float) -> str:
+    """formats a byte count for humans
+
+    Args:
+        size (float): number of bytes
+
+    Returns:
+        str: size with a binary unit suffix
+    """
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def parse_size(value: str) -> int:
+    """parses a size from the CLI such as 500MB, 20GiB or a plain number of bytes
+
+    Args:
+        value (str): size with an optional unit
+
+    Returns:
+        int: number of bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*", value)
+    if match is None or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError(f"invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+class TransferSummary:
+    """thread-safe counters for what a run actually moved over the wire and what it avoided moving"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.blobs_transferred = 0
+        self.bytes_transferred = 0
+        self.blobs_skipped = 0
+        self.bytes_skipped = 0
+        self.blobs_mounted = 0
+        self.bytes_mounted = 0
+
+    def transferred(self, size: int) -> None:
+        with self._lock:
+            self.blobs_transferred += 1
+            self.bytes_transferred += size
+
+    def skipped(self, size: int) -> None:
+        with self._lock:
+            self.blobs_skipped += 1
+            self.bytes_skipped += size
+
+    def mounted(self, size: int) -> None:
+        with self._lock:
+            self.blobs_mounted += 1
+            self.bytes_mounted += size
+
+    def log(self, logger: Any) -> None:
+        """logs the totals for the run
+
+        Args:
+            logger (Any): logger object
+        """
+        saved = self.bytes_skipped + self.bytes_mounted
+        logger.info(
+            f"transferred {format_bytes(self.bytes_transferred)} in {self.blobs_transferred} blobs, "
+            f"skipped {format_bytes(self.bytes_skipped)} in {self.blobs_skipped} blobs already at the destination, "
+            f"mounted {format_bytes(self.bytes_mounted)} in {self.blobs_mounted} blobs from other repositories "
+            f"({format_bytes(saved)} not transferred)"
+        )
@@ -0,0 +1,366 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import docker
+
+from retry import is_transient
+from retry import RetryBudget
+from retry import RetryStats
+from scheduler import call_with_limits
+from scheduler import HostLimiter
+from summary import format_bytes
+
+# upper bounds in bytes per second of the layer throughput histogram
+LAYER_RATE_BUCKETS = [256 * 1024, 1024**2, 4 * 1024**2, 16 * 1024**2, 64 * 1024**2, 256 * 1024**2, 1024**3]
+
+
+# busy intervals that ended this long before the latest transfer are folded into a total and dropped
+BUSY_INTERVALS_KEPT_SECONDS = 3600.0
+
+
+def merge_intervals(intervals: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """merges overlapping intervals, so concurrent layers aren't counted twice
+
+    Args:
+        intervals (List[Tuple[float, float]]): start and end times
+
+    Returns:
+        List[Tuple[float, float]]: disjoint intervals covering the same time, sorted
+    """
+    merged: List[Tuple[float, float]] = list()
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class TransferTotals:
+    """running totals of the layers moved in one direction to or from one registry, or for one image. Only the busy
+    intervals of the last BUSY_INTERVALS_KEPT_SECONDS are kept, so a long --watch doesn't hold on to every layer. A layer
+    that took longer than that may have its overlap with the folded intervals counted twice"""
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.layers = 0
+        self.rate_buckets = [0 for _ in LAYER_RATE_BUCKETS]  # cumulative, like the histogram's buckets
+        self.rate_sum = 0.0
+        self._settled_seconds = 0.0
+        self._intervals: List[Tuple[float, float]] = list()
+
+    def add(self, start: float, end: float, size: int) -> None:
+        """adds one layer transfer
+
+        Args:
+            start (float): time.monotonic() when the layer started moving
+            end (float): time.monotonic() when it was done
+            size (int): bytes moved
+        """
+        self.bytes += size
+        self.layers += 1
+        rate = size / (end - start) if end > start else 0.0
+        self.rate_sum += rate
+        for index, bucket in enumerate(LAYER_RATE_BUCKETS):
+            if rate <= bucket:
+                self.rate_buckets[index] += 1
+        self._intervals = merge_intervals(self._intervals + [(start, end)])
+        # disjoint and sorted by start, so also sorted by end
+        horizon = self._intervals[-1][1] - BUSY_INTERVALS_KEPT_SECONDS
+        while self._intervals[0][1] < horizon:
+            settled_start, settled_end = self._intervals.pop(0)
+            self._settled_seconds += settled_end - settled_start
+
+    @property
+    def busy_seconds(self) -> float:
+        """time during which at least one of the layers was moving"""
+        return self._settled_seconds + sum(end - start for start, end in self._intervals)
+
+
+class ThroughputMeter:
+    """bytes moved per layer, and from them per image and per registry, whether the layers came through the docker
+    daemon's progress events or were streamed by the registry engine. Rates are bytes over the time at least one layer
+    was moving, so idle time between images doesn't drag them down. Registries keep running totals for the whole
+    process, images only until the next log(), so neither grows with every --watch pass"""
+
+    def __init__(self) -> None:
+        self.registries: Dict[Tuple[str, str], TransferTotals] = dict()  # direction, registry
+        self.images: Dict[Tuple[str, str, str], TransferTotals] = dict()  # direction, registry, image
+        self._lock = threading.Lock()
+
+    def record(self, direction: str, registry: str, image: str, start: float, end: float, size: int) -> None:
+        """records one layer transfer
+
+        Args:
+            direction (str): pull or push
+            registry (str): registry host the layer came from or went to
+            image (str): image the layer belongs to
+            start (float): time.monotonic() when the layer started moving
+            end (float): time.monotonic() when it was done
+            size (int): bytes moved
+        """
+        with self._lock:
+            self.registries.setdefault((direction, registry), TransferTotals()).add(start, end, size)
+            self.images.setdefault((direction, registry, image), TransferTotals()).add(start, end, size)
+
+    def totals(self, by_image: bool = False) -> Dict[Tuple[str, ...], Tuple[int, float, int]]:
+        """the totals per direction and registry, or per direction, registry and image since the last log()
+
+        Args:
+            by_image (bool): group by image too
+
+        Returns:
+            Dict[Tuple[str, ...], Tuple[int, float, int]]: bytes, busy seconds and number of layers for each group
+        """
+        with self._lock:
+            groups: Iterable[Tuple[Tuple[str, ...], TransferTotals]] = (self.images if by_image else self.registries).items()
+            return {key: (group.bytes, group.busy_seconds, group.layers) for key, group in groups}
+
+    def log(self, logger: Any) -> None:
+        """logs each registry's throughput and the slowest images since the last log, then forgets the images"""
+        for (direction, registry), (size, seconds, layers) in sorted(self.totals().items()):
+            logger.info(
+                f"{direction} {'from' if direction == 'pull' else 'to'} {registry}: {format_bytes(size)} in {layers} layers "
+                f"at {format_bytes(size / seconds if seconds > 0 else 0)}/s"
+            )
+        slowest = sorted(self.totals(by_image=True).items(), key=lambda item: item[1][0] / item[1][1] if item[1][1] > 0 else 0)
+        for (direction, _, image), (size, seconds, _) in slowest[:5]:
+            logger.debug(f"{image} - {direction} {format_bytes(size)} at {format_bytes(size / seconds if seconds > 0 else 0)}/s")
+        with self._lock:
+            self.images.clear()
+
+    def prometheus(self) -> str:
+        """renders the metrics in the Prometheus text exposition format. There are no per-image metrics, since every
+        image would be a label set of its own
+
+        Returns:
+            str: metrics for a node-exporter textfile
+        """
+        lines: List[str] = list()
+
+        def metric(name: str, kind: str, description: str, samples: List[Tuple[Dict[str, str], float]]) -> None:
+            lines.extend([f"# HELP {name} {description}", f"# TYPE {name} {kind}"])
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels) if labels else ''} {format_value(value)}")
+
+        labels = [({"direction": key[0], "registry": key[1]}, values) for key, values in sorted(self.totals().items())]
+        metric("cir_transfer_bytes_total", "counter", "Bytes of layers transferred.", [(label, values[0]) for label, values in labels])
+        metric("cir_transfer_layers_total", "counter", "Layers transferred.", [(label, values[2]) for label, values in labels])
+        metric(
+            "cir_transfer_busy_seconds_total",
+            "counter",
+            "Seconds during which at least one layer was transferring.",
+            [(label, values[1]) for label, values in labels],
+        )
+        metric(
+            "cir_transfer_bytes_per_second",
+            "gauge",
+            "Throughput while transferring.",
+            [(label, values[0] / values[1] if values[1] > 0 else 0) for label, values in labels],
+        )
+
+        with self._lock:
+            histograms = {key: (list(group.rate_buckets), group.rate_sum, group.layers) for key, group in self.registries.items()}
+        samples: List[Tuple[str, Dict[str, str], float]] = list()
+        for (direction, registry), (buckets, rate_sum, count) in sorted(histograms.items()):
+            label = {"direction": direction, "registry": registry}
+            for bucket, bucket_count in zip(LAYER_RATE_BUCKETS, buckets):
+                samples.append(("_bucket", dict(label, le=str(bucket)), bucket_count))
+            samples.append(("_bucket", dict(label, le="+Inf"), count))
+            samples.append(("_sum", label, rate_sum))
+            samples.append(("_count", label, count))
+        lines.extend(
+            [
+                "# HELP cir_layer_transfer_bytes_per_second Throughput of individual layers.",
+                "# TYPE cir_layer_transfer_bytes_per_second histogram",
+            ]
+        )
+        lines.extend(
+            f"cir_layer_transfer_bytes_per_second{suffix}{format_labels(label)} {format_value(value)}" for suffix, label, value in samples
+        )
+
+        metric("cir_metrics_last_update_timestamp_seconds", "gauge", "When these metrics were written.", [(dict(), time.time())])
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float) -> str:
+    """formats a sample value without losing precision, as whole numbers where possible
+
+    Args:
+        value (float): sample value
+
+    Returns:
+        str: e.g. 15032385536 or 1792195569.25
+    """
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """formats Prometheus labels, escaping backslashes, quotes and newlines in their values
+
+    Args:
+        labels (Dict[str, str]): label names and values
+
+    Returns:
+        str: e.g. {direction="pull",registry="docker.io"}
+    """
+    escaped = {name: value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for name, value in labels.items()}
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped.items()) + "}"
+
+
+class ProgressTracker:
+    """turns the progress events of one `docker pull` or `docker push` into layer transfers
+
+    Args:
+        meter (ThroughputMeter): meter to record finished layers in
+        direction (str): pull or push
+        registry (str): registry host the daemon talks to
+        image (str): image being pulled or pushed
+    """
+
+    def __init__(self, meter: ThroughputMeter, direction: str, registry: str, image: str) -> None:
+        self.meter = meter
+        self.direction = direction
+        self.registry = registry
+        self.image = image
+        self.bytes = 0
+        self.active: Dict[str, Tuple[float, int, int]] = dict()  # layer ID -> started, current and total bytes
+        self._bytes_kept = 0
+
+    def interrupted(self, stats: RetryStats) -> None:
+        """accounts for a transfer that failed partway before it's retried. The daemon skips layers that finished, so
+        they count as resumed, while layers that were still moving start over"""
+        stats.resent(sum(max(current, 0) for _, current, _ in self.active.values()))
+        stats.resumed(self.bytes - self._bytes_kept)
+        self._bytes_kept = self.bytes
+        self.active.clear()
+
+    def update(self, event: Dict[str, Any]) -> None:
+        """handles one decoded progress event
+
+        Args:
+            event (Dict[str, Any]): event as streamed by the daemon
+        """
+        if "error" in event:
+            # the daemon reports failures inside the stream, after the request itself succeeded
+            raise docker.errors.APIError(str(event["error"]))
+        layer = event.get("id")
+        status = str(event.get("status", ""))
+        if not layer:
+            return
+        detail = event.get("progressDetail") or dict()
+        if status in ("Downloading", "Pushing") and "current" in detail:
+            started, _, _ = self.active.get(layer, (time.monotonic(), 0, 0))
+            self.active[layer] = (started, int(detail["current"]), int(detail.get("total") or 0))
+        elif status in ("Download complete", "Pushed") and layer in self.active:
+            # layers that already exist or are mounted never get here, since nothing was transferred for them
+            started, current, total = self.active.pop(layer)
+            size = max(current, total)
+            self.bytes += size
+            self.meter.record(self.direction, self.registry, self.image, started, time.monotonic(), size)
+
+
+def stream_progress(func: Callable[..., Any], progress: ProgressTracker, *args: Any, **kwargs: Any) -> int:
+    """runs a streaming docker-py API call such as docker_client.api.pull and feeds every event to a tracker
+
+    Args:
+        func (Callable[..., Any]): low-level API call that accepts stream and decode
+        progress (ProgressTracker): tracker for this transfer
+
+    Returns:
+        int: bytes transferred
+    """
+    for event in func(*args, stream=True, decode=True, **kwargs):
+        progress.update(event)
+    return progress.bytes
+
+
+def transfer_with_retries(
+    limiter: Optional[HostLimiter],
+    budget: Optional[RetryBudget],
+    func: Callable[..., Any],
+    progress: ProgressTracker,
+    *args: Any,
+    **kwargs: Any,
+) -> int:
+    """runs a streaming pull or push within the registry's limits, retrying it after transient errors while the image's
+    retry budget lasts
+
+    Args:
+        limiter (Optional[HostLimiter]): per-registry concurrency and rate limits to honor
+        budget (Optional[RetryBudget]): retries left for the image, or None to not retry
+        func (Callable[..., Any]): docker_client.api.pull or docker_client.api.push
+        progress (ProgressTracker): tracker for this transfer
+
+    Returns:
+        int: bytes transferred
+    """
+    attempt = 0
+    while True:
+        try:
+            return call_with_limits(limiter, progress.registry, stream_progress, func, progress, *args, **kwargs)
+        except docker.errors.APIError as e:
+            if budget is None or not is_transient(e) or not budget.spend(progress.image, e, attempt):
+                raise
+            attempt += 1
+            progress.interrupted(budget.stats)
+
+
+class MetricsTextfile:
+    """writes the meter's metrics to a node-exporter textfile every interval and once more when closed
+
+    Args:
+        logger (Any): logger
+        meter (ThroughputMeter): metrics to write
+        path (Path): textfile, which node-exporter expects to end in .prom
+        interval (float): seconds between writes
+    """
+
+    def __init__(self, logger: Any, meter: ThroughputMeter, path: Path, interval: float) -> None:
+        self.logger = logger
+        self.meter = meter
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="metrics-textfile", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self) -> None:
+        """replaces the textfile atomically, so node-exporter never reads a partial one"""
+        temporary = self.path.with_name(f"{self.path.name}.tmp")
+        try:
+            with open(temporary, "w", encoding="utf-8") as textfile:
+                textfile.write(self.meter.prometheus())
+            os.replace(temporary, self.path)
+        except OSError as e:
+            self.logger.warning(f"{self.path} - failed to write metrics: {e}")
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+
+# one meter for the whole run, so builds, both engines and the textfile all see the same transfers
+_meter = ThroughputMeter()
+
+
+def current_meter() -> ThroughputMeter:
+    return _meter
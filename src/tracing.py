@@ -0,0 +1,193 @@
+import json
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+class Span:
+    """one phase of one image, timed from entering to leaving the `with` block. Set `bytes` and `outcome` inside the block
+    to record what the phase did, an exception escaping it is recorded as the outcome"""
+
+    __slots__ = ("tracer", "phase", "image", "thread", "thread_id", "start", "end", "bytes", "outcome")
+
+    def __init__(self, tracer: "Tracer", phase: str, image: str) -> None:
+        self.tracer = tracer
+        self.phase = phase
+        self.image = image
+        self.bytes = 0
+        self.outcome = "ok"
+
+    def __enter__(self) -> "Span":
+        current = threading.current_thread()
+        self.thread = current.name
+        self.thread_id = current.ident or 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.outcome = f"error: {exc_type.__name__}"
+        self.tracer.add(self)
+
+
+class NullSpan:
+    """stands in for Span when tracing is off, so instrumented code costs one function call and nothing is recorded"""
+
+    bytes = 0
+    outcome = ""
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        pass
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """nearest-rank percentile
+
+    Args:
+        values (List[float]): sorted values
+        fraction (float): e.g. 0.95 for p95
+
+    Returns:
+        float: the value at that rank, 0 if there are none
+    """
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Tracer:
+    """collects spans from every thread of a run"""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.spans: List[Span] = list()
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def trace_events(self) -> Dict[str, Any]:
+        """renders the spans as Chrome trace events, which chrome://tracing and https://ui.perfetto.dev open
+
+        Returns:
+            Dict[str, Any]: trace in the JSON object format
+        """
+        pid = os.getpid()
+        events: List[Dict[str, Any]] = list()
+        threads: Dict[int, str] = dict()
+        for span in self.spans:
+            threads[span.thread_id] = span.thread
+            events.append(
+                {
+                    "name": span.phase,
+                    "cat": span.phase,
+                    "ph": "X",
+                    "ts": round((span.start - self.started) * 1000000),
+                    "dur": round((span.end - span.start) * 1000000),
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": {"image": span.image, "bytes": span.bytes, "outcome": span.outcome},
+                }
+            )
+        for thread_id, name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"started": self.started_wall}}
+
+    def summary(self) -> Dict[str, Any]:
+        """flattens the spans and adds up count, errors, bytes and duration percentiles per phase
+
+        Returns:
+            Dict[str, Any]: phases and spans
+        """
+        phases: Dict[str, Dict[str, Any]] = dict()
+        durations: Dict[str, List[float]] = dict()
+        for span in self.spans:
+            phase = phases.setdefault(span.phase, {"count": 0, "errors": 0, "bytes": 0})
+            phase["count"] += 1
+            phase["errors"] += 1 if span.outcome.startswith("error") else 0
+            phase["bytes"] += span.bytes
+            durations.setdefault(span.phase, list()).append(span.end - span.start)
+        for name, values in durations.items():
+            values.sort()
+            phases[name].update(
+                {
+                    "total_seconds": round(sum(values), 6),
+                    "p50_seconds": round(percentile(values, 0.50), 6),
+                    "p95_seconds": round(percentile(values, 0.95), 6),
+                    "max_seconds": round(values[-1], 6),
+                }
+            )
+        spans = [
+            {
+                "phase": span.phase,
+                "image": span.image,
+                "thread": span.thread,
+                "start": round(self.started_wall + span.start - self.started, 6),
+                "end": round(self.started_wall + span.end - self.started, 6),
+                "seconds": round(span.end - span.start, 6),
+                "bytes": span.bytes,
+                "outcome": span.outcome,
+            }
+            for span in sorted(self.spans, key=lambda span: span.start)
+        ]
+        return {"phases": phases, "spans": spans}
+
+    def write(self, path: Path) -> Path:
+        """writes the Chrome trace to path and the summary next to it
+
+        Args:
+            path (Path): trace file, e.g. trace.json
+
+        Returns:
+            Path: summary file, e.g. trace.summary.json
+        """
+        with self._lock:
+            trace, summary = self.trace_events(), self.summary()
+        summary_path = path.with_suffix(".summary.json")
+        for destination, content in [(path, trace), (summary_path, summary)]:
+            with open(destination, "w", encoding="utf-8") as trace_file:
+                json.dump(content, trace_file, indent=1 if destination == summary_path else None)
+        return summary_path
+
+
+# set by start_tracing(). Instrumented code checks it instead of having a tracer passed down to every phase
+_tracer: Optional[Tracer] = None
+
+
+def start_tracing() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def span(phase: str, image: str) -> Any:
+    """times one phase of one image when tracing is on
+
+    Args:
+        phase (str): e.g. pull or push
+        image (str): image or destination the phase works on
+
+    Returns:
+        Any: a Span to use in a `with` statement, or NULL_SPAN when tracing is off
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, phase, image)
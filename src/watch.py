@@ -0,0 +1,220 @@
+import os
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+from typing_extensions import LiteralString
+
+from build import construct_build
+from engines import EnginePool
+from entries import build_replication_entry
+from entries import ReplicationEntry
+from inputs import expand_inputs
+from inputs import InputErrors
+from inputs import STDIN
+from plan import in_shard
+from plan import source_key
+from registry import RegistryError
+from registry import RegistryPool
+from replicate import open_registry_pool
+from replicate import replicate
+from results import RESULT_REPLICATED
+from results import RESULT_UP_TO_DATE
+from results import RunResults
+from state import STATE_CONFIRMED
+from throughput import current_meter
+
+ImageReader = Callable[[InputErrors], Iterator[Tuple[str, Dict[LiteralString, Any]]]]
+
+
+class ConfigWatcher:
+    """notices changes to the input files by their modification times, so they're only parsed again when they change"""
+
+    def __init__(self, patterns: List[str]) -> None:
+        self.patterns = patterns
+        self._mtimes: Optional[Dict[str, Optional[int]]] = None
+
+    def changed(self) -> bool:
+        """checks whether any input file changed, appeared or disappeared since the last call. Globs are expanded again,
+        so new files matching them are picked up
+
+        Returns:
+            bool: True on the first call and whenever the inputs changed
+        """
+        mtimes: Dict[str, Optional[int]] = dict()
+        for path in expand_inputs(self.patterns, InputErrors()):
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+        return True
+
+
+class SourcePoller:
+    """polls the manifest digest of every source and hands out only the entries whose source changed since they were last
+    replicated. Polls are conditional, so registries that support If-None-Match answer 304 without a body
+
+    Args:
+        logger (Any): logger
+        registry_pool (RegistryPool): registry clients kept open between polls, along with their auth tokens
+    """
+
+    def __init__(self, logger: Any, registry_pool: RegistryPool) -> None:
+        self.logger = logger
+        self.registry_pool = registry_pool
+        self.digests: Dict[str, str] = dict()  # source key -> digest at the last poll
+        self.confirmed: Dict[str, str] = dict()  # entry key -> source digest last replicated to or found at the destination
+        self._handed_out: Dict[str, Tuple[str, Optional[str]]] = dict()  # result key -> entry key and polled digest
+
+    def poll(self, entry: ReplicationEntry) -> Optional[str]:
+        """resolves the current digest of an entry's source
+
+        Args:
+            entry (ReplicationEntry): entry whose source to poll
+
+        Returns:
+            Optional[str]: source digest, or None if it couldn't be resolved
+        """
+        if entry.final_sha256 != "":
+            return f"sha256:{entry.final_sha256}"
+        key = source_key(entry)
+        digest: Optional[str]
+        try:
+            client, path = self.registry_pool.resolve_source(entry.source_repository)
+            digest, status_code = client.head_manifest(path, entry.source_tag, self.digests.get(key))
+        except (RegistryError, requests.RequestException) as e:
+            self.logger.debug(f"{entry.source_endpoint} - failed to poll source: {e}")
+            return None
+        if digest is None:
+            self.logger.debug(f"{entry.source_endpoint} - unable to poll source, status {status_code}")
+            return None
+        self.digests[key] = digest
+        return digest
+
+    def changed_images(
+        self, images: List[Tuple[Dict[LiteralString, Any], ReplicationEntry]], interval: float
+    ) -> Iterator[Dict[LiteralString, Any]]:
+        """polls every distinct source once, spread evenly over the interval instead of all at once, and yields the
+        entries that need replicating as they're found: new entries, entries whose source changed, and entries whose
+        source couldn't be polled and that haven't been replicated yet
+
+        Args:
+            images (List[Tuple[Dict[LiteralString, Any], ReplicationEntry]]): entries from the input files
+            interval (float): seconds to spread the polls over, 0 to poll right away
+
+        Yields:
+            Iterator[Dict[LiteralString, Any]]: entries to replicate. Entries whose source changed since they were
+                replicated are forced, since their destination tag exists and would otherwise be considered up to date
+        """
+        sources: Dict[str, List[Tuple[Dict[LiteralString, Any], ReplicationEntry]]] = dict()
+        for image, entry in images:
+            sources.setdefault(source_key(entry), list()).append((image, entry))
+
+        started = time.monotonic()
+        changed = 0
+        for index, group in enumerate(sources.values()):
+            time.sleep(max(0.0, started + index * interval / len(sources) - time.monotonic()))
+            digest = self.poll(group[0][1])
+            for image, entry in group:
+                entry_key = f"{source_key(entry)} -> {entry.destination_endpoint}"
+                confirmed = self.confirmed.get(entry_key)
+                if confirmed is not None and (digest is None or digest == confirmed):
+                    continue
+                if digest is not None:
+                    # a state file confirmation of another digest doesn't count
+                    image = dict(image, source=dict(image["source"], polledDigest=digest))
+                if confirmed is not None:
+                    self.logger.info(f"{entry.source_endpoint} - source changed from {confirmed} to {digest}")
+                    image = dict(image, source=dict(image["source"], forcePull=True))
+                self._handed_out[f"{entry.source_endpoint} -> {entry.destination_endpoint}"] = (entry_key, digest)
+                changed += 1
+                yield image
+        self.logger.info(f"polled {len(sources)} sources in {time.monotonic() - started:.1f}s, {changed} entries to replicate")
+
+    def confirm(self, results: RunResults) -> None:
+        """remembers the source digest of every handed out entry that's now at its destination. Failed entries aren't
+        remembered, so they're tried again on the next poll, and neither are entries skipped because of the state file,
+        since nothing was checked for them
+
+        Args:
+            results (RunResults): outcome of the entries handed out since the last call
+        """
+        for result_key, (entry_key, digest) in self._handed_out.items():
+            result = results.results.get(result_key, dict())
+            if result.get("detail") == STATE_CONFIRMED:
+                continue
+            if digest is not None and result.get("status") in (RESULT_REPLICATED, RESULT_UP_TO_DATE):
+                self.confirmed[entry_key] = digest
+        self._handed_out.clear()
+
+    def forget_except(self, images: List[Tuple[Dict[LiteralString, Any], ReplicationEntry]]) -> None:
+        """drops what's known about entries no longer in the input files"""
+        keys = {f"{source_key(entry)} -> {entry.destination_endpoint}" for _, entry in images}
+        self.confirmed = {key: digest for key, digest in self.confirmed.items() if key in keys}
+        sources = {source_key(entry) for _, entry in images}
+        self.digests = {key: digest for key, digest in self.digests.items() if key in sources}
+
+
+def watch(logger: Any, arguments: Any, engines: EnginePool, read_images: ImageReader) -> None:
+    """keeps replicating every --watch seconds until interrupted. The docker engines, registry sessions and auth tokens stay
+    open between passes, the input files are only parsed again when they change, and only entries whose source changed are
+    replicated. Builds run on every pass, since their build folders can change without the input files changing
+
+    Args:
+        arguments (Any): CLI arguments
+        engines (EnginePool): docker engines, kept for every pass. Builds run on the first one
+        read_images (ImageReader): reads and validates the entries of the input files
+    """
+    if STDIN in arguments.input_files:
+        logger.error("--watch needs input files it can read again, not stdin")
+        return
+    config = ConfigWatcher(arguments.input_files)
+    registry_pool = open_registry_pool(logger, arguments)
+    poller = SourcePoller(logger, registry_pool)
+    images: List[Tuple[Dict[LiteralString, Any], ReplicationEntry]] = list()
+    builds: List[Dict[LiteralString, Any]] = list()
+    interval = 0.0  # the first pass polls right away
+    passes = 0
+    try:
+        while True:
+            started = time.monotonic()
+            passes += 1
+            if config.changed():
+                logger.info(f"watch pass {passes} - reading input files")
+                errors = InputErrors()
+                builds = list()
+                images = list()
+                for kind, image in read_images(errors):
+                    if kind == "build":
+                        builds.append(image)
+                        continue
+                    entry = build_replication_entry(logger, image)
+                    if entry is not None and in_shard(source_key(entry), arguments.shard):
+                        images.append((image, entry))
+                errors.log(logger)
+                poller.forget_except(images)
+
+            results = RunResults(arguments.shard)
+            if builds:
+                # an unchanged build context hashes to the label at the destination, so unchanged builds are only hashed
+                construct_build(logger, arguments, engines.primary.client, builds, results)
+            replicate(logger, arguments, engines, poller.changed_images(images, interval), results, registry_pool)
+            poller.confirm(results)
+            current_meter().log(logger)
+            if arguments.result_file is not None:
+                results.write(arguments.result_file)
+            interval = arguments.watch
+            logger.info(f"watch pass {passes} - done in {time.monotonic() - started:.1f}s: {results.counts()}")
+            # polling takes the whole interval unless there's nothing to poll
+            time.sleep(max(0.0, started + interval - time.monotonic()))
+    finally:
+        registry_pool.close()
@@ -0,0 +1,56 @@
+import importlib.util
+import sys
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import Tuple
+
+import pytest
+import verboselogs
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / "src")]
+
+from fakes import FakeRegistry  # noqa: E402
+
+verboselogs.install()
+
+
+@pytest.fixture(scope="session")
+def parse_arguments() -> Callable[..., Any]:
+    """parses a command line the way container-image-replicator does, without running it
+
+    Returns:
+        Callable[..., Any]: takes the CLI arguments and returns the parsed namespace
+    """
+    spec = importlib.util.spec_from_file_location("container_image_replicator", ROOT / "src" / "container-image-replicator.py")
+    assert spec is not None and spec.loader is not None
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+
+    def parse(*argv: str) -> Any:
+        argv_before = sys.argv
+        sys.argv = ["container-image-replicator", *argv]
+        try:
+            return cli.init_arg_parser()
+        finally:
+            sys.argv = argv_before
+
+    return parse
+
+
+@pytest.fixture
+def registry() -> Iterator[FakeRegistry]:
+    registry = FakeRegistry()
+    yield registry
+    registry.close()
+
+
+@pytest.fixture
+def registries() -> Iterator[Tuple[FakeRegistry, FakeRegistry]]:
+    """a source and a destination registry"""
+    source, destination = FakeRegistry(), FakeRegistry()
+    yield source, destination
+    source.close()
+    destination.close()
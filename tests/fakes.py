@@ -0,0 +1,565 @@
+import hashlib
+import json
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import docker
+import requests
+
+from entries import parse_image_reference
+from registry import MEDIA_TYPE_OCI_MANIFEST
+
+MEDIA_TYPE_OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+MEDIA_TYPE_OCI_LAYER = "application/vnd.oci.image.layer.v1.tar+gzip"
+
+
+def sha256_digest(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def api_error(error: Any, message: str, status_code: int) -> Exception:
+    """builds a docker-py error carrying the HTTP status the daemon would have answered with"""
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = HTTPStatus(status_code).phrase
+    # the daemon puts the registry's message in the body of its error response, which docker-py calls the explanation
+    built: Exception = error(message, response=response, explanation=message)
+    return built
+
+
+def image_config(layers: List[bytes], labels: Optional[Dict[str, str]] = None) -> bytes:
+    """builds an image config, which like a real one names its layers, so that images with different layers get different IDs"""
+    rootfs = {"type": "layers", "diff_ids": [sha256_digest(layer) for layer in layers]}
+    return json.dumps({"architecture": "amd64", "os": "linux", "config": {"Labels": labels or dict()}, "rootfs": rootfs}).encode()
+
+
+class InjectedError(Exception):
+    """a failure the fake registry was told to inject, answered with a 503"""
+
+
+class Link:
+    """bandwidth shared by every transfer to or from one registry. Transfers queue up behind each other, so concurrent
+    transfers split the bandwidth like they would on a real link
+
+    Args:
+        bandwidth (float): bytes per second, 0 for unlimited
+    """
+
+    def __init__(self, bandwidth: float) -> None:
+        self.bandwidth = bandwidth
+        self._free_at = 0.0
+        self._lock = threading.Lock()
+
+    def transfer(self, size: int) -> None:
+        """blocks for as long as sending size bytes takes once the transfers ahead of it are done"""
+        if self.bandwidth <= 0 or size <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._free_at = max(now, self._free_at) + size / self.bandwidth
+            done = self._free_at
+        time.sleep(max(0.0, done - time.monotonic()))
+
+
+class RegistryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # clients dropping their connection, e.g. after a failed request, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeRegistry:
+    """an in-memory registry serving enough of the OCI distribution API for the registry engine, served over HTTP on
+    localhost. The fake docker daemon reads and writes its store directly, through the same latency, bandwidth and error
+    injection, and every request is counted either way
+
+    Args:
+        latency (float): seconds added to every request
+        bandwidth (float): bytes per second shared by all transfers, 0 for unlimited
+        error_rate (float): fraction of requests answered with a 503
+        seed (int): seed for picking the failing requests, so runs are repeatable
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = 0.0, error_rate: float = 0.0, seed: int = 0) -> None:
+        self.latency = latency
+        self.link = Link(bandwidth)
+        self.error_rate = error_rate
+        self.blobs: Dict[str, bytes] = dict()  # digest -> content
+        self.repositories: Dict[str, Set[str]] = dict()  # repository -> digests of the blobs linked into it
+        self.manifests: Dict[Tuple[str, str], Tuple[bytes, str]] = dict()  # repository and tag or digest -> manifest, media type
+        self.uploads: Dict[str, bytearray] = dict()
+        self.requests: Counter[str] = Counter()  # e.g. "HEAD manifest" -> count
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.errors_injected = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = RegistryServer(("127.0.0.1", 0), make_handler(self))
+        self.host = f"127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name=f"registry-{self.host}", daemon=True).start()
+
+    def handle(self, method: str, kind: str, received: int = 0) -> None:
+        """accounts for one request: counts it, waits out latency and the transfer of its request body, and decides
+        whether it fails
+
+        Args:
+            method (str): HTTP method
+            kind (str): manifest, blob, upload or other
+            received (int): bytes in the request body
+
+        Raises:
+            InjectedError: if the request was picked to fail
+        """
+        with self._lock:
+            self.requests[f"{method} {kind}"] += 1
+            self.bytes_received += received
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            if failed:
+                self.errors_injected += 1
+        time.sleep(self.latency)
+        self.link.transfer(received)
+        if failed:
+            raise InjectedError(f"503 Service Unavailable from {self.host}")
+
+    def send(self, size: int) -> None:
+        """waits out the transfer of a response body"""
+        with self._lock:
+            self.bytes_sent += size
+        self.link.transfer(size)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.requests.clear()
+            self.bytes_received = self.bytes_sent = self.errors_injected = 0
+
+    def has_blob(self, repository: str, digest: str) -> bool:
+        with self._lock:
+            return digest in self.repositories.get(repository, set())
+
+    def link_blob(self, repository: str, digest: str, content: Optional[bytes] = None) -> None:
+        with self._lock:
+            if content is not None:
+                self.blobs[digest] = content
+            self.repositories.setdefault(repository, set()).add(digest)
+
+    def mountable(self, digest: str) -> bool:
+        """whether a blob is stored in any repository, like a registry that allows mounting from any of them"""
+        with self._lock:
+            return digest in self.blobs
+
+    def put_manifest(self, repository: str, reference: str, raw: bytes, media_type: str) -> str:
+        digest = sha256_digest(raw)
+        with self._lock:
+            self.manifests[(repository, reference)] = (raw, media_type)
+            self.manifests[(repository, digest)] = (raw, media_type)
+        return digest
+
+    def get_manifest(self, repository: str, reference: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            return self.manifests.get((repository, reference))
+
+    def seed_image(self, repository: str, tag: str, layers: List[bytes], labels: Optional[Dict[str, str]] = None) -> str:
+        """stores an image without counting any requests, for setting up a benchmark
+
+        Args:
+            repository (str): repository path
+            tag (str): tag
+            layers (List[bytes]): layer contents
+            labels (Optional[Dict[str, str]]): labels in the image config
+
+        Returns:
+            str: manifest digest
+        """
+        config = image_config(layers, labels)
+        descriptors = list()
+        for media_type, content in [(MEDIA_TYPE_OCI_CONFIG, config)] + [(MEDIA_TYPE_OCI_LAYER, layer) for layer in layers]:
+            digest = sha256_digest(content)
+            self.link_blob(repository, digest, content)
+            descriptors.append({"mediaType": media_type, "digest": digest, "size": len(content)})
+        manifest = {"schemaVersion": 2, "mediaType": MEDIA_TYPE_OCI_MANIFEST, "config": descriptors[0], "layers": descriptors[1:]}
+        return self.put_manifest(repository, tag, json.dumps(manifest).encode(), MEDIA_TYPE_OCI_MANIFEST)
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def make_handler(registry: FakeRegistry) -> Any:
+    """builds the request handler class serving a fake registry"""
+
+    class RegistryHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def reply(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None, length: Optional[int] = None) -> None:
+            self.send_response(status)
+            for name, value in (headers or dict()).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body) if length is None else length))
+            self.end_headers()
+            if self.command != "HEAD" and body:
+                registry.send(len(body))
+                self.wfile.write(body)
+
+        def route(self) -> None:
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            upload = re.match(r"^/v2/(.+)/blobs/uploads/(.*)$", url.path)
+            content = re.match(r"^/v2/(.+)/(manifests|blobs)/([^/]+)$", url.path)
+            kind = "upload" if upload else content.group(2).rstrip("s") if content else "other"
+            try:
+                registry.handle(self.command, kind, len(body))
+            except InjectedError as e:
+                return self.reply(503, str(e).encode())
+            if upload:
+                return self.upload(upload.group(1), upload.group(2), query, body)
+            if content and kind == "blob":
+                return self.blob(content.group(1), content.group(3))
+            if content:
+                return self.manifest(content.group(1), content.group(3), body)
+            self.reply(200 if url.path == "/v2/" else 404)
+
+        def upload(self, repository: str, session: str, query: Dict[str, List[str]], body: bytes) -> None:
+            if self.command == "POST":
+                if "mount" in query and registry.mountable(query["mount"][0]):
+                    registry.link_blob(repository, query["mount"][0])
+                    return self.reply(201, headers={"Location": f"/v2/{repository}/blobs/{query['mount'][0]}"})
+                session = str(uuid.uuid4())
+                registry.uploads[session] = bytearray()
+                return self.reply(202, headers={"Location": f"/v2/{repository}/blobs/uploads/{session}"})
+            if session not in registry.uploads:
+                return self.reply(404)
+            data = registry.uploads[session]
+            if self.command == "PATCH":
+                data.extend(body)
+            # Range is inclusive, so an empty upload has none
+            headers = {"Location": f"/v2/{repository}/blobs/uploads/{session}", **({"Range": f"0-{len(data) - 1}"} if data else dict())}
+            if self.command == "PATCH":
+                return self.reply(202, headers=headers)
+            if self.command == "GET":
+                return self.reply(204, headers=headers)
+            if self.command == "DELETE":
+                del registry.uploads[session]
+                return self.reply(204)
+            if self.command == "PUT":
+                data.extend(body)
+                digest = query.get("digest", [""])[0]
+                if sha256_digest(bytes(data)) != digest:
+                    return self.reply(400, b"digest mismatch")
+                del registry.uploads[session]
+                registry.link_blob(repository, digest, bytes(data))
+                return self.reply(201, headers={"Location": f"/v2/{repository}/blobs/{digest}", "Docker-Content-Digest": digest})
+            self.reply(405)
+
+        def blob(self, repository: str, digest: str) -> None:
+            if not registry.has_blob(repository, digest):
+                return self.reply(404)
+            data = registry.blobs[digest]
+            if self.command == "HEAD":
+                return self.reply(200, headers={"Docker-Content-Digest": digest}, length=len(data))
+            offset = int(re.sub(r"\D", "", self.headers.get("Range", "").split("-")[0]) or 0)
+            if offset:
+                return self.reply(
+                    206, data[offset:], {"Docker-Content-Digest": digest, "Content-Range": f"bytes {offset}-{len(data) - 1}/{len(data)}"}
+                )
+            self.reply(200, data, {"Docker-Content-Digest": digest})
+
+        def manifest(self, repository: str, reference: str, body: bytes) -> None:
+            if self.command == "PUT":
+                digest = registry.put_manifest(repository, reference, body, self.headers.get("Content-Type", MEDIA_TYPE_OCI_MANIFEST))
+                return self.reply(201, headers={"Docker-Content-Digest": digest, "Location": f"/v2/{repository}/manifests/{digest}"})
+            stored = registry.get_manifest(repository, reference)
+            if stored is None:
+                return self.reply(404)
+            raw, media_type = stored
+            digest = sha256_digest(raw)
+            if self.command == "HEAD" and self.headers.get("If-None-Match") == f'"{digest}"':
+                return self.reply(304)
+            headers = {"Content-Type": media_type, "Docker-Content-Digest": digest, "ETag": f'"{digest}"'}
+            self.reply(200, raw, headers, length=len(raw))
+
+        do_GET = do_HEAD = do_PUT = do_POST = do_PATCH = do_DELETE = route
+
+    return RegistryHandler
+
+
+class FakeImage:
+    """a local image of the fake daemon, shaped like a docker-py Image"""
+
+    def __init__(self, daemon: "FakeDocker", manifest: Dict[str, Any], config: bytes) -> None:
+        self.daemon = daemon
+        self.manifest = manifest
+        self.config = config
+        self.id = sha256_digest(config)
+        self.tags: List[str] = list()
+        self.digests: List[str] = list()
+
+    @property
+    def attrs(self) -> Dict[str, Any]:
+        config = json.loads(self.config)
+        return {
+            "Id": self.id,
+            "RepoTags": list(self.tags),
+            "RepoDigests": list(self.digests),
+            "Size": sum(int(layer["size"]) for layer in self.manifest["layers"]),
+            "Os": config.get("os", "linux"),
+            "Architecture": config.get("architecture", "amd64"),
+            "Config": config.get("config", dict()),
+        }
+
+    def tag(self, repository: str, tag: Optional[str] = None, **kwargs: Any) -> bool:
+        self.daemon.tag(self, f"{repository}:{tag or 'latest'}")
+        return True
+
+
+class FakeImages:
+    """the images collection of the fake daemon"""
+
+    def __init__(self, daemon: "FakeDocker") -> None:
+        self.daemon = daemon
+
+    def list(self, **kwargs: Any) -> List[FakeImage]:
+        with self.daemon.lock:
+            return list(self.daemon.local.values())
+
+    def get(self, reference: str) -> FakeImage:
+        image = self.daemon.find(reference)
+        if image is None:
+            raise api_error(docker.errors.ImageNotFound, f"No such image: {reference}", 404)
+        return image
+
+    def remove(self, image: str, force: bool = False, **kwargs: Any) -> None:
+        with self.daemon.lock:
+            removed = self.daemon.local.pop(image, None)
+            if removed is None:
+                return
+            # layers go with the last image using them, like the daemon frees disk space
+            used = {
+                layer["digest"] for other in self.daemon.local.values() for layer in [other.manifest["config"]] + other.manifest["layers"]
+            }
+            for layer in [removed.manifest["config"]] + removed.manifest["layers"]:
+                if layer["digest"] not in used:
+                    self.daemon.layers.pop(layer["digest"], None)
+        self.daemon.emit("delete", removed.id)
+
+    def get_registry_data(self, name: str, **kwargs: Any) -> Dict[str, Any]:
+        repository, _, tag = name.rpartition(":")
+        registry, path = self.daemon.registry_for(repository)
+        try:
+            registry.handle("GET", "manifest")
+        except InjectedError as e:
+            raise api_error(docker.errors.APIError, str(e), 503)
+        stored = registry.get_manifest(path, tag)
+        if stored is None:
+            raise api_error(docker.errors.ImageNotFound, f"manifest unknown: {name}", 404)
+        return {"Descriptor": {"digest": sha256_digest(stored[0])}}
+
+    def build(self, path: str, tag: str, labels: Optional[Dict[str, str]] = None, **kwargs: Any) -> Tuple[FakeImage, List[Any]]:
+        time.sleep(self.daemon.build_seconds)
+        # every build shares a base layer and adds one of its own, like FROM and COPY
+        layer = hashlib.sha256(f"{path}\n{json.dumps(labels, sort_keys=True)}".encode()).digest() * 64
+        layers = [self.daemon.base_layer, layer]
+        config = image_config(layers, labels)
+        self.daemon.layers[sha256_digest(config)] = config
+        for content in layers:
+            self.daemon.layers[sha256_digest(content)] = content
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_TYPE_OCI_MANIFEST,
+            "config": {"mediaType": MEDIA_TYPE_OCI_CONFIG, "digest": sha256_digest(config), "size": len(config)},
+            "layers": [{"mediaType": MEDIA_TYPE_OCI_LAYER, "digest": sha256_digest(content), "size": len(content)} for content in layers],
+        }
+        image = self.daemon.store(manifest, config)
+        self.daemon.tag(image, tag)
+        return image, list()
+
+
+class FakeEvents:
+    """a stream of daemon events that ends when closed"""
+
+    def __init__(self) -> None:
+        self.queue: queue.Queue[Optional[Dict[str, Any]]] = queue.Queue()
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        while (event := self.queue.get()) is not None:
+            yield event
+
+    def close(self) -> None:
+        self.queue.put(None)
+
+
+class FakeAPI:
+    """the low-level API client of the fake daemon, streaming progress events for pulls and pushes"""
+
+    def __init__(self, daemon: "FakeDocker") -> None:
+        self.daemon = daemon
+
+    def pull(self, repository: str, tag: Optional[str] = None, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        return self.daemon.pull(repository, tag or "latest")
+
+    def push(self, repository: str, tag: Optional[str] = None, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        return self.daemon.push(repository, tag or "latest")
+
+
+class FakeDocker:
+    """an in-process stand-in for a docker daemon and its docker-py client. Pulls and pushes go to the fake registries
+    the way the daemon would talk to them: a manifest request, then a request per layer that isn't local or at the
+    destination yet, reporting progress events as layers move. Layers are stored once however many images use them
+
+    Args:
+        registries (List[FakeRegistry]): registries the daemon can reach
+        build_seconds (float): time every build takes
+    """
+
+    def __init__(self, registries: List[FakeRegistry], build_seconds: float = 0.0) -> None:
+        self.registries = {registry.host: registry for registry in registries}
+        self.build_seconds = build_seconds
+        self.local: Dict[str, FakeImage] = dict()  # image ID -> image
+        self.layers: Dict[str, bytes] = dict()  # digest -> content
+        self.base_layer = b"base layer of every build\n" * 64
+        self.lock = threading.Lock()
+        self.subscribers: List[FakeEvents] = list()
+        self.api = FakeAPI(self)
+        self.images = FakeImages(self)
+
+    def events(self, **kwargs: Any) -> FakeEvents:
+        events = FakeEvents()
+        with self.lock:
+            self.subscribers.append(events)
+        return events
+
+    def emit(self, action: str, image_id: str) -> None:
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            events.queue.put({"Type": "image", "Action": action, "Actor": {"ID": image_id}})
+
+    def registry_for(self, repository: str) -> Tuple[FakeRegistry, str]:
+        host, path = parse_image_reference(repository)
+        return self.registries[host], path
+
+    def find(self, reference: str) -> Optional[FakeImage]:
+        with self.lock:
+            if reference in self.local:
+                return self.local[reference]
+            for image in self.local.values():
+                if reference in image.tags or reference in image.digests:
+                    return image
+        return None
+
+    def store(self, manifest: Dict[str, Any], config: bytes) -> FakeImage:
+        image = FakeImage(self, manifest, config)
+        with self.lock:
+            image = self.local.setdefault(image.id, image)
+        return image
+
+    def tag(self, image: FakeImage, reference: str) -> None:
+        with self.lock:
+            # a tag moves from whatever image had it before
+            for other in self.local.values():
+                if reference in other.tags:
+                    other.tags.remove(reference)
+            image.tags.append(reference)
+        self.emit("tag", image.id)
+
+    def pull(self, repository: str, tag: str) -> Iterator[Dict[str, Any]]:
+        registry, path = self.registry_for(repository)
+        yield {"status": f"Pulling from {path}", "id": tag}
+        try:
+            registry.handle("GET", "manifest")
+        except InjectedError as e:
+            yield {"error": f"received unexpected HTTP status: {e}"}
+            return
+        stored = registry.get_manifest(path, tag)
+        if stored is None:
+            yield {"error": f"manifest for {repository}:{tag} not found: manifest unknown"}
+            return
+        raw, _ = stored
+        manifest = json.loads(raw)
+        for layer in [manifest["config"]] + manifest["layers"]:
+            digest, size, short = layer["digest"], int(layer["size"]), layer["digest"][7:19]
+            if digest in self.layers:
+                yield {"status": "Already exists", "progressDetail": dict(), "id": short}
+                continue
+            try:
+                registry.handle("GET", "blob")
+            except InjectedError as e:
+                yield {"error": f"received unexpected HTTP status: {e}"}
+                return
+            registry.send(size)
+            yield {"status": "Downloading", "progressDetail": {"current": size, "total": size}, "id": short}
+            yield {"status": "Download complete", "progressDetail": dict(), "id": short}
+            self.layers[digest] = registry.blobs[digest]
+            yield {"status": "Pull complete", "progressDetail": dict(), "id": short}
+        image = self.store(manifest, self.layers[manifest["config"]["digest"]])
+        with self.lock:
+            image.digests.append(f"{repository}@{sha256_digest(raw)}")
+        self.tag(image, f"{repository}:{tag}")
+        self.emit("pull", image.id)
+        yield {"status": f"Digest: {sha256_digest(raw)}"}
+
+    def push(self, repository: str, tag: str) -> Iterator[Dict[str, Any]]:
+        registry, path = self.registry_for(repository)
+        image = self.find(f"{repository}:{tag}")
+        if image is None:
+            yield {"error": f"An image does not exist locally with the tag: {repository}"}
+            return
+        yield {"status": f"The push refers to repository [{repository}]"}
+        for layer in [image.manifest["config"]] + image.manifest["layers"]:
+            digest, size, short = layer["digest"], int(layer["size"]), layer["digest"][7:19]
+            try:
+                registry.handle("HEAD", "blob")
+                if registry.has_blob(path, digest):
+                    yield {"status": "Layer already exists", "progressDetail": dict(), "id": short}
+                    continue
+                if registry.mountable(digest):
+                    registry.handle("POST", "upload")
+                    registry.link_blob(path, digest)
+                    yield {"status": "Mounted from another repository", "progressDetail": dict(), "id": short}
+                    continue
+                registry.handle("POST", "upload")
+                yield {"status": "Pushing", "progressDetail": {"current": 0, "total": size}, "id": short}
+                registry.handle("PUT", "upload", size)
+            except InjectedError as e:
+                yield {"error": f"received unexpected HTTP status: {e}"}
+                return
+            registry.link_blob(path, digest, self.layers[digest])
+            yield {"status": "Pushing", "progressDetail": {"current": size, "total": size}, "id": short}
+            yield {"status": "Pushed", "progressDetail": dict(), "id": short}
+        try:
+            registry.handle("PUT", "manifest")
+        except InjectedError as e:
+            yield {"error": f"received unexpected HTTP status: {e}"}
+            return
+        raw = json.dumps(image.manifest).encode()
+        digest = registry.put_manifest(path, tag, raw, MEDIA_TYPE_OCI_MANIFEST)
+        yield {"status": f"{tag}: digest: {digest} size: {len(raw)}"}
+
+    def close(self) -> None:
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, list()
+        for events in subscribers:
+            events.close()
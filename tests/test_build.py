@@ -0,0 +1,68 @@
+import logging
+from pathlib import Path
+from typing import Any
+from typing import Callable
+
+import requests
+from fakes import FakeDocker
+from fakes import FakeRegistry
+
+from build import construct_build
+from results import RESULT_BUILT
+from results import RESULT_FAILED
+from results import RunResults
+
+logger = logging.getLogger("test_build")
+
+
+def build_entry(tmp_path: Path, registry: FakeRegistry, name: str) -> Any:
+    build_folder = tmp_path / name
+    build_folder.mkdir()
+    (build_folder / "Dockerfile").write_text(f"FROM scratch\nLABEL name={name}\n")
+    return {
+        "build": {"build_folder": str(build_folder), "tags": ["1.0", "latest"]},
+        "destination": {"repository": f"{registry.host}/{name}"},
+    }
+
+
+def test_unexpected_build_error_fails_only_that_entry(
+    tmp_path: Path, registry: FakeRegistry, parse_arguments: Callable[..., Any], monkeypatch: Any
+) -> None:
+    daemon = FakeDocker([registry])
+    build = daemon.images.build
+
+    def flaky_build(path: str, **kwargs: Any) -> Any:
+        if path.endswith("broken"):
+            raise requests.ConnectionError("connection to the daemon was lost")
+        return build(path, **kwargs)
+
+    monkeypatch.setattr(daemon.images, "build", flaky_build)
+    results = RunResults()
+    arguments = parse_arguments(str(tmp_path / "images.yaml"))
+    construct_build(
+        logger, arguments, daemon, [build_entry(tmp_path, registry, "broken"), build_entry(tmp_path, registry, "fine")], results
+    )
+
+    outcomes = {result["destination"].split("/", 1)[1]: (result["status"], result["detail"]) for result in results.results.values()}
+    assert outcomes["broken:1.0"] == outcomes["broken:latest"] == (RESULT_FAILED, "connection to the daemon was lost")
+    assert outcomes["fine:1.0"][0] == outcomes["fine:latest"][0] == RESULT_BUILT
+
+
+def test_unexpected_push_error_fails_only_that_tag(
+    tmp_path: Path, registry: FakeRegistry, parse_arguments: Callable[..., Any], monkeypatch: Any
+) -> None:
+    daemon = FakeDocker([registry])
+    push = daemon.api.push
+
+    def flaky_push(repository: str, tag: str, **kwargs: Any) -> Any:
+        if tag == "latest":
+            raise OSError("disk full")
+        return push(repository, tag=tag, **kwargs)
+
+    monkeypatch.setattr(daemon.api, "push", flaky_push)
+    results = RunResults()
+    construct_build(logger, parse_arguments(str(tmp_path / "images.yaml")), daemon, [build_entry(tmp_path, registry, "app")], results)
+
+    outcomes = {result["destination"].split("/", 1)[1]: (result["status"], result["detail"]) for result in results.results.values()}
+    assert outcomes["app:1.0"][0] == RESULT_BUILT
+    assert outcomes["app:latest"] == (RESULT_FAILED, "disk full")
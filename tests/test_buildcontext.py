@@ -0,0 +1,41 @@
+import os
+from pathlib import Path
+
+from buildcontext import hash_build_context
+from buildcontext import hash_file
+
+
+def make_context(tmp_path: Path) -> Path:
+    context = tmp_path / "context"
+    context.mkdir()
+    (context / "Dockerfile").write_text("FROM scratch\nCOPY . /\n")
+    (context / "app.txt").write_text("app")
+    return context
+
+
+def test_special_files_are_not_read(tmp_path: Path) -> None:
+    context = make_context(tmp_path)
+    before = hash_build_context(context, context / "Dockerfile", dict())
+    # opening a FIFO without a writer would block the hash forever
+    os.mkfifo(context / "pipe")
+    assert hash_build_context(context, context / "Dockerfile", dict()) != before
+
+
+def test_symlinks_are_hashed_by_target_path(tmp_path: Path) -> None:
+    context = make_context(tmp_path)
+    (context / "data").mkdir()
+    (context / "data" / "file.txt").write_text("one")
+    before = hash_build_context(context, context / "Dockerfile", dict())
+
+    # docker sends a symlink to a directory as a symlink, so adding one changes the context
+    (context / "link").symlink_to("data")
+    with_link = hash_build_context(context, context / "Dockerfile", dict())
+    assert with_link != before
+
+    (context / "link").unlink()
+    (context / "link").symlink_to("data/file.txt")
+    assert hash_build_context(context, context / "Dockerfile", dict()) != with_link
+    # the link is hashed by where it points, not by what it points to, and a dangling link is fine
+    assert hash_file(context / "link") != hash_file(context / "data" / "file.txt")
+    (context / "dangling").symlink_to("missing.txt")
+    hash_build_context(context, context / "Dockerfile", dict())
@@ -0,0 +1,93 @@
+import io
+import logging
+from pathlib import Path
+from typing import Any
+from typing import List
+
+import pytest
+import yaml
+
+from inputs import InputErrors
+from inputs import iter_input_images
+from inputs import iter_yaml_images
+
+logger = logging.getLogger("test_inputs")
+
+
+def read_yaml(text: str) -> Any:
+    errors = InputErrors()
+    images = list(iter_yaml_images(io.StringIO(text), "images.yaml", errors))
+    return images, errors.errors
+
+
+def test_anchors_and_merge_keys() -> None:
+    images, errors = read_yaml(
+        """
+defaults: &defaults
+  source:
+    tag: "1.0"
+images:
+  - <<: *defaults
+    destination: &mirror
+      repository: mirror/app
+  - source:
+      repository: other
+    destination: *mirror
+"""
+    )
+    assert errors == list()
+    # an anchor outside the list and one defined by an earlier entry both resolve
+    assert images == [
+        {"source": {"tag": "1.0"}, "destination": {"repository": "mirror/app"}},
+        {"source": {"repository": "other"}, "destination": {"repository": "mirror/app"}},
+    ]
+
+
+def test_multiple_documents() -> None:
+    images, errors = read_yaml("images:\n  - one\n  - two\n---\nimages:\n  - three\n")
+    assert images == ["one", "two", "three"]
+    assert errors == list()
+
+
+def test_anchors_are_per_document() -> None:
+    with pytest.raises(yaml.YAMLError, match="undefined alias"):
+        read_yaml("images:\n  - &first one\n---\nimages:\n  - *first\n")
+
+
+@pytest.mark.parametrize(
+    "text, error",
+    [
+        ("imagez:\n  - one\n", ("images.yaml", "no `images` list found, the input must be a mapping with an `images` key")),
+        ("- one\n", ("images.yaml", "no `images` list found, the input must be a mapping with an `images` key")),
+        ("images:\n  source: one\n", ("images.yaml", "`images` must be a list")),
+        ("", ("images.yaml", "input file is empty")),
+        (
+            "images: []\n---\nother: 1\n",
+            ("images.yaml (document 2)", "no `images` list found, the input must be a mapping with an `images` key"),
+        ),
+    ],
+)
+def test_documents_without_an_images_list(text: str, error: Any) -> None:
+    images, errors = read_yaml(text)
+    assert images == list()
+    assert errors == [error]
+
+
+def test_other_keys_may_follow_images() -> None:
+    images, errors = read_yaml("images:\n  - one\nextra:\n  nested: [1, 2]\n")
+    assert images == ["one"]
+    assert errors == list()
+
+
+def test_input_files_are_read_in_order_with_locations(tmp_path: Path) -> None:
+    (tmp_path / "a.yaml").write_text("images:\n  - one\n  - two\n")
+    (tmp_path / "b.jsonl").write_text('"three"\n\nnot json\n"four"\n')
+    (tmp_path / "c.yaml").write_text("images:\n  - [unterminated\n")
+    errors = InputErrors()
+    entries: List[Any] = list(iter_input_images(logger, [str(tmp_path / "*.*"), str(tmp_path / "missing.yaml")], errors))
+
+    a, b, c = (str(tmp_path / name) for name in ("a.yaml", "b.jsonl", "c.yaml"))
+    assert entries == [(f"{a}#0", "one"), (f"{a}#1", "two"), (f"{b}:1", "three"), (f"{b}:4", "four")]
+    assert [location for location, _ in errors.errors] == [f"{b}:3", c, str(tmp_path / "missing.yaml")]
+    assert errors.errors[1][1].startswith("failed to parse input file")
+    assert errors.errors[2][1].startswith("unable to read input file")
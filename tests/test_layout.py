@@ -0,0 +1,86 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+import pytest
+from fakes import FakeRegistry
+
+from engines import EnginePool
+from inputs import InputErrors
+from layout import iter_layout_images
+from layout import split_image_name
+from replicate import replicate
+from results import RESULT_REPLICATED
+from results import RESULT_UP_TO_DATE
+from results import RunResults
+
+logger = logging.getLogger("test_layout")
+
+
+def run(arguments: Any, images: List[Any]) -> RunResults:
+    results = RunResults()
+    engines = EnginePool(logger, connect=lambda: pytest.fail("layouts are copied without the daemon"))
+    replicate(logger, arguments, engines, images, results)
+    return results
+
+
+def statuses(results: RunResults) -> List[str]:
+    return sorted(result["status"] for result in results.results.values())
+
+
+@pytest.mark.parametrize(
+    "name, split",
+    [
+        ("localhost:5000/team/app:1.0", ("localhost:5000/team/app", "1.0")),
+        ("localhost:5000/team/app", ("localhost:5000/team/app", "latest")),
+        ("app", ("app", "latest")),
+    ],
+)
+def test_split_image_name(name: str, split: Tuple[str, str]) -> None:
+    assert split_image_name(name) == split
+
+
+def test_export_and_import_round_trip(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [b"shared base", b"app 1.0"])
+    source.seed_image("app", "2.0", [b"shared base", b"app 2.0"])
+    images = [
+        {"source": {"repository": f"{source.host}/app", "tag": tag}, "destination": {"repository": f"{destination.host}/mirror/app"}}
+        for tag in ("1.0", "2.0")
+    ]
+    layout = tmp_path / "layout"
+    export = parse_arguments("--export-dir", str(layout), str(tmp_path / "images.yaml"))
+
+    assert statuses(run(export, images)) == [RESULT_REPLICATED, RESULT_REPLICATED]
+    assert json.loads((layout / "oci-layout").read_text()) == {"imageLayoutVersion": "1.0.0"}
+    assert not (layout / ".incomplete").exists()
+    # two configs, two manifests, the shared layer once and one layer per tag
+    assert len(list((layout / "blobs" / "sha256").iterdir())) == 7
+    # nothing was pushed, and running the export again finds both images in the layout
+    assert destination.blobs == dict()
+    assert statuses(run(export, images)) == [RESULT_UP_TO_DATE, RESULT_UP_TO_DATE]
+
+    errors = InputErrors()
+    entries = [entry for _, entry in iter_layout_images(layout, errors)]
+    assert errors.errors == list()
+    assert [entry["destination"] for entry in entries] == [
+        {"repository": f"{destination.host}/mirror/app", "tag": tag} for tag in ("1.0", "2.0")
+    ]
+    assert statuses(run(parse_arguments("--import-dir", str(layout)), entries)) == [RESULT_REPLICATED, RESULT_REPLICATED]
+    for tag in ("1.0", "2.0"):
+        assert destination.get_manifest("mirror/app", tag) == source.get_manifest("app", tag)
+    assert destination.blobs == source.blobs
+
+
+def test_import_reports_unnamed_images_and_a_missing_index(tmp_path: Path) -> None:
+    (tmp_path / "index.json").write_text(json.dumps({"manifests": [{"digest": "sha256:" + "a" * 64, "annotations": dict()}]}))
+    errors = InputErrors()
+    assert list(iter_layout_images(tmp_path, errors)) == list()
+    assert list(iter_layout_images(tmp_path / "missing", errors)) == list()
+    assert [location for location, _ in errors.errors] == [f"{tmp_path / 'index.json'}#1", str(tmp_path / "missing" / "index.json")]
@@ -0,0 +1,138 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+import pytest
+from fakes import FakeDocker
+from fakes import FakeRegistry
+
+from engines import DockerEngine
+from engines import EnginePool
+from ordering import ScheduleReport
+from pipeline import Pipeline
+from pipeline import Stage
+from replicate import open_registry_pool
+from replicate import replicate
+from replicate import schedule_jobs
+from results import RESULT_FAILED
+from results import RunResults
+
+logger = logging.getLogger("test_pipeline")
+
+
+def test_run_shuts_down_when_items_raise() -> None:
+    processed: List[int] = list()
+
+    def items() -> Iterator[int]:
+        yield 1
+        raise ValueError("broken input")
+
+    pipeline = Pipeline(logger, [Stage("first", lambda item: item, 2, 1), Stage("second", processed.append, 2, 1)])
+    runner = threading.Thread(target=lambda: pytest.raises(ValueError, pipeline.run, items()))
+    runner.start()
+    runner.join(10)
+    assert not runner.is_alive()
+    assert processed == [1]
+
+
+def test_stage_errors_are_handed_to_failed() -> None:
+    failures: List[Any] = list()
+
+    def explode(item: int) -> int:
+        raise OSError(f"item {item}")
+
+    Pipeline(logger, [Stage("only", explode, 1, 1, failed=lambda item, error: failures.append((item, str(error))))]).run([1, 2])
+    assert failures == [(1, "item 1"), (2, "item 2")]
+
+
+@pytest.mark.parametrize("call", ["pull", "push"])
+def test_daemon_stage_errors_fail_the_entry(
+    tmp_path: Path, call: str, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any], monkeypatch: Any
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [b"layer"])
+    daemon = FakeDocker([source, destination])
+
+    def broken(*args: Any, **kwargs: Any) -> Any:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(daemon.api, call, broken)
+    engine = DockerEngine("fake", daemon)
+    arguments = parse_arguments("--engine", "daemon", "--local-cache-budget", "1GiB", str(tmp_path / "images.yaml"))
+    image = {"source": {"repository": f"{source.host}/app", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/app"}}
+    results = RunResults()
+    replicate(logger, arguments, EnginePool(logger, [engine]), [image], results)
+
+    [result] = results.results.values()
+    assert result["status"] == RESULT_FAILED
+    assert result["detail"] == f"{call} failed: disk full"
+    assert (engine.tasks, engine.failed) == (1, 1)
+
+
+def test_local_cache_outlives_a_pass(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    source.seed_image("first", "1.0", [b"first"])
+    source.seed_image("second", "1.0", [b"second"])
+    engine = DockerEngine("fake", FakeDocker([source, destination]))
+    engines = EnginePool(logger, [engine])
+    arguments = parse_arguments("--engine", "daemon", "--local-cache-budget", "1GiB", str(tmp_path / "images.yaml"))
+    for name in ("first", "second"):
+        image = {
+            "source": {"repository": f"{source.host}/{name}", "tag": "1.0"},
+            "destination": {"repository": f"{destination.host}/{name}"},
+        }
+        replicate(logger, arguments, engines, [image], RunResults())
+
+    # as in --watch, the image the first pass pulled is still the cache's to remove, not one that was there before
+    assert len(engine.cache.sizes) == 2
+    assert not engine.cache.preexisting
+
+
+def test_sources_seen_in_an_earlier_batch_are_held_back(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [b"app"])
+    source.seed_image("other", "1.0", [b"other"])
+    arguments = parse_arguments("--engine", "registry", "--batch-size", "1", str(tmp_path / "images.yaml"))
+    images = [
+        {"source": {"repository": f"{source.host}/{name}", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/{mirror}"}}
+        for name, mirror in [("app", "one"), ("app", "two"), ("other", "other"), ("app", "three")]
+    ]
+    registry_pool = open_registry_pool(logger, arguments)
+    try:
+        jobs = list(schedule_jobs(logger, arguments, registry_pool, ScheduleReport("file", 1), None, RunResults(), images))
+    finally:
+        registry_pool.close()
+
+    # each batch holds one entry, so app's later destinations come after its job was handed out, and get one job at the end
+    destinations = [[entry.destination_repository.split("/")[-1] for entry in job.entries] for job, _ in jobs]
+    assert destinations == [["one"], ["other"], ["two", "three"]]
+    assert [len(statuses) for _, statuses in jobs] == [1, 1, 2]
+
+
+def test_order_covers_every_batch(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    for name, size in [("small", 10), ("medium", 1000), ("large", 100000)]:
+        source.seed_image(name, "1.0", [b"x" * size])
+    arguments = parse_arguments("--engine", "registry", "--order", "size", "--batch-size", "1", str(tmp_path / "images.yaml"))
+    images = [
+        {"source": {"repository": f"{source.host}/{name}", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/{name}"}}
+        for name in ["small", "medium", "large"]
+    ]
+    registry_pool = open_registry_pool(logger, arguments)
+    try:
+        jobs = list(schedule_jobs(logger, arguments, registry_pool, ScheduleReport("size", 1), None, RunResults(), images))
+    finally:
+        registry_pool.close()
+
+    assert [job.source.source_repository.split("/")[-1] for job, _ in jobs] == ["large", "medium", "small"]
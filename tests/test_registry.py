@@ -0,0 +1,166 @@
+import json
+import logging
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import pytest
+import requests
+from fakes import FakeRegistry
+from fakes import sha256_digest
+
+from engines import EnginePool
+from registry import BlobUpload
+from registry import filter_index
+from registry import MEDIA_TYPE_OCI_INDEX
+from registry import MEDIA_TYPE_OCI_MANIFEST
+from registry import RegistryClient
+from registry import RegistryError
+from replicate import replicate
+from results import RESULT_REPLICATED
+from results import RunResults
+from retry import RetryBudget
+from retry import RetryStats
+
+logger = logging.getLogger("test_registry")
+
+
+def interrupt_patch(monkeypatch: Any, client: RegistryClient, number: int, arrived: int) -> None:
+    """makes the client's PATCH number `number` lose its connection after `arrived` bytes of the chunk reached the registry"""
+    request = client.request
+    patches: List[int] = list()
+
+    def flaky_request(method: str, url: str, scopes: List[str], **kwargs: Any) -> requests.Response:
+        if method == "PATCH":
+            patches.append(len(kwargs["data"]))
+            if len(patches) == number:
+                start = int(kwargs["headers"]["Content-Range"].split("-")[0])
+                data = kwargs["data"][:arrived]
+                headers = dict(kwargs["headers"], **{"Content-Range": f"{start}-{start + len(data) - 1}"})
+                request(method, url, scopes, **dict(kwargs, data=data, headers=headers))
+                raise requests.ConnectionError("connection reset by peer")
+        return request(method, url, scopes, **kwargs)
+
+    monkeypatch.setattr(client, "request", flaky_request)
+
+
+def upload(client: RegistryClient, chunks: List[bytes], budget: Any) -> Tuple[str, int]:
+    digest = sha256_digest(b"".join(chunks))
+    blob = BlobUpload(client, "app", digest, budget)
+    for chunk in chunks:
+        blob.write(chunk)
+    return digest, blob.finish()
+
+
+def test_interrupted_chunk_resumes_from_the_acknowledged_offset(registry: FakeRegistry, monkeypatch: Any) -> None:
+    client = RegistryClient(logger, registry.host, insecure=True)
+    interrupt_patch(monkeypatch, client, 2, 300)
+    budget = RetryBudget(logger, RetryStats(), 3, 0)
+    digest, size = upload(client, [b"a" * 1000, b"b" * 1000, b"c" * 1000], budget)
+
+    assert size == 3000
+    assert registry.blobs[digest] == b"a" * 1000 + b"b" * 1000 + b"c" * 1000
+    # only the 700 bytes of the second chunk that didn't arrive are sent again
+    assert (budget.stats.retries, budget.stats.bytes_resumed, budget.stats.bytes_retried) == (1, 1300, 700)
+
+
+def test_chunk_that_arrived_before_the_connection_dropped_is_not_sent_again(registry: FakeRegistry, monkeypatch: Any) -> None:
+    client = RegistryClient(logger, registry.host, insecure=True)
+    interrupt_patch(monkeypatch, client, 1, 1000)
+    budget = RetryBudget(logger, RetryStats(), 3, 0)
+    digest, size = upload(client, [b"a" * 1000, b"b" * 1000], budget)
+
+    assert size == 2000
+    assert registry.blobs[digest] == b"a" * 1000 + b"b" * 1000
+    assert (budget.stats.bytes_resumed, budget.stats.bytes_retried) == (1000, 0)
+    assert registry.requests["PATCH upload"] == 2
+
+
+def test_lost_upload_session_is_not_resumed(registry: FakeRegistry, monkeypatch: Any) -> None:
+    client = RegistryClient(logger, registry.host, insecure=True)
+    interrupt_patch(monkeypatch, client, 1, 0)
+    blob = BlobUpload(client, "app", sha256_digest(b"a" * 1000), RetryBudget(logger, RetryStats(), 3, 0))
+    registry.uploads.clear()
+    with pytest.raises(RegistryError, match="upload session lost"):
+        blob.write(b"a" * 1000)
+
+
+def test_interrupted_chunk_without_a_budget_fails(registry: FakeRegistry, monkeypatch: Any) -> None:
+    client = RegistryClient(logger, registry.host, insecure=True)
+    interrupt_patch(monkeypatch, client, 1, 300)
+    with pytest.raises(requests.ConnectionError):
+        upload(client, [b"a" * 1000], None)
+
+
+def test_copy_resumes_through_a_flaky_destination(
+    tmp_path: Any, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [bytes(range(256)) * 8192, b"second layer" * 100000])
+    destination.error_rate = 0.3
+    arguments = parse_arguments(
+        "--engine", "registry", "--blob-chunk-size", "1", "--retries", "100", "--retry-backoff", "0", str(tmp_path / "images.yaml")
+    )
+    image = {"source": {"repository": f"{source.host}/app", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/app"}}
+    results = RunResults()
+    engines = EnginePool(logger, connect=lambda: pytest.fail("the registry engine doesn't need the daemon"))
+    replicate(logger, arguments, engines, [image], results)
+
+    assert [result["status"] for result in results.results.values()] == [RESULT_REPLICATED]
+    # the failures are seeded, and some hit chunks that were then resumed
+    assert destination.requests["GET upload"] > 0
+    assert destination.get_manifest("app", "1.0") == source.get_manifest("app", "1.0")
+    assert destination.blobs == source.blobs
+
+
+def index_child(digest: str, platform: str, **annotations: str) -> Dict[str, Any]:
+    os, architecture = platform.split("/")
+    return {
+        "mediaType": MEDIA_TYPE_OCI_MANIFEST,
+        "digest": digest,
+        "size": 100,
+        "platform": {"os": os, "architecture": architecture},
+        "annotations": annotations,
+    }
+
+
+INDEX = {
+    "schemaVersion": 2,
+    "mediaType": MEDIA_TYPE_OCI_INDEX,
+    "manifests": [
+        index_child("sha256:amd64", "linux/amd64"),
+        index_child("sha256:arm64", "linux/arm64"),
+        index_child("sha256:amd64-attestation", "unknown/unknown", **{"vnd.docker.reference.digest": "sha256:amd64"}),
+        index_child("sha256:arm64-attestation", "unknown/unknown", **{"vnd.docker.reference.digest": "sha256:arm64"}),
+    ],
+}
+
+
+def test_filter_index_keeps_matching_children_and_their_attestations() -> None:
+    raw = json.dumps(INDEX, indent=2).encode("utf-8")
+    filtered, digest = filter_index(raw, MEDIA_TYPE_OCI_INDEX, ["linux/arm64"])
+
+    assert [child["digest"] for child in json.loads(filtered)["manifests"]] == ["sha256:arm64", "sha256:arm64-attestation"]
+    # compact, so the digest doesn't depend on how the source happened to indent its index
+    assert filtered == json.dumps(json.loads(filtered), separators=(",", ":")).encode("utf-8")
+    assert digest == sha256_digest(filtered)
+
+
+@pytest.mark.parametrize(
+    "manifest, platforms",
+    [
+        (INDEX, ["linux/amd64", "linux/arm64"]),
+        (INDEX, list()),
+        ({"schemaVersion": 2, "mediaType": MEDIA_TYPE_OCI_MANIFEST, "layers": list()}, ["linux/arm64"]),
+    ],
+)
+def test_filter_index_returns_unfiltered_manifests_byte_for_byte(manifest: Dict[str, Any], platforms: List[str]) -> None:
+    raw = json.dumps(manifest, indent=2).encode("utf-8")
+    assert filter_index(raw, str(manifest["mediaType"]), platforms) == (raw, sha256_digest(raw))
+
+
+def test_filter_index_without_a_match_fails() -> None:
+    with pytest.raises(RegistryError, match="no manifest in the index matches platforms windows/amd64"):
+        filter_index(json.dumps(INDEX).encode("utf-8"), MEDIA_TYPE_OCI_INDEX, ["windows/amd64"])
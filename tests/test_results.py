@@ -0,0 +1,78 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any
+from typing import List
+
+import pytest
+
+from plan import in_shard
+from plan import parse_shard
+from plan import shard_of
+from results import merge_results
+from results import RESULT_FAILED
+from results import RESULT_REPLICATED
+from results import RunResults
+
+logger = logging.getLogger("test_results")
+
+
+def write_shard(tmp_path: Path, index: int, count: int, destinations: List[str], status: str = RESULT_REPLICATED) -> Path:
+    results = RunResults((index, count))
+    for destination in destinations:
+        results.record(f"source/{destination}", destination, status)
+    path = tmp_path / f"results-{index}-of-{count}.json"
+    results.write(path)
+    return path
+
+
+@pytest.mark.parametrize("value", ["0/2", "3/2", "1", "1/", "/2", "a/b", "-1/2", "1/0"])
+def test_invalid_shards_are_rejected(value: str) -> None:
+    with pytest.raises(ValueError, match="invalid shard"):
+        parse_shard(value)
+
+
+def test_every_key_lands_in_exactly_one_shard() -> None:
+    assert parse_shard("2/4") == (2, 4)
+    keys = [f"registry.example.com/app{number}:1.0" for number in range(200)]
+    for key in keys:
+        assert [index for index in range(1, 5) if in_shard(key, (index, 4))] == [shard_of(key, 4)]
+        assert in_shard(key, None)
+    # and the hash spreads them out
+    assert {shard_of(key, 4) for key in keys} == {1, 2, 3, 4}
+
+
+def test_merge_complete_shards(tmp_path: Path) -> None:
+    paths = [write_shard(tmp_path, 1, 2, ["a", "b"]), write_shard(tmp_path, 2, 2, ["c"])]
+    output = tmp_path / "merged.json"
+    assert merge_results(logger, paths, output) == 0
+
+    report = json.loads(output.read_text())
+    assert report["shard"] is None
+    assert sorted(result["destination"] for result in report["results"]) == ["a", "b", "c"]
+    assert report["counts"] == {RESULT_REPLICATED: 3}
+
+
+def test_merge_reports_missing_and_duplicate_shards(tmp_path: Path, caplog: Any) -> None:
+    first = write_shard(tmp_path, 1, 3, ["a"])
+    copy = tmp_path / "copy.json"
+    copy.write_text(first.read_text())
+    assert merge_results(logger, [first, copy, write_shard(tmp_path, 3, 3, ["c"])]) == 1
+    assert f"{copy} - shard 1/3 was already read from {first}" in caplog.messages
+    assert "missing result files for shards 2 of 3" in caplog.messages
+
+
+def test_merge_reports_disagreeing_shard_counts(tmp_path: Path, caplog: Any) -> None:
+    assert merge_results(logger, [write_shard(tmp_path, 1, 1, ["a"]), write_shard(tmp_path, 2, 2, ["b"])]) == 1
+    assert "result files disagree on the number of shards: 1, 2" in caplog.messages
+
+
+def test_merge_fails_on_failed_entries_and_unreadable_files(tmp_path: Path, caplog: Any) -> None:
+    assert merge_results(logger, [write_shard(tmp_path, 1, 1, ["a"], RESULT_FAILED)]) == 1
+    assert "a - failed: " in caplog.messages
+
+    caplog.clear()
+    broken = tmp_path / "broken.json"
+    broken.write_text("{")
+    assert merge_results(logger, [broken, tmp_path / "missing.json"]) == 1
+    assert [message.split(" - ")[0] for message in caplog.messages] == [str(broken), str(tmp_path / "missing.json")]
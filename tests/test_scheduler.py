@@ -0,0 +1,57 @@
+import logging
+import time
+
+from scheduler import HostLimiter
+from scheduler import HostQueue
+from scheduler import RATE_LIMIT_MAX_INTERVAL
+
+logger = logging.getLogger("test_scheduler")
+
+
+def test_host_queue_skips_items_for_a_busy_host() -> None:
+    limiter = HostLimiter(logger, 4, {"slow": 1})
+    work = HostQueue(limiter, lambda item: [item[0]])
+    for item in ["slow-1", "slow-2", "fast-1", "fast-2"]:
+        work.put(item.split("-"))
+
+    first = work.get()
+    assert first == (["slow", "1"], frozenset({"slow"}))
+    # slow-2 is older but slow has no free slot, so a worker must not wait for it
+    assert work.get() == (["fast", "1"], frozenset({"fast"}))
+    assert work.get() == (["fast", "2"], frozenset({"fast"}))
+
+    work.release(first[1])
+    assert work.get() == (["slow", "2"], frozenset({"slow"}))
+    work.close()
+    assert work.get() is None
+
+
+def test_host_queue_skips_paused_hosts() -> None:
+    limiter = HostLimiter(logger, 4, dict())
+    limiter.pause("paused", 60)
+    work = HostQueue(limiter, lambda item: [item])
+    work.put("paused")
+    work.put("other")
+    assert work.get() == ("other", frozenset({"other"}))
+
+
+def test_slot_skips_hosts_the_thread_already_holds() -> None:
+    limiter = HostLimiter(logger, 1, dict())
+    work = HostQueue(limiter, lambda item: [item])
+    work.put("host")
+    _, hosts = work.get()  # type: ignore[misc]
+    # a daemon call made while processing the item must not wait for the worker's own slot
+    with limiter.slot("host"):
+        pass
+    work.release(hosts)
+    assert limiter.ready_in(["host"]) == 0
+
+
+def test_pacing_is_capped_and_only_applies_to_paced_requests() -> None:
+    limiter = HostLimiter(logger, 4, dict())
+    limiter.observe("hub", 200, {"RateLimit-Remaining": "1;w=21600"})
+    limiter.wait("hub")
+    started = time.monotonic()
+    limiter.wait("hub", paced=False)
+    assert time.monotonic() - started < 1
+    assert limiter._next_request["hub"] - started <= RATE_LIMIT_MAX_INTERVAL
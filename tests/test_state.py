@@ -0,0 +1,84 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any
+
+from entries import build_replication_entry
+from entries import ReplicationEntry
+from state import state_key
+from state import SyncState
+
+logger = logging.getLogger("test_state")
+
+SHA256 = "a" * 64
+
+
+def entry(**source: Any) -> ReplicationEntry:
+    image = {
+        "source": dict({"repository": "registry.example.com/app", "tag": "1.0"}, **source),
+        "destination": {"repository": "mirror/app"},
+    }
+    replication_entry = build_replication_entry(logger, image)
+    assert replication_entry is not None
+    return replication_entry
+
+
+def test_records_survive_a_reload(tmp_path: Path) -> None:
+    path = tmp_path / "state.jsonl"
+    state = SyncState(logger, path)
+    state.record(entry())
+    state.record(entry(polledDigest=f"sha256:{SHA256}"))
+    state.close()
+
+    state = SyncState(logger, path)
+    try:
+        assert state.is_fresh(entry(), 3600, 3600)
+        assert not state.is_fresh(entry(), 0, 0)
+        # the newest record of a key wins, and it was confirmed with the polled digest
+        assert state.records[state_key(entry())]["digest"] == f"sha256:{SHA256}"
+        assert state.is_fresh(entry(polledDigest=f"sha256:{SHA256}"), 3600, 3600)
+        assert not state.is_fresh(entry(polledDigest=f"sha256:{'b' * 64}"), 3600, 3600)
+    finally:
+        state.close()
+
+
+def test_pins_and_platforms_are_separate_keys(tmp_path: Path) -> None:
+    state = SyncState(logger, tmp_path / "state.jsonl")
+    try:
+        state.record(entry())
+        assert not state.is_fresh(entry(sha256=SHA256), 3600, 3600)
+        assert not state.is_fresh(entry(platforms=["linux/amd64"]), 3600, 3600)
+        # forcePull entries expire on their own TTL
+        assert state.is_fresh(entry(forcePull=True), 3600, 3600)
+        assert not state.is_fresh(entry(forcePull=True), 3600, 0)
+    finally:
+        state.close()
+
+
+def test_malformed_lines_are_ignored(tmp_path: Path) -> None:
+    path = tmp_path / "state.jsonl"
+    state = SyncState(logger, path)
+    state.record(entry())
+    state.close()
+    with open(path, "a", encoding="utf-8") as state_file:
+        state_file.write('[]\n{"no": "key"}\n{"key": "cut off by a kil')
+
+    state = SyncState(logger, path)
+    state.close()
+    assert list(state.records) == [state_key(entry())]
+
+
+def test_mostly_superseded_state_file_is_compacted(tmp_path: Path) -> None:
+    path = tmp_path / "state.jsonl"
+    state = SyncState(logger, path)
+    for _ in range(150):
+        state.record(entry())
+    state.record(entry(tag="2.0"))
+    state.close()
+    assert len(path.read_text().splitlines()) == 151
+
+    state = SyncState(logger, path)
+    state.record(entry(tag="3.0"))
+    state.close()
+    keys = [json.loads(line)["key"] for line in path.read_text().splitlines()]
+    assert keys == [state_key(entry()), state_key(entry(tag="2.0")), state_key(entry(tag="3.0"))]
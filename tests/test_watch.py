@@ -0,0 +1,102 @@
+import logging
+from pathlib import Path
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+import pytest
+from fakes import FakeRegistry
+
+import watch
+from engines import DockerEngine
+from engines import EnginePool
+from entries import build_replication_entry
+from replicate import open_registry_pool
+from replicate import replicate
+from results import RESULT_UP_TO_DATE
+from results import RunResults
+from state import STATE_CONFIRMED
+
+logger = logging.getLogger("test_watch")
+
+
+class StopWatching(Exception):
+    pass
+
+
+def test_watch_with_state_file_replicates_moved_tag(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any], monkeypatch: Any
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [b"first"])
+    input_file = tmp_path / "images.yaml"
+    input_file.write_text("images: []\n")
+    arguments = parse_arguments("--engine", "registry", "--state-file", str(tmp_path / "state.jsonl"), "--watch", "1", str(input_file))
+    arguments.watch = 0
+    image = {"source": {"repository": f"{source.host}/app", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/mirror/app"}}
+
+    passes: List[RunResults] = list()
+
+    def replicate_pass(logger: Any, arguments: Any, engines: Any, images: Any, results: RunResults, registry_pool: Any) -> None:
+        passes.append(results)
+        if len(passes) == 2:
+            # the tag moves between the first and second pass, well within the state file's TTL
+            source.seed_image("app", "1.0", [b"second"])
+        if len(passes) == 3:
+            raise StopWatching()
+        replicate(logger, arguments, engines, images, results, registry_pool)
+
+    monkeypatch.setattr(watch, "replicate", replicate_pass)
+    engines = EnginePool(logger, connect=lambda: pytest.fail("the registry engine doesn't need the daemon"))
+    with pytest.raises(StopWatching):
+        watch.watch(logger, arguments, engines, lambda errors: iter([("replicate", image)]))
+
+    assert [results.counts() for results in passes[:2]] == [{"replicated": 1}, {"replicated": 1}]
+    assert destination.get_manifest("mirror/app", "1.0") == source.get_manifest("app", "1.0")
+
+
+def test_confirm_ignores_entries_skipped_by_state_file(
+    tmp_path: Path, registries: Tuple[FakeRegistry, FakeRegistry], parse_arguments: Callable[..., Any]
+) -> None:
+    source, destination = registries
+    source.seed_image("app", "1.0", [b"first"])
+    arguments = parse_arguments("--engine", "registry", str(tmp_path / "images.yaml"))
+    image = {"source": {"repository": f"{source.host}/app", "tag": "1.0"}, "destination": {"repository": f"{destination.host}/mirror/app"}}
+    entry = build_replication_entry(logger, image)
+    assert entry is not None
+
+    registry_pool = open_registry_pool(logger, arguments)
+    try:
+        poller = watch.SourcePoller(logger, registry_pool)
+        assert len(list(poller.changed_images([(image, entry)], 0))) == 1
+        results = RunResults()
+        results.record(entry.source_endpoint, entry.destination_endpoint, RESULT_UP_TO_DATE, STATE_CONFIRMED)
+        poller.confirm(results)
+        assert poller.confirmed == dict()
+        # so the next pass hands it out again
+        assert len(list(poller.changed_images([(image, entry)], 0))) == 1
+    finally:
+        registry_pool.close()
+
+
+def test_watch_runs_builds_on_every_pass(tmp_path: Path, parse_arguments: Callable[..., Any], monkeypatch: Any) -> None:
+    input_file = tmp_path / "images.yaml"
+    input_file.write_text("images: []\n")
+    arguments = parse_arguments("--engine", "registry", "--watch", "1", str(input_file))
+    arguments.watch = 0
+    build = {"build": {"build_folder": str(tmp_path), "tags": ["1.0"]}, "destination": {"repository": "localhost/app"}}
+
+    builds: List[Any] = list()
+    monkeypatch.setattr(watch, "construct_build", lambda logger, arguments, client, images, results: builds.append(images))
+
+    def replicate_pass(logger: Any, arguments: Any, engines: Any, images: Any, results: RunResults, registry_pool: Any) -> None:
+        if len(builds) == 3:
+            raise StopWatching()
+
+    monkeypatch.setattr(watch, "replicate", replicate_pass)
+    engines = EnginePool(logger, connect=lambda: [DockerEngine("fake", None)])
+    with pytest.raises(StopWatching):
+        # the input file doesn't change, but a build folder can
+        watch.watch(logger, arguments, engines, lambda errors: iter([("build", build)]))
+    assert builds == [[build], [build], [build]]